@@ -0,0 +1,90 @@
+"""
+bidskit command line tools as an importable package
+
+The tools (dcm2bids, dcm2ndar, dcmhdr and dcmpacs) remain standalone scripts. This package
+adds a single entry point that runs any of them in the current interpreter, so a cluster worker
+that runs many short per-subject jobs only pays interpreter and import startup once:
+
+% python -m bidskit dcm2bids -i mydicom -o mybids --subjects Ra0950
+% python -m bidskit --commands jobs.txt
+
+where jobs.txt lists one tool command line per line. From Python:
+
+>>> import bidskit
+>>> status = bidskit.run('dcm2bids', ['-i', 'mydicom', '-o', 'mybids', '--subjects', 'Ra0950'])
+
+Heavy dependencies (pydicom, nibabel, numpy, dateutil, asyncio, pynetdicom) are imported by the
+tools on first use, so they too are only loaded once per worker.
+
+MIT License
+
+Copyright (c) 2017 Mike Tyszka
+"""
+
+import os
+import sys
+import importlib
+
+__version__ = '1.0.0'
+
+# Tool names and their script modules
+TOOLS = ['dcm2bids', 'dcm2ndar', 'dcmhdr', 'dcmpacs']
+
+# Repository checkout containing the tool scripts next to this package
+_SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def tool_module(tool):
+    """
+    Import a tool's script module (cached by the interpreter after the first call)
+
+    :param tool: str
+        Tool name from TOOLS
+    :return: module with a main() function
+        Raises ValueError for an unknown tool
+    """
+
+    if tool not in TOOLS:
+        raise ValueError('Unknown bidskit tool %s - choose from %s' % (tool, ', '.join(TOOLS)))
+
+    # Running from a repository checkout rather than an installed copy
+    if os.path.isfile(os.path.join(_SCRIPT_DIR, tool + '.py')) and _SCRIPT_DIR not in sys.path:
+        sys.path.append(_SCRIPT_DIR)
+
+    return importlib.import_module(tool)
+
+
+def run(tool, argv=None):
+    """
+    Run a tool's main() in this interpreter with the given arguments
+    - SystemExit from the tool is caught and returned as the exit status, so the
+      interpreter and its imported modules can be reused for the next job
+    - Logging is configured by the first tool run in the process
+
+    :param tool: str
+        Tool name from TOOLS
+    :param argv: list
+        Command line arguments, without the program name
+    :return status: int
+        Tool exit status (0 for success)
+    """
+
+    module = tool_module(tool)
+
+    saved_argv = sys.argv
+    sys.argv = [tool + '.py'] + list(argv or [])
+
+    try:
+        module.main()
+        status = 0
+    except SystemExit as err:
+        if err.code is None or isinstance(err.code, int):
+            status = err.code or 0
+        else:
+            # sys.exit('message') prints the message and exits with status 1
+            print(err.code, file=sys.stderr)
+            status = 1
+    finally:
+        sys.argv = saved_argv
+
+    return status
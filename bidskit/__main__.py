@@ -0,0 +1,76 @@
+"""
+Single entry point for the bidskit tools
+
+Usage
+----
+% python -m bidskit <tool> [tool arguments]
+% python -m bidskit --commands <file>
+
+<tool> is one of dcm2bids, dcm2ndar, dcmhdr or dcmpacs. With --commands, each non-blank
+line of the file (- for stdin) is one tool command line, run in turn in this interpreter.
+Lines starting with # are ignored. The exit status is the highest status of any command.
+
+MIT License
+
+Copyright (c) 2017 Mike Tyszka
+"""
+
+import sys
+import shlex
+
+from bidskit import TOOLS, run
+
+
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    if not argv or argv[0] in ('-h', '--help'):
+        print('usage: bidskit <tool> [arguments] | bidskit --commands <file>')
+        print('tools: %s' % ', '.join(TOOLS))
+        return 0 if argv else 2
+
+    if argv[0] == '--commands':
+
+        if len(argv) != 2:
+            print('* --commands takes one filename (- for stdin)')
+            return 2
+
+        # Read every command first so a tool reading stdin can't consume the list
+        if argv[1] == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(argv[1], 'r') as cmd_fd:
+                lines = cmd_fd.readlines()
+
+        commands = [shlex.split(line) for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+        status = 0
+        for command in commands:
+            status = max(status, run_command(command))
+
+        return status
+
+    return run_command(argv)
+
+
+def run_command(command):
+    """
+    Run one tool command line
+
+    :param command: list
+        Tool name (optionally with a .py extension) followed by its arguments
+    :return status: int
+    """
+
+    tool = command[0][:-3] if command[0].endswith('.py') else command[0]
+
+    if tool not in TOOLS:
+        print('* Unknown bidskit tool %s - choose from %s' % (command[0], ', '.join(TOOLS)))
+        return 2
+
+    return run(tool, command[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -36,6 +36,7 @@ Examples
 % dcm2bids.py
 % dcm2bids.py --no-sessions
 % dcm2bids.py -i mydicom -o mybids --no-sessions
+% dcm2bids.py -i mydicom -o mybids --watch --quiet-period 600
 
 Authors
 ----
@@ -73,14 +74,41 @@ SOFTWARE.
 __version__ = '1.0.0'
 
 import os
+import re
 import sys
 import argparse
-import subprocess
 import shutil
 import json
-import dicom
+import time
+import logging
+import gzip
+import struct
+import hashlib
+import tempfile
+import threading
+import traceback
+import dcmconv
+import dcmio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
 from glob import glob
 
+# Module logger - level set in main() from the --quiet and --verbose flags
+logger = logging.getLogger('dcm2bids')
+
+# DICOM header elements used for header-only protocol discovery
+BIDS_DISCOVERY_TAGS = ['SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'ProtocolName',
+                       'ScanningSequence', 'ImageType', 'Rows', 'Columns']
+
+# DICOM header elements used to detect duplicate files and series
+BIDS_DEDUP_TAGS = ['SOPInstanceUID', 'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription',
+                   'AcquisitionDate', 'AcquisitionTime', 'InstanceNumber', 'ImagePositionPatient']
+
+# Marker left in a working conversion directory once its intermediate files have been deleted
+BIDS_RECLAIM_MARKER = '.reclaimed'
+
 
 def main():
 
@@ -96,15 +124,87 @@ def main():
     parser.add_argument('--no-sessions', action='store_true', default=False,
                         help='Do not use session sub-directories')
 
+    parser.add_argument('--include', action='append', default=None,
+                        help='Only convert subject directories matching this pattern (repeatable)')
+
+    parser.add_argument('--exclude', action='append', default=None,
+                        help='Skip subject directories matching this pattern (repeatable)')
+
     parser.add_argument('--overwrite', action='store_true', default=False,
                         help='Overwrite existing files')
 
+    parser.add_argument('-q', '--quiet', action='store_true', default=False,
+                        help='Only report warnings and errors')
+
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='Report per-file detail')
+
+    parser.add_argument('--plan', default=None,
+                        help='Write the complete DICOM to BIDS mapping to this JSON or TSV file without converting or copying')
+
+    parser.add_argument('--discover', action='store_true', default=False,
+                        help='Create the protocol translator template from DICOM headers without converting')
+
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of concurrent dcm2niix conversions [1]')
+
+    parser.add_argument('--io-threads', type=int, default=8,
+                        help='Number of concurrent file copies and sidecar writes during BIDS placement [8]')
+
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Seconds before a dcm2niix conversion is killed [no limit]')
+
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Retries for a failed or timed out dcm2niix conversion [0]')
+
+    parser.add_argument('--batch', action='store_true', default=False,
+                        help='Convert sessions through dcm2niibatch, one process per concurrent job')
+
+    parser.add_argument('--direct', action='store_true', default=False,
+                        help='Move converted images into the BIDS source directory instead of copying them')
+
+    parser.add_argument('--scratch', default=None,
+                        help='Node-local directory for staging DICOM and converting each session')
+
+    parser.add_argument('--scratch-budget', type=float, default=None,
+                        help='Maximum scratch space to use in GB [90%% of free space]')
+
+    parser.add_argument('--reclaim', default='none', choices=['none', 'verified', 'sidecars', 'lru'],
+                        help='Working directory reclamation after each session is placed [none]')
+
+    parser.add_argument('--work-cap', type=float, default=None,
+                        help='Working directory size cap in GB for --reclaim lru')
+
+    parser.add_argument('--manifest', action='store_true', default=False,
+                        help='Maintain an MD5/SHA-256 manifest of the BIDS source directory')
+
+    parser.add_argument('--dedup', action='store_true', default=False,
+                        help='Skip duplicate DICOM series and files before conversion')
+
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='Stay resident and convert sessions as they arrive in the DICOM directory')
+
+    parser.add_argument('--quiet-period', type=float, default=300.0,
+                        help='Seconds a session must remain unchanged before conversion in watch mode [300]')
+
+    parser.add_argument('--poll-interval', type=float, default=30.0,
+                        help='Seconds between DICOM directory polls in watch mode [30]')
+
     # Parse command line arguments
     args = parser.parse_args()
     dcm_root_dir = os.path.realpath(args.indir)
     no_sessions = args.no_sessions
     overwrite = args.overwrite
 
+    # Plain message logging to stdout
+    if args.quiet:
+        log_level = logging.WARNING
+    elif args.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+    logging.basicConfig(level=log_level, format='%(message)s', stream=sys.stdout)
+
     # Place derivatives and working directories in parent of BIDS source directory
     bids_src_dir = os.path.realpath(args.outdir)
     bids_root_dir = os.path.dirname(bids_src_dir)
@@ -116,16 +216,16 @@ def main():
     safe_mkdir(bids_src_dir)
     safe_mkdir(bids_deriv_dir)
 
-    print('')
-    print('------------------------------------------------------------')
-    print('Directory Structure')
-    print('------------------------------------------------------------')
-    print('DICOM Root Directory       : %s' % dcm_root_dir)
-    print('BIDS Source Directory      : %s' % bids_src_dir)
-    print('BIDS Derivatives Directory : %s' % bids_deriv_dir)
-    print('Working Directory          : %s' % work_dir)
-    print('Use Session Directories    : %s' % ('No' if no_sessions else 'Yes') )
-    print('Overwrite Existing Files   : %s' % ('Yes' if overwrite else 'No') )
+    logger.info('')
+    logger.info('------------------------------------------------------------')
+    logger.info('Directory Structure')
+    logger.info('------------------------------------------------------------')
+    logger.info('DICOM Root Directory       : %s' % dcm_root_dir)
+    logger.info('BIDS Source Directory      : %s' % bids_src_dir)
+    logger.info('BIDS Derivatives Directory : %s' % bids_deriv_dir)
+    logger.info('Working Directory          : %s' % work_dir)
+    logger.info('Use Session Directories    : %s' % ('No' if no_sessions else 'Yes') )
+    logger.info('Overwrite Existing Files   : %s' % ('Yes' if overwrite else 'No') )
 
     # Load protocol translation and exclusion info from derivatives/conversion directory
     # If no translator is present, prot_dict is an empty dictionary
@@ -135,456 +235,2379 @@ def main():
     prot_dict = bids_load_prot_dict(prot_dict_json)
 
     if prot_dict and os.path.isdir(work_dir):
-        print('')
-        print('------------------------------------------------------------')
-        print('Pass 2 : Populating BIDS source directory')
-        print('------------------------------------------------------------')
+        logger.info('')
+        logger.info('------------------------------------------------------------')
+        logger.info('Pass 2 : Populating BIDS source directory')
+        logger.info('------------------------------------------------------------')
         first_pass = False
     else:
-        print('')
-        print('------------------------------------------------------------')
-        print('Pass 1 : DICOM to Nifti conversion and dictionary creation')
-        print('------------------------------------------------------------')
+        logger.info('')
+        logger.info('------------------------------------------------------------')
+        logger.info('Pass 1 : DICOM to Nifti conversion and dictionary creation')
+        logger.info('------------------------------------------------------------')
         first_pass = True
 
-    # Initialize BIDS source directory contents
+    if args.plan:
+
+        if first_pass:
+            logger.error('* Planning requires a completed protocol translator')
+            sys.exit(1)
+
+        # Map existing working conversions to the BIDS source tree without touching any images
+        plan = []
+        for SID, dcm_sub_dir in bids_subject_dirs(dcm_root_dir, args.include, args.exclude):
+            for SES, dcm_dir in bids_session_dirs(dcm_sub_dir, no_sessions):
+                session_key = bids_session_key(SID, SES)
+                work_conv_dir = os.path.join(work_dir, session_key)
+                if not os.path.isdir(work_conv_dir):
+                    logger.warning('* %s has not been converted yet - not included in plan' % session_key)
+                    continue
+                plan.extend(bids_plan_session(work_conv_dir, prot_dict, os.path.join(bids_src_dir, session_key),
+                                              SID, SES))
+
+        bids_write_plan(args.plan, plan)
+        logger.info('')
+        logger.info('Conversion plan for %d images written to %s' % (len(plan), args.plan))
+        sys.exit(0)
+
+    if args.discover:
+
+        if not first_pass:
+            logger.error('* Protocol translator already exists : %s' % prot_dict_json)
+            logger.error('* Delete or rename it to rediscover protocols')
+            sys.exit(1)
+
+        # Header-only Pass 1 - all conversion happens once, in Pass 2
+        sessions = [(SID, SES, dcm_dir)
+                    for SID, dcm_sub_dir in bids_subject_dirs(dcm_root_dir, args.include, args.exclude)
+                    for SES, dcm_dir in bids_session_dirs(dcm_sub_dir, no_sessions)]
+
+        protocols = bids_discover_protocols(sessions)
+
+        for ser_desc in protocols:
+            prot_dict[ser_desc] = ["EXCLUDE_BIDS_Directory", "EXCLUDE_BIDS_Name", "UNASSIGNED"]
+
+        discovery_tsv = os.path.join(bids_deriv_dir, 'Protocol_Discovery.tsv')
+        bids_write_discovery(discovery_tsv, protocols)
+        logger.info('')
+        logger.info('%d protocols found in %d sessions - see %s' % (len(protocols), len(sessions), discovery_tsv))
+
+        bids_create_prot_dict(prot_dict_json, prot_dict)
+        sys.exit(0)
+
+    # Per-session timing and throughput metrics are appended to a JSON lines file
+    metrics_fd = open(os.path.join(bids_deriv_dir, 'Conversion_Metrics.jsonl'), 'a')
+
+    # Duplicate DICOM series and files skipped before conversion are reported here
+    dedup_report = os.path.join(bids_deriv_dir, 'Dedup_Report.tsv') if args.dedup else None
+
+    # Scratch space budget in bytes
+    scratch_budget = args.scratch_budget * 1e9 if args.scratch_budget else None
+
+    if args.reclaim == 'lru' and not args.work_cap:
+        logger.error('* --reclaim lru requires --work-cap')
+        sys.exit(1)
+
+    # Initialize BIDS source directory contents and Pass 2 progress journal
+    # The journal lets an interrupted Pass 2 resume without redoing completed placements
     if not first_pass:
-        participants_fd = bids_init(bids_src_dir, overwrite)
+        participants = bids_init(bids_src_dir, overwrite)
+        journal = bids_open_journal(os.path.join(work_dir, 'Conversion_Journal.jsonl'), overwrite)
+        bids_check_journal_translator(journal, prot_dict)
     else:
-        participants_fd = []
-
-    # Loop over subject directories in DICOM root
-    for dcm_sub_dir in glob(dcm_root_dir + '/*/'):
+        participants = None
+        journal = None
 
-        SID = os.path.basename(dcm_sub_dir.strip('/'))
+    # Working directory reclamation state (Pass 2 only)
+    reclaim = None if first_pass else bids_init_reclaim(args.reclaim, work_dir, args.work_cap)
 
-        print('')
-        print('------------------------------------------------------------')
-        print('Processing subject ' + SID)
-        print('------------------------------------------------------------')
+    # Checksum manifest of the BIDS source directory, filled as files are placed (Pass 2 only)
+    if args.manifest and not first_pass:
+        manifest = bids_open_manifest(os.path.join(bids_deriv_dir, 'Checksum_Manifest.tsv'), bids_src_dir)
+    else:
+        manifest = None
 
-        # Handle subj vs subj/session directory lists
-        if no_sessions:
-            dcm_dir_list = [dcm_sub_dir]
-        else:
-            dcm_dir_list = glob(dcm_sub_dir + '/*/')
+    if args.watch:
 
-        # Loop over session directories in subject directory
-        for dcm_dir in dcm_dir_list:
+        if first_pass:
+            logger.error('* Watch mode requires a completed protocol translator')
+            logger.error('* Run Pass 1, edit %s and restart with --watch' % prot_dict_json)
+            sys.exit(1)
 
-            # BIDS subject, session and conversion directories
-            sub_prefix = 'sub-' + SID
+        # Stay resident, converting sessions as they finish arriving
+        conv_results = bids_watch(dcm_root_dir, work_dir, bids_src_dir, prot_dict, participants, journal,
+                                  metrics_fd, no_sessions, args.quiet_period, args.poll_interval,
+                                  args.timeout, args.retries, overwrite, args.io_threads, dedup_report,
+                                  args.direct, args.scratch, scratch_budget, reclaim, manifest,
+                                  args.include, args.exclude)
 
-            if no_sessions:
-                # If session subdirs aren't being used, *_ses_dir = *sub_dir
-                # Use an empty ses_prefix with os.path.join to achieve this
-                SES = ''
-                ses_prefix = ''
-            else:
-                SES = os.path.basename(dcm_dir.strip('/'))
-                ses_prefix = 'ses-' + SES
-                print('  Processing session ' + SES)
-
-            # Working conversion directories
-            work_subj_dir = os.path.join(work_dir, sub_prefix)
-            work_conv_dir = os.path.join(work_subj_dir, ses_prefix)
-
-            # BIDS source directory directories
-            bids_src_subj_dir = os.path.join(bids_src_dir, sub_prefix)
-            bids_src_ses_dir = os.path.join(bids_src_subj_dir, ses_prefix)
-
-            print('  BIDS working subject directory : %s' % work_subj_dir)
-            if not no_sessions:
-                print('  BIDS working session directory : %s' % work_conv_dir)
-            print('  BIDS source subject directory  : %s' % bids_src_subj_dir)
-            if not no_sessions:
-                print('  BIDS source session directory  : %s' % bids_src_ses_dir)
-
-            # Safely create BIDS working directory
-            # Flag for conversion if no working directory existed
-            if not os.path.isdir(work_conv_dir):
-                os.makedirs(work_conv_dir)
-                needs_converting = True
-            else:
-                needs_converting = False
+    else:
 
-            if first_pass or needs_converting:
+        # All (SID, SES, session DICOM directory) combinations in the DICOM root
+        sessions = [(SID, SES, dcm_dir)
+                    for SID, dcm_sub_dir in bids_subject_dirs(dcm_root_dir, args.include, args.exclude)
+                    for SES, dcm_dir in bids_session_dirs(dcm_sub_dir, no_sessions)]
 
-                # Run dcm2niix conversion into working conversion directory
-                print('  Converting all DICOM images in %s' % dcm_dir)
-                devnull = open(os.devnull, 'w')
-                subprocess.call(['dcm2niix', '-b', 'y', '-z', 'y', '-f', '%n--%d--%q--%s',
-                                 '-o', work_conv_dir, dcm_dir],
-                                stdout=devnull, stderr=subprocess.STDOUT)
+        # Run all required dcm2niix conversions concurrently before BIDS placement
+        conv_results = bids_convert_sessions(sessions, work_dir, first_pass, args.jobs, args.timeout, args.retries,
+                                             batch=args.batch, scratch_dir=args.scratch,
+                                             scratch_budget=scratch_budget, journal=journal,
+                                             dedup_report=dedup_report)
 
-            else:
+        # Probe participant demographics for all subjects in parallel before BIDS placement
+        if first_pass:
+            demographics = None
+        else:
+            demographics = bids_demographics(bids_subject_dirs(dcm_root_dir, args.include, args.exclude))
 
-                # Get subject age and sex from representative DICOM header
-                dcm_info = bids_dcm_info(dcm_dir)
+        # Loop over subject sessions
+        last_SID = None
+        for SID, SES, dcm_dir in sessions:
 
-                # Add line to participants TSV file
-                participants_fd.write("sub-%s\t%s\t%s\n" % (SID, dcm_info['Sex'], dcm_info['Age']))
+            if SID != last_SID:
+                logger.info('')
+                logger.info('------------------------------------------------------------')
+                logger.info('Processing subject ' + SID)
+                logger.info('------------------------------------------------------------')
+                last_SID = SID
 
-            # Run dcm2niix output to BIDS source conversions
-            bids_run_conversion(work_conv_dir, first_pass, prot_dict, bids_src_ses_dir, SID, SES, overwrite)
+            bids_process_session(dcm_dir, SID, SES, work_dir, bids_src_dir, first_pass, prot_dict,
+                                 participants, journal, metrics_fd, overwrite,
+                                 conv_results.get(bids_session_key(SID, SES)), demographics, args.io_threads,
+                                 args.direct, reclaim, manifest)
 
     if first_pass:
         # Create a template protocol dictionary
         bids_create_prot_dict(prot_dict_json, prot_dict)
     else:
-        # Close participants TSV file
-        participants_fd.close()
+        # Close progress journal (participants.tsv is rewritten as each session is processed)
+        journal['fd'].close()
+
+        # Complete the checksum manifest, hashing only files not recorded during placement
+        if manifest:
+            bids_close_manifest(manifest, args.io_threads)
+
+    metrics_fd.close()
+
+    # Final dcm2niix summary, including any failed or empty conversions
+    if conv_results:
+        logger.info('')
+        for line in dcmconv.dcm2niix_summary(list(conv_results.values())):
+            if line.startswith('*'):
+                logger.warning(line)
+            else:
+                logger.info(line)
 
     # Clean exit
     sys.exit(0)
 
 
-def bids_run_conversion(conv_dir, first_pass, prot_dict, src_dir, SID, SES, overwrite=False):
+def bids_subject_dirs(dcm_root_dir, include=None, exclude=None):
+    """
+    Subject directories in the DICOM root directory, yielded as the root is read
+    - Hidden directories (eg the dcmpacs.py staging directory) are skipped
+
+    :param dcm_root_dir: string
+        DICOM root directory
+    :param include: list
+        Subject directory name patterns to include (None includes all)
+    :param exclude: list
+        Subject directory name patterns to exclude
+    :return: generator of (SID, subject DICOM directory) tuples
     """
-    Run dcm2niix output to BIDS source conversions
 
-    :param conv_dir: string
-        Working conversion directory
+    return dcmio.scan_dirs(dcm_root_dir, include, exclude)
+
+
+def bids_session_dirs(dcm_sub_dir, no_sessions=False):
+    """
+    Session directories within a subject DICOM directory, yielded as the directory is read
+
+    :param dcm_sub_dir: string
+        Subject DICOM directory
+    :param no_sessions: bool
+        Treat the subject directory as a single unnamed session
+    :return: generator of (session name, session DICOM directory) tuples
+    """
+
+    # If session subdirs aren't being used, the session name is empty
+    if no_sessions:
+        return iter([('', dcm_sub_dir)])
+
+    return dcmio.scan_dirs(dcm_sub_dir)
+
+
+def bids_session_key(SID, SES):
+    """
+    Session key relative to the working and BIDS source roots (eg 'sub-01/ses-1' or 'sub-01')
+
+    :param SID: string
+        subject ID
+    :param SES: string
+        session name or empty string if session directories are not used
+    :return: string
+    """
+
+    # An empty session prefix with os.path.join collapses the session level
+    return os.path.join('sub-' + SID, 'ses-' + SES if SES else '').rstrip(os.sep)
+
+
+def bids_convert_sessions(sessions, work_dir, first_pass, max_jobs=1, timeout=None, retries=0,
+                          reconvert=False, dedup_report=None, batch=False, scratch_dir=None, scratch_budget=None,
+                          journal=None):
+    """
+    Run dcm2niix for every session that needs converting
+    - All of Pass 1 and any Pass 2 session without a working conversion directory
+    - Conversions run concurrently with output captured to work_dir/logs
+    - Working directories of failed conversions are removed so that a rerun retries them
+    - With a scratch directory, sessions are staged and converted on local disk in waves that fit the budget
+    - Reclaimed working directories are reconverted unless the journal still records the session as complete
+
+    :param sessions: list
+        (SID, SES, session DICOM directory) tuples
+    :param work_dir: string
+        Working conversion root directory
     :param first_pass: boolean
         Flag for first pass conversion
-    :param prot_dict: dictionary
-        Protocol translation dictionary
-    :param src_dir: string
-        BIDS source output subj or subj/session directory
+    :param max_jobs: int
+        Maximum number of concurrent dcm2niix processes
+    :param timeout: float
+        Seconds before a conversion attempt is killed
+    :param retries: int
+        Additional attempts for failed conversions
+    :param reconvert: bool
+        Discard any existing working conversion and rerun dcm2niix
+    :param dedup_report: string
+        If set, skip duplicate DICOM series and files before conversion and append them to this TSV report
+    :param batch: bool
+        Convert through dcm2niibatch, splitting sessions into max_jobs shards of one process each
+    :param scratch_dir: string
+        If set, stage DICOM and convert in a temporary directory here, then copy the results back
+    :param scratch_budget: float
+        Maximum bytes of scratch space to use (None uses 90% of the free space)
+    :param journal: dictionary
+        Pass 2 progress journal from bids_open_journal
+    :return conv_results: dictionary
+        dcm2niix results keyed by session key
+    """
+
+    # (session key, session DICOM directory, working conversion directory) for each conversion
+    pending = []
+
+    # Dedup staging directories, removed once converted
+    stage_dirs = []
+
+    for SID, SES, dcm_dir in sessions:
+
+        session_key = bids_session_key(SID, SES)
+        work_conv_dir = os.path.join(work_dir, session_key)
+
+        # Discard a stale working conversion (eg series added after a previous conversion)
+        if reconvert and os.path.isdir(work_conv_dir):
+            logger.info('  Discarding previous working conversion %s' % work_conv_dir)
+            shutil.rmtree(work_conv_dir)
+
+        # A reclaimed working conversion is only needed again if the placement has to be redone
+        elif (not first_pass and os.path.isfile(os.path.join(work_conv_dir, BIDS_RECLAIM_MARKER)) and
+              'complete' not in (journal['done'].get(session_key, set()) if journal else set())):
+            logger.info('  Reconverting reclaimed working conversion %s' % work_conv_dir)
+            shutil.rmtree(work_conv_dir)
+
+        # Safely create BIDS working directory
+        # Flag for conversion if no working directory existed
+        if not os.path.isdir(work_conv_dir):
+            os.makedirs(work_conv_dir)
+            needs_converting = True
+        else:
+            needs_converting = False
+
+        if first_pass or needs_converting:
+
+            # Convert from a staging directory of unique files if duplicates were found
+            if dedup_report:
+                stage_dir = os.path.join(os.path.dirname(work_dir), 'dedup', session_key)
+                dcm_dir, skipped = bids_dedup_session(dcm_dir, stage_dir, session_key)
+                bids_write_dedup_report(dedup_report, skipped)
+                if dcm_dir == stage_dir:
+                    stage_dirs.append(stage_dir)
+
+            # dcm2niix conversion into working conversion directory
+            logger.info('  Converting all DICOM images in %s' % dcm_dir)
+            pending.append((session_key, dcm_dir, work_conv_dir))
+
+    if scratch_dir and pending:
+        results = bids_scratch_convert(pending, work_dir, scratch_dir, scratch_budget,
+                                       max_jobs, timeout, retries, batch)
+    else:
+        results = bids_dcm2niix(pending, work_dir, max_jobs, timeout, retries, batch)
+
+    conv_results = dict()
+
+    for result in results:
+
+        conv_results[result['name']] = result
+
+        if result['status'] != 'ok':
+            logger.warning('* dcm2niix %s for %s - see %s' % (result['status'], result['name'], result['log']))
+            shutil.rmtree(result['out_dir'], ignore_errors=True)
+
+    # The staged symlinks are only needed by dcm2niix
+    # Remove each staging directory and any parents it leaves empty, up to and including work/dedup
+    dedup_root = os.path.join(os.path.dirname(work_dir), 'dedup')
+    for stage_dir in stage_dirs:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        parent = os.path.dirname(stage_dir)
+        while parent.startswith(dedup_root):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    return conv_results
+
+
+def bids_dcm2niix(pending, work_dir, max_jobs=1, timeout=None, retries=0, batch=False):
+    """
+    Run dcm2niix (or dcm2niibatch) for a list of session conversions
+
+    :param pending: list
+        (session key, DICOM directory, output directory) tuples
+    :param work_dir: string
+        Working conversion root directory, for the conversion logs
+    :param max_jobs: int
+        Maximum number of concurrent dcm2niix processes
+    :param timeout: float
+        Seconds before a conversion attempt is killed
+    :param retries: int
+        Additional attempts for failed conversions
+    :param batch: bool
+        Convert through dcm2niibatch, splitting sessions into max_jobs shards of one process each
+    :return results: list
+        dcm2niix results in pending order
+    """
+
+    log_dir = os.path.join(work_dir, 'logs')
+
+    if batch:
+        # Equivalent of dcm2niix -b y -z y
+        items = [dcmconv.dcm2niibatch_item(session_key, dcm_dir, out_dir, '%n--%d--%q--%s')
+                 for session_key, dcm_dir, out_dir in pending]
+        return dcmconv.run_dcm2niibatch(items, {'isGz': True, 'isCreateBIDS': True},
+                                        log_dir, max_jobs, timeout, retries)
+
+    jobs = [dcmconv.dcm2niix_job(session_key,
+                                 ['dcm2niix', '-b', 'y', '-z', 'y', '-f', '%n--%d--%q--%s', '-o', out_dir, dcm_dir],
+                                 os.path.join(log_dir, session_key.replace(os.sep, '_') + '_dcm2niix.log'),
+                                 out_dir)
+            for session_key, dcm_dir, out_dir in pending]
+
+    return dcmconv.run_dcm2niix_jobs(jobs, max_jobs, timeout, retries)
+
+
+def bids_scratch_convert(pending, work_dir, scratch_dir, scratch_budget=None,
+                         max_jobs=1, timeout=None, retries=0, batch=False):
+    """
+    Convert sessions on node-local scratch space
+    - Sessions are grouped into waves that fit the scratch budget
+    - Each session in a wave is charged twice its DICOM size (staged DICOM plus converted images)
+    - A wave is staged with whole-file sequential copies, converted concurrently,
+      and its results copied back to the working directory before the scratch copies are removed
+    - A session larger than the whole budget is converted in place
+
+    :param pending: list
+        (session key, DICOM directory, working conversion directory) tuples
+    :param work_dir: string
+        Working conversion root directory, for the conversion logs
+    :param scratch_dir: string
+        Node-local scratch directory
+    :param scratch_budget: float
+        Maximum bytes of scratch space to use (None uses 90% of the free space)
+    :param max_jobs: int
+        Maximum number of concurrent dcm2niix processes
+    :param timeout: float
+        Seconds before a conversion attempt is killed
+    :param retries: int
+        Additional attempts for failed conversions
+    :param batch: bool
+        Convert through dcm2niibatch
+    :return results: list
+        dcm2niix results with out_dir set to the working conversion directory
+    """
+
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    if not scratch_budget:
+        scratch_budget = 0.9 * shutil.disk_usage(scratch_dir).free
+
+    # Private scratch directory for this run, removed on exit or error
+    run_dir = tempfile.mkdtemp(prefix='dcm2bids_', dir=scratch_dir)
+    logger.info('  Staging conversions in %s (budget %0.1f GB)' % (run_dir, scratch_budget / 1e9))
+
+    results = []
+
+    try:
+
+        wave, wave_bytes = [], 0
+
+        for session in pending:
+
+            n_bytes = 2 * bids_tree_size(session[1])
+
+            if n_bytes > scratch_budget:
+                logger.warning('* %s needs %0.1f GB of scratch space - converting in place' %
+                               (session[0], n_bytes / 1e9))
+                results.extend(bids_dcm2niix([session], work_dir, 1, timeout, retries, batch))
+                continue
+
+            if wave and wave_bytes + n_bytes > scratch_budget:
+                results.extend(bids_scratch_wave(wave, work_dir, run_dir, max_jobs, timeout, retries, batch))
+                wave, wave_bytes = [], 0
+
+            wave.append(session)
+            wave_bytes += n_bytes
+
+        if wave:
+            results.extend(bids_scratch_wave(wave, work_dir, run_dir, max_jobs, timeout, retries, batch))
+
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    return results
+
+
+def bids_scratch_wave(wave, work_dir, run_dir, max_jobs=1, timeout=None, retries=0, batch=False):
+    """
+    Stage, convert and copy back one wave of sessions on scratch space
+
+    :param wave: list
+        (session key, DICOM directory, working conversion directory) tuples
+    :param work_dir: string
+        Working conversion root directory, for the conversion logs
+    :param run_dir: string
+        Scratch directory for this run
+    :param max_jobs: int
+    :param timeout: float
+    :param retries: int
+    :param batch: bool
+    :return results: list
+        dcm2niix results with out_dir set to the working conversion directory
+    """
+
+    staged = []
+
+    for session_key, dcm_dir, work_conv_dir in wave:
+
+        stage_dir = os.path.join(run_dir, session_key.replace(os.sep, '_'))
+        logger.info('  Staging %s to scratch' % session_key)
+
+        # Symlinks (eg from --dedup) are staged as the files they point to
+        shutil.copytree(dcm_dir, os.path.join(stage_dir, 'dicom'))
+        os.makedirs(os.path.join(stage_dir, 'nifti'))
+
+        staged.append((session_key, os.path.join(stage_dir, 'dicom'), os.path.join(stage_dir, 'nifti')))
+
+    results = bids_dcm2niix(staged, work_dir, max_jobs, timeout, retries, batch)
+
+    for result, (session_key, stage_dcm_dir, stage_out_dir), (_, _, work_conv_dir) in zip(results, staged, wave):
+
+        # Copy converted images back in a single sequential pass
+        if result['status'] == 'ok':
+            for fname in sorted(os.listdir(stage_out_dir)):
+                safe_copy(os.path.join(stage_out_dir, fname), os.path.join(work_conv_dir, fname), overwrite=True)
+
+        shutil.rmtree(os.path.dirname(stage_dcm_dir), ignore_errors=True)
+
+        # Failed conversions are cleaned up from the working directory by the caller
+        result['out_dir'] = work_conv_dir
+
+    return results
+
+
+def bids_tree_size(root_dir):
+    """
+    Total size of the files in a directory tree, following symlinks
+
+    :param root_dir: string
+    :return n_bytes: int
+    """
+
+    n_bytes = 0
+
+    for subdir, dirs, files in os.walk(root_dir):
+        for fname in files:
+            try:
+                n_bytes += os.stat(os.path.join(subdir, fname)).st_size
+            except OSError:
+                pass
+
+    return n_bytes
+
+
+def bids_dedup_session(dcm_dir, stage_dir, session_key=''):
+    """
+    Find duplicate DICOM files and series in a session from a header-only scan
+    - A file is a duplicate if its SOPInstanceUID has already been seen (eg a scanner re-push)
+    - A series is a duplicate of an earlier series with the same description and either the same
+      set of SOPInstanceUIDs or the same acquisition content (acquisition date and time, instance number
+      and slice position of every image), which catches re-exports with regenerated UIDs
+    - Acquisition content is only compared when every image has an acquisition date and time. Anonymized
+      data without them would otherwise match genuine repeat runs with the same geometry
+    - Only files with a DICOM preamble are compared. Other files (eg raw or implicit VR exports without
+      a preamble) are never skipped
+    - If anything is skipped, every remaining file is symlinked into a staging directory for dcm2niix
+
+    :param dcm_dir: string
+        Session DICOM directory
+    :param stage_dir: string
+        Staging directory, recreated if duplicates are found
+    :param session_key: string
+        Session key used in the report
+    :return conv_dir: string
+        Directory to convert (dcm_dir if there are no duplicates, otherwise stage_dir)
+    :return skipped: list
+        One report row dictionary per series with skipped files
+    """
+
+    # Every regular file is staged, but only files with a DICOM preamble are compared
+    all_fnames = [entry.path for entry in dcmio.scan_files(dcm_dir, sort=True)]
+    fnames = [fname for fname in all_fnames if dcmio.is_dicom(fname)]
+    hdrs = dcmio.read_headers(fnames, BIDS_DEDUP_TAGS)
+
+    series = dict()     # Series information keyed by SeriesInstanceUID
+    sop_series = dict() # SeriesInstanceUID of the first file with each SOPInstanceUID
+    drop = set()        # Skipped files
+    skipped = dict()    # Report rows keyed by SeriesInstanceUID
+
+    for fname, hdr in zip(fnames, hdrs):
+
+        # Leave unreadable files for dcm2niix to judge
+        if hdr is None:
+            continue
+
+        uid = hdr.get('SeriesInstanceUID', '')
+        sop = hdr.get('SOPInstanceUID')
+
+        if uid not in series:
+            series[uid] = {'number': hdr.get('SeriesNumber', 0), 'desc': hdr.get('SeriesDescription', ''),
+                           'files': [], 'sops': set(), 'content': set(), 'timed': True}
+
+        if sop and sop in sop_series:
+            drop.add(fname)
+            original = series[sop_series[sop]]
+            row = skipped.setdefault(uid, bids_dedup_row(session_key, series[uid], original,
+                                                         'duplicate SOPInstanceUID'))
+            row['files_skipped'] += 1
+            continue
+
+        sop_series[sop] = uid
+        series[uid]['files'].append(fname)
+        series[uid]['sops'].add(sop)
+        series[uid]['content'].add((hdr.get('AcquisitionDate', ''), hdr.get('AcquisitionTime', ''),
+                                    hdr.get('InstanceNumber', 0), str(hdr.get('ImagePositionPatient', ''))))
+        if not (hdr.get('AcquisitionDate') and hdr.get('AcquisitionTime')):
+            series[uid]['timed'] = False
+
+    # Compare whole series in series number order so the first acquisition is kept
+    seen = dict()
+    for uid, s in sorted(series.items(), key=lambda item: (item[1]['number'], item[0])):
+
+        if not s['files']:
+            continue
+
+        keys = [('sops', s['desc'], frozenset(s['sops']))]
+        if s['timed'] and len(s['content']) == len(s['files']):
+            keys.append(('content', s['desc'], frozenset(s['content'])))
+
+        original = next((seen[k] for k in keys if k in seen), None)
+
+        if original is None:
+            for k in keys:
+                seen[k] = s
+            continue
+
+        drop.update(s['files'])
+        reason = 'duplicate SOPInstanceUIDs' if keys[0] in seen else 'duplicate content'
+        row = skipped.setdefault(uid, bids_dedup_row(session_key, s, original, reason))
+        row['files_skipped'] += len(s['files'])
+
+    if not drop:
+        return dcm_dir, []
+
+    for row in skipped.values():
+        logger.warning('* Skipping %d duplicate files from series %s %s (%s of series %s)' %
+                       (row['files_skipped'], row['series_number'], row['series_description'],
+                        row['reason'], row['duplicate_of']))
+
+    # Stage every file not skipped as a symlink, preserving the session directory layout
+    # Files without a DICOM preamble or with unreadable headers are left for dcm2niix to judge
+    if os.path.isdir(stage_dir):
+        shutil.rmtree(stage_dir)
+
+    for fname in all_fnames:
+        if fname not in drop:
+            link = os.path.join(stage_dir, os.path.relpath(fname, dcm_dir))
+            safe_mkdir(os.path.dirname(link))
+            os.symlink(os.path.abspath(fname), link)
+
+    return stage_dir, list(skipped.values())
+
+
+def bids_dedup_row(session_key, dup, original, reason):
+    """
+    Dedup report row for a series with skipped files
+
+    :param session_key: string
+    :param dup: dictionary
+        Series with skipped files from bids_dedup_session
+    :param original: dictionary
+        Series that was kept
+    :param reason: string
+    :return: dictionary
+    """
+
+    return {'session': session_key, 'series_number': dup['number'], 'series_description': dup['desc'],
+            'files_skipped': 0, 'reason': reason, 'duplicate_of': original['number']}
+
+
+def bids_write_dedup_report(report_fname, rows):
+    """
+    Append duplicate series rows to the dedup report TSV
+
+    :param report_fname: string
+    :param rows: list
+        Report rows from bids_dedup_session
+    :return:
+    """
+
+    columns = ['session', 'series_number', 'series_description', 'files_skipped', 'reason', 'duplicate_of']
+
+    new_report = not os.path.isfile(report_fname)
+
+    with open(report_fname, 'a') as fd:
+        if new_report:
+            fd.write('\t'.join(columns) + '\n')
+        for row in rows:
+            fd.write('\t'.join(str(row[col]) for col in columns) + '\n')
+
+
+def bids_process_session(dcm_dir, SID, SES, work_dir, bids_src_dir, first_pass, prot_dict, participants,
+                         journal=None, metrics_fd=None, overwrite=False, conv_result=None, demographics=None,
+                         io_threads=1, direct=False, reclaim=None, manifest=None):
+    """
+    Convert a single subject session and populate its BIDS source directories
+
+    :param dcm_dir: string
+        Session DICOM directory
     :param SID: string
         subject ID
     :param SES: string
-        session name or number
+        session name or empty string if session directories are not used
+    :param work_dir: string
+        Working conversion root directory
+    :param bids_src_dir: string
+        BIDS source root directory
+    :param first_pass: boolean
+        Flag for first pass conversion
+    :param prot_dict: dictionary
+        Protocol translation dictionary
+    :param participants: dictionary
+        Participants table from bids_init (unused in first pass)
+    :param journal: dictionary
+        Pass 2 progress journal from bids_open_journal (None in first pass)
+    :param metrics_fd: object
+        JSON lines file descriptor for per-session metrics
     :param overwrite: bool
         overwrite flag
+    :param conv_result: dictionary
+        dcm2niix result from bids_convert_sessions if the session was converted by this run
+    :param demographics: dictionary
+        Subject demographics cache from bids_demographics, keyed by subject DICOM directory.
+        Subjects missing from the cache are probed and added
+    :param io_threads: int
+        Number of concurrent file copies and sidecar writes during placement
+    :param direct: bool
+        Move images from the working directory into the BIDS source directory instead of copying
+    :param reclaim: dictionary
+        Working directory reclamation state from bids_init_reclaim
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
     :return:
     """
 
-    # Flag for working conversion directory cleanup
-    do_cleanup = False
+    # BIDS subject, session and conversion directories
+    # An empty ses_prefix with os.path.join collapses *_ses_dir to *_sub_dir
+    sub_prefix = 'sub-' + SID
+    ses_prefix = 'ses-' + SES if SES else ''
+    session_key = bids_session_key(SID, SES)
+
+    if SES:
+        logger.info('  Processing session ' + SES)
+
+    metrics = bids_init_metrics(SID, SES, first_pass)
+
+    # Working conversion directories
+    work_subj_dir = os.path.join(work_dir, sub_prefix)
+    work_conv_dir = os.path.join(work_subj_dir, ses_prefix)
+
+    # BIDS source directory directories
+    bids_src_subj_dir = os.path.join(bids_src_dir, sub_prefix)
+    bids_src_ses_dir = os.path.join(bids_src_subj_dir, ses_prefix)
+
+    logger.info('  BIDS working subject directory : %s' % work_subj_dir)
+    if SES:
+        logger.info('  BIDS working session directory : %s' % work_conv_dir)
+    logger.info('  BIDS source subject directory  : %s' % bids_src_subj_dir)
+    if SES:
+        logger.info('  BIDS source session directory  : %s' % bids_src_ses_dir)
+
+    # dcm2niix time and outcome if converted by this run
+    if conv_result:
+        metrics['durations']['dcm2niix'] = conv_result['elapsed']
+        metrics['dcm2niix'] = conv_result['status']
+
+    if not first_pass:
+
+        # Get subject age and sex from representative DICOM header
+        # Demographics are per subject, so all sessions share one cached probe
+        dcm_sub_dir = os.path.normpath(dcm_dir)
+        if SES:
+            dcm_sub_dir = os.path.dirname(dcm_sub_dir)
+        if demographics is None:
+            demographics = dict()
+
+        with bids_timer(metrics, 'bids_dcm_info'):
+            if dcm_sub_dir not in demographics:
+                demographics[dcm_sub_dir] = bids_dcm_info(dcm_sub_dir)
+            dcm_info = demographics[dcm_sub_dir]
+
+        if not dcm_info:
+            logger.error('* No DICOM header information found in %s' % dcm_sub_dir)
+            logger.error('* Confirm that DICOM images in this folder are uncompressed')
+            logger.error('* Exiting')
+            sys.exit(1)
+
+        # Add or update this subject's row in the participants TSV file
+        bids_participants_record(participants, SID, dcm_info['Sex'], dcm_info['Age'], manifest)
+
+    # Run dcm2niix output to BIDS source conversions
+    with bids_timer(metrics, 'bids_run_conversion'):
+        bids_run_conversion(work_conv_dir, first_pass, prot_dict, bids_src_ses_dir, SID, SES, overwrite,
+                            journal, session_key, metrics, io_threads, direct, reclaim, manifest)
+
+    if metrics_fd:
+        bids_write_metrics(metrics_fd, metrics)
+
+
+def bids_watch(dcm_root_dir, work_dir, bids_src_dir, prot_dict, participants, journal, metrics_fd,
+               no_sessions, quiet_period=300.0, poll_interval=30.0, timeout=None, retries=0, overwrite=False,
+               io_threads=1, dedup_report=None, direct=False, scratch_dir=None, scratch_budget=None,
+               reclaim=None, manifest=None, include=None, exclude=None):
+    """
+    Watch the DICOM root directory and convert each session once it stops changing
+    - Polls a cheap per-session signature (file count, total size, latest mtime)
+    - A session is converted after its signature has been stable for quiet_period seconds
+    - Sessions that change again after conversion are reconverted
+    - Runs until interrupted
+
+    :param dcm_root_dir: string
+        DICOM root directory
+    :param work_dir: string
+        Working conversion root directory
+    :param bids_src_dir: string
+        BIDS source root directory
+    :param prot_dict: dictionary
+        Protocol translation dictionary
+    :param participants: dictionary
+        Participants table from bids_init
+    :param journal: dictionary
+        Pass 2 progress journal from bids_open_journal
+    :param metrics_fd: object
+        JSON lines file descriptor for per-session metrics
+    :param no_sessions: bool
+        Do not use session sub-directories
+    :param quiet_period: float
+        Seconds a session must remain unchanged before conversion
+    :param poll_interval: float
+        Seconds between polls of the DICOM root directory
+    :param timeout: float
+        Seconds before a dcm2niix conversion attempt is killed
+    :param retries: int
+        Additional attempts for failed conversions
+    :param overwrite: bool
+        overwrite flag
+    :param io_threads: int
+        Number of concurrent file copies and sidecar writes during placement
+    :param dedup_report: string
+        If set, skip duplicate DICOM series and files before conversion and append them to this TSV report
+    :param direct: bool
+        Move images from the working directory into the BIDS source directory instead of copying
+    :param scratch_dir: string
+        If set, stage DICOM and convert each session in a temporary directory here
+    :param scratch_budget: float
+        Maximum bytes of scratch space to use
+    :param reclaim: dictionary
+        Working directory reclamation state from bids_init_reclaim
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :param include: list
+        Subject directory name patterns to include (None includes all)
+    :param exclude: list
+        Subject directory name patterns to exclude
+    :return conv_results: dictionary
+        dcm2niix results keyed by session key for all conversions run while watching
+    """
+
+    # All dcm2niix results for the final summary
+    conv_results = dict()
+
+    # Subject demographics, filled as each subject's first session is processed
+    demographics = dict()
+
+    # Per-session state : dcm_dir -> [signature, time of last change, signature at conversion]
+    sessions = dict()
+
+    # Session keys whose last conversion or placement failed
+    failed = set()
+
+    logger.info('')
+    logger.info('Watching %s for new sessions (quiet period %0.0f s, poll interval %0.0f s)' %
+                (dcm_root_dir, quiet_period, poll_interval))
+    logger.info('Press Ctrl-C to stop')
+
+    try:
+
+        while True:
+
+            for SID, dcm_sub_dir in bids_subject_dirs(dcm_root_dir, include, exclude):
+
+                for SES, dcm_dir in bids_session_dirs(dcm_sub_dir, no_sessions):
+
+                    sig = bids_session_signature(dcm_dir)
+                    now = time.time()
+
+                    if dcm_dir not in sessions:
+                        # First sighting - date the last change from the newest file
+                        sessions[dcm_dir] = [sig, min(sig[2], now), None]
+                    elif sig != sessions[dcm_dir][0]:
+                        # Still receiving files - restart the quiet period
+                        sessions[dcm_dir][0:2] = [sig, now]
+                        continue
+
+                    last_change, converted_sig = sessions[dcm_dir][1:3]
+
+                    if sig[0] > 0 and sig != converted_sig and now - last_change >= quiet_period:
+
+                        logger.info('')
+                        logger.info('------------------------------------------------------------')
+                        logger.info('Processing subject %s %s' % (SID, ('session ' + SES) if SES else ''))
+                        logger.info('------------------------------------------------------------')
+
+                        # Sessions already converted by this process have changed since
+                        session_key = bids_session_key(SID, SES)
+                        reconvert = converted_sig is not None
+                        if reconvert:
+                            bids_journal_record(journal, session_key, 'reset')
+
+                        # A failing session (eg a series missing from the translator or no readable
+                        # DICOM headers) must not stop the watch. bids_process_session exits on
+                        # unreadable headers, so SystemExit is caught here as well
+                        try:
+
+                            conv_results.update(bids_convert_sessions([(SID, SES, dcm_dir)], work_dir, False,
+                                                                      1, timeout, retries, reconvert, dedup_report,
+                                                                      scratch_dir=scratch_dir,
+                                                                      scratch_budget=scratch_budget,
+                                                                      journal=journal))
+
+                            bids_process_session(dcm_dir, SID, SES, work_dir, bids_src_dir,
+                                                 False, prot_dict, participants, journal, metrics_fd, overwrite,
+                                                 conv_results.get(session_key), demographics, io_threads, direct,
+                                                 reclaim, manifest)
+
+                            failed.discard(session_key)
+
+                        except (Exception, SystemExit) as err:
+
+                            logger.error('* %s failed : %s %s' % (session_key, type(err).__name__, err))
+                            logger.error('* Retrying once the session changes')
+                            logger.debug(traceback.format_exc())
+                            failed.add(session_key)
+
+                        metrics_fd.flush()
+
+                        # Failed sessions are also marked, so they are retried only when their files change
+                        sessions[dcm_dir][2] = sig
+
+            time.sleep(poll_interval)
+
+    except KeyboardInterrupt:
+
+        logger.info('')
+        logger.info('Stopping watch')
+
+    for session_key in sorted(failed):
+        logger.warning('* %s : last conversion or placement failed' % session_key)
+
+    return conv_results
+
+
+def bids_session_signature(dcm_dir):
+    """
+    Cheap signature of a session DICOM directory used to detect when files stop arriving
+    - Hidden files (eg partial transfers written under a dot name) are ignored
+
+    :param dcm_dir: string
+        Session DICOM directory
+    :return: (number of files, total bytes, latest modification time)
+    """
+
+    n_files, n_bytes, latest = 0, 0, 0.0
+
+    for entry in dcmio.scan_files(dcm_dir):
+        try:
+            st = entry.stat()
+        except OSError:
+            # File removed between listing and stat
+            continue
+        n_files += 1
+        n_bytes += st.st_size
+        latest = max(latest, st.st_mtime)
+
+    return n_files, n_bytes, latest
+
+
+def bids_run_conversion(conv_dir, first_pass, prot_dict, src_dir, SID, SES, overwrite=False,
+                        journal=None, session_key='', metrics=None, io_threads=1, direct=False, reclaim=None,
+                        manifest=None):
+    """
+    Run dcm2niix output to BIDS source conversions
+
+    :param conv_dir: string
+        Working conversion directory
+    :param first_pass: boolean
+        Flag for first pass conversion
+    :param prot_dict: dictionary
+        Protocol translation dictionary
+    :param src_dir: string
+        BIDS source output subj or subj/session directory
+    :param SID: string
+        subject ID
+    :param SES: string
+        session name or number
+    :param overwrite: bool
+        overwrite flag
+    :param journal: dictionary
+        Pass 2 progress journal from bids_open_journal
+    :param session_key: string
+        Session key within the journal (working directory relative to the work root)
+    :param metrics: dictionary
+        Session metrics from bids_init_metrics
+    :param io_threads: int
+        Number of concurrent file copies and sidecar writes during placement
+    :param direct: bool
+        Move images from the working directory into the BIDS source directory instead of copying
+    :param reclaim: dictionary
+        Working directory reclamation state from bids_init_reclaim
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :return:
+    """
+
+    # Completed placement steps recorded for this session by previous runs
+    done = journal['done'].get(session_key, set()) if journal else set()
+
+    if not first_pass and 'complete' in done:
+
+        logger.info('  Session placement completed by a previous run - skipping')
+
+        # Sessions placed by earlier runs (eg without --reclaim) are reclaimed here
+        if reclaim and os.path.isdir(conv_dir) and not os.path.isfile(os.path.join(conv_dir, BIDS_RECLAIM_MARKER)):
+            plan = None if reclaim['policy'] == 'lru' else bids_plan_session(conv_dir, prot_dict, src_dir, SID, SES)
+            n_bytes = bids_reclaim_session(reclaim, journal, session_key, conv_dir, plan, completed_now=False)
+            if metrics:
+                metrics['bytes_reclaimed'] = n_bytes
+
+        return
+
+    if not os.path.isdir(conv_dir):
+        return
+
+    if first_pass:
+
+        # Loop over all Nifti files (*.nii, *.nii.gz) for this subject
+        for src_nii_fname in glob(os.path.join(conv_dir, '*.nii*')):
+
+            # Parse image filename into fields
+            subj_name, ser_desc, seq_name, ser_no = parse_dcm2niix_fname(src_nii_fname)
+
+            logger.info('  Adding protocol %s to dictionary template' % ser_desc)
+
+            # Add current protocol to protocol dictionary
+            # Use default EXCLUDE_* values which can be changed (or not) by the user
+            prot_dict[ser_desc] = ["EXCLUDE_BIDS_Directory", "EXCLUDE_BIDS_Name", "UNASSIGNED"]
+
+        return
+
+    # Work out the complete source to BIDS mapping for this session before touching any files
+    with bids_timer(metrics, 'bids_purpose_handling'):
+        plan = bids_plan_session(conv_dir, prot_dict, src_dir, SID, SES)
+
+    session_ok = True
+
+    # Images still to be placed in the BIDS source directory
+    todo = []
+
+    for image in plan:
+
+        if image.status == 'missing sidecar':
+
+            logger.warning('* JSON sidecar not found : %s' % image.work_json)
+            session_ok = False
+
+        elif image.status == 'collision':
+
+            logger.error('* %s : BIDS destination %s shared with another image - not placed' %
+                         (os.path.basename(image.work_nii), os.path.basename(image.bids_nii or image.bids_json)))
+            session_ok = False
+
+        elif image.status == 'exclude':
+
+            # Skip excluded protocols
+            logger.info('* Excluding protocol ' + image.ser_desc)
+
+        elif os.path.basename(image.work_nii) in done:
+
+            # Skip images placed before an interruption
+            logger.info('  Already organized ' + image.ser_desc)
+
+        else:
+
+            logger.info('  Organizing ' + image.ser_desc)
+            todo.append(image)
+
+    with bids_timer(metrics, 'bids_place_image'):
+
+        # Create all destination directories up front so placement workers only copy and write files
+        for bids_dir in sorted(set(image.bids_dir for image in todo)):
+            safe_mkdir(bids_dir)
+
+        # Populate BIDS structure with the images and adjusted sidecars
+        # Placement is dominated by per-file metadata latency on parallel filesystems,
+        # so overlap it with a thread pool. Metrics and journal are only updated here.
+        with ThreadPoolExecutor(max_workers=max(1, io_threads)) as pool:
+
+            futures = {pool.submit(bids_place_image, image, overwrite, direct, manifest): image for image in todo}
+
+            for future in as_completed(futures):
+
+                n_bytes = future.result()
+
+                if metrics:
+                    metrics['bytes_copied'] += n_bytes
+                    metrics['files_processed'] += 1
+
+                # Record completed placement of this image
+                if journal:
+                    bids_journal_record(journal, session_key, os.path.basename(futures[future].work_nii))
+
+    # Record completed placement of the whole session
+    if journal and session_ok:
+        bids_journal_record(journal, session_key, 'complete',
+                            bids_translator_record(prot_dict, [image.ser_desc for image in plan]))
+
+    # Optional working directory reclamation once the session is fully placed
+    if reclaim and journal and session_ok:
+        n_bytes = bids_reclaim_session(reclaim, journal, session_key, conv_dir, plan)
+        if metrics:
+            metrics['bytes_reclaimed'] = n_bytes
+    else:
+        logger.info('  Preserving conversion directory')
+
+
+def bids_plan_session(conv_dir, prot_dict, src_dir, SID, SES):
+    """
+    Map every dcm2niix output in a working conversion directory to its BIDS destination
+    - Uses only the working filenames, JSON sidecars and the protocol translator
+    - No images are read, copied or written
+
+    :param conv_dir: string
+        Working conversion directory
+    :param prot_dict: dictionary
+        Protocol translation dictionary
+    :param src_dir: string
+        BIDS source output subj or subj/session directory
+    :param SID: string
+        subject ID
+    :param SES: string
+        session name or number
+    :return plan: list
+        One BidsImage per working Nifti image, with destinations filled by bids_purpose_handling
+        and status set to 'include', 'exclude', 'missing sidecar' or 'collision' (same BIDS destination
+        as another image in the session)
+    """
+
+    plan = []
+
+    if not os.path.isdir(conv_dir):
+        return plan
+
+    # glob returns the full relative path from the tmp dir
+    filelist = glob(os.path.join(conv_dir, '*.nii*'))
+
+    # Images moved into the BIDS source directory by --direct leave their sidecar behind,
+    # so include them to keep run numbering stable when an interrupted session is resumed
+    nii_stems = set(strip_extensions(f) for f in filelist)
+    filelist += [strip_extensions(f) + '.nii.gz' for f in glob(os.path.join(conv_dir, '*.json'))
+                 if strip_extensions(f) not in nii_stems]
+
+    # Parse each image once and resolve runs, echoes and magnitude/phase pairs
+    images = bids_group_series(filelist)
+
+    # Complete BIDS filenames for image and sidecar
+    if SES:
+        bids_prefix = 'sub-' + SID + '_ses-' + SES + '_'
+    else:
+        bids_prefix = 'sub-' + SID + '_'
+
+    # Loop over all Nifti files (*.nii, *.nii.gz) for this subject in series and echo order
+    for image in images:
+
+        image.subject = SID
+        image.session = SES
+        plan.append(image)
+
+        # JSON sidecar for this image
+        if not image.info:
+            image.status = 'missing sidecar'
+            continue
+
+        if prot_dict[image.ser_desc][0].startswith('EXCLUDE'):
+            image.status = 'exclude'
+            continue
+
+        # Use protocol dictionary to determine purpose folder, BIDS filename suffix and fmap linking
+        bids_purpose, bids_suffix, bids_intendedfor = prot_dict[image.ser_desc]
+
+        # Add run suffix for duplicate series descriptions
+        if image.run:
+            bids_suffix = bids_add_run_number(bids_suffix, str(image.run))
+
+        # Add echo suffix for multi-echo series (eg ME-BOLD, MEMPRAGE)
+        # GRE fieldmap echoes are named magnitude/phasediff by bids_purpose_handling instead
+        if image.n_echoes > 1 and not (bids_purpose == 'fmap' and image.seq_name == 'GR'):
+            bids_suffix = bids_add_echo_number(bids_suffix, image.echo)
+
+        # Add part suffix to magnitude and phase images of the same run (eg ME-BOLD with phase output)
+        # GRE fieldmap phase images are named phasediff by bids_purpose_handling instead
+        if image.has_phase and not (bids_purpose == 'fmap' and image.seq_name == 'GR'):
+            bids_suffix = bids_add_part(bids_suffix, 'phase' if image.image_type == 'P' else 'mag')
+
+        # Add prefix and suffix to IntendedFor values
+        # Build new values rather than editing the translator, which is shared by all sessions
+        if not 'UNASSIGNED' in bids_intendedfor:
+            if isinstance(bids_intendedfor, str):
+                # Single linked image
+                bids_intendedfor = bids_prefix + bids_intendedfor + '.nii.gz'
+            else:
+                # Loop over all linked images
+                bids_intendedfor = [ifstr if '.nii.gz' in ifstr else bids_prefix + ifstr + '.nii.gz'
+                                    for ifstr in bids_intendedfor]
+
+        # BIDS source directory and filename stem (no extension) for this image
+        image.bids_dir = os.path.join(src_dir, bids_purpose)
+        bids_stem = os.path.join(image.bids_dir, bids_prefix + bids_suffix)
+
+        # Special handling for specific purposes (anat, func, fmap, etc)
+        bids_purpose_handling(image, bids_purpose, bids_intendedfor, bids_stem)
+        image.status = 'include'
+
+    # Two images with the same destination would overwrite each other during concurrent placement,
+    # so neither is placed and the session is left incomplete until the translator is fixed
+    destinations = dict()
+    for image in plan:
+        if image.status == 'include':
+            for bids_fname in (image.bids_nii, image.bids_json):
+                if bids_fname:
+                    destinations.setdefault(bids_fname, []).append(image)
+
+    for bids_fname, images in destinations.items():
+        if len(images) > 1:
+            for image in images:
+                image.status = 'collision'
+
+    return plan
+
+
+class BidsImage:
+    """
+    Converted image record for a single dcm2niix output
+    - Filename fields and sidecar metadata are parsed once by bids_group_series
+    - Destinations are filled by bids_plan_session and bids_purpose_handling
+    - Unused destinations are empty strings
+    """
+
+    __slots__ = ('work_stem', 'work_nii', 'info', 'ser_desc', 'seq_name', 'ser_str',
+                 'ser_no', 'echo', 'image_type', 'group', 'run', 'n_echoes', 'first_echo', 'mag1_json', 'has_phase',
+                 'subject', 'session', 'status',
+                 'bids_dir', 'bids_nii', 'bids_json', 'bids_events', 'bids_bval', 'bids_bvec')
+
+    def __init__(self, work_nii):
+
+        self.work_nii = work_nii
+        self.work_stem = os.path.join(os.path.dirname(work_nii), strip_extensions(os.path.basename(work_nii)))
+
+        _, self.ser_desc, self.seq_name, self.ser_str = parse_dcm2niix_fname(work_nii)
+
+        # JSON sidecar contents (empty if missing)
+        work_json = self.work_json
+        self.info = bids_read_json(work_json) if os.path.isfile(work_json) else dict()
+
+        # Echo and image type from the dcm2niix suffix, falling back to the sidecar
+        self.ser_no, self.echo, is_phase = parse_dcm2niix_series(self.ser_str)
+        if 'EchoNumber' in self.info:
+            self.echo = int(self.info['EchoNumber'])
+        if is_phase is None:
+            is_phase = bool({'P', 'PHASE'} & set(self.info.get('ImageType', [])))
+        self.image_type = 'P' if is_phase else 'M'
+
+        self.group = None
+        self.run, self.n_echoes, self.first_echo, self.mag1_json = 0, 1, True, ''
+        self.has_phase = False
+        self.subject, self.session, self.status = '', '', ''
+        self.bids_dir, self.bids_nii, self.bids_json, self.bids_events = '', '', '', ''
+        self.bids_bval, self.bids_bvec = '', ''
+
+    @property
+    def work_json(self):
+        return self.work_stem + '.json'
+
+    @property
+    def work_bval(self):
+        return self.work_stem + '.bval'
+
+    @property
+    def work_bvec(self):
+        return self.work_stem + '.bvec'
+
+    @property
+    def key(self):
+        return self.ser_no, self.echo, self.image_type
+
+    @property
+    def echo_id(self):
+        # Sidecar echo number and time, which identify an echo independently of the dcm2niix suffix
+        # (an 'a' suffix is also used for filename conflicts such as a re-pushed series)
+        if 'EchoNumber' in self.info or 'EchoTime' in self.info:
+            return self.info.get('EchoNumber'), self.info.get('EchoTime')
+        return self.echo, None
+
+
+def bids_group_series(filelist):
+    """
+    Group dcm2niix outputs by series number, echo and image type
+    - Echoes of the same series share a run. An image is only another echo if its sidecar EchoNumber or
+      EchoTime differs from the images already in the run; a repeat (eg a re-pushed series with the same
+      series number) gets a run of its own
+    - A phase series is paired with the closest preceding magnitude series of the same description
+      and shares its run (GRE fieldmaps, ME-BOLD with phase output)
+    - Runs are numbered by acquisition order within each series description
+
+    dcm2niix suffixes handled (see parse_dcm2niix_series):
+    *--<serno>a : additional echo from older dcm2niix versions (echo from sidecar EchoNumber)
+    *--<serno>_e<N> : echo N
+    *--<serno>_ph, *--<serno>_e<N>_ph : phase image
+
+    :param filelist: list
+        Working Nifti filenames from dcm2niix
+    :return images: list
+        One BidsImage per file in (series number, echo, image type) order with 'run' (0 if the
+        description occurs once), 'n_echoes', 'first_echo', 'mag1_json' (echo 1 magnitude
+        sidecar of the magnitude/phase pair or empty) and 'has_phase' (run includes phase images) resolved
+    """
+
+    series = dict()
+
+    for nii_fname in filelist:
+
+        image = BidsImage(nii_fname)
+
+        key = image.key
+        if key in series:
+            logger.warning('* Series %d echo %d %s image found more than once' % key)
+            key = key + (image.ser_str,)
+
+        series[key] = image
+
+    images = [series[key] for key in sorted(series)]
+
+    # Single pass in acquisition order - magnitude precedes phase within a series
+    # A group is one acquisition (run) : (ser_desc, ser_no, n) where n counts repeats of a series
+    last_mag = dict()   # Latest magnitude group for each description
+    groups = dict()     # Acquisition groups (runs) for each description
+    members = dict()    # (image type, echo_id) of the images in each acquisition group
+    echoes = dict()     # Echo numbers in each acquisition group
+    mag1 = dict()       # Echo 1 magnitude sidecar for each acquisition group
+
+    for image in images:
+
+        ser_desc = image.ser_desc
+        member = (image.image_type, image.echo_id)
+
+        if image.image_type == 'P' and ser_desc in last_mag and member not in members[last_mag[ser_desc]]:
+            # Phase joins the acquisition group of its magnitude partner
+            group = last_mag[ser_desc]
+        else:
+            # An image only counts as another echo of a series if its sidecar echo number or time differs.
+            # Otherwise it is a repeat of the series (eg a re-push) and starts an acquisition group of its own
+            n = 0
+            while member in members.get((ser_desc, image.ser_no, n), set()):
+                n += 1
+            group = (ser_desc, image.ser_no, n)
+            if image.image_type == 'M':
+                last_mag[ser_desc] = group
+                echoes.setdefault(group, set()).add(image.echo)
+                if image.echo == 1:
+                    mag1[group] = image.work_json
+
+        members.setdefault(group, set()).add(member)
+
+        if group not in groups.setdefault(ser_desc, []):
+            groups[ser_desc].append(group)
+
+        image.group = group
+
+    phase_groups = set(image.group for image in images if image.image_type == 'P')
+
+    for image in images:
+        group, desc_groups = image.group, groups[image.ser_desc]
+        group_echoes = echoes.get(group, {image.echo})
+        image.run = desc_groups.index(group) + 1 if len(desc_groups) > 1 else 0
+        image.n_echoes = len(group_echoes)
+        image.first_echo = image.echo == min(group_echoes)
+        image.mag1_json = mag1.get(group, '')
+        image.has_phase = group in phase_groups
+
+    return images
+
+
+def bids_purpose_handling(image, bids_purpose, bids_intendedfor, bids_stem):
+    """
+    Special handling for each image purpose (func, anat, fmap, dwi, etc)
+    - Determines the BIDS destinations and adjusted sidecar without copying anything
+    - Fills bids_nii, bids_json, bids_events, bids_bval and bids_bvec of the image record,
+      leaving destinations that aren't required empty, and adjusts the sidecar in image.info
+
+    :param image: BidsImage
+        Image record from bids_group_series
+    :param bids_purpose: str
+    :param bids_intendedfor: str
+    :param bids_stem: str
+        BIDS source filename without extension
+    :return:
+    """
+
+    info = image.info
+    seq_name = image.seq_name
+
+    # Default image and sidecar destinations
+    bids_nii_fname = bids_stem + '.nii.gz'
+    bids_json_fname = bids_stem + '.json'
+
+    if bids_purpose == 'func':
+
+        if seq_name == 'EP':
+
+            logger.debug('    EPI detected')
+
+            # One events template per run, shared by all echoes and by magnitude and phase images
+            if image.first_echo and image.image_type == 'M' and bids_stem.endswith('_bold'):
+                run_stem = re.sub(r'_(echo-[0-9]+|part-[a-z]+)', '', bids_stem[:-len('_bold')])
+                image.bids_events = run_stem + '_events.tsv'
+
+            # Add taskname to BIDS JSON sidecar
+            bids_keys = parse_bids_fname(bids_nii_fname)
+            if 'task' in bids_keys:
+                info['TaskName'] = bids_keys['task']
+            else:
+                info['TaskName'] = 'unknown'
+
+    elif bids_purpose == 'fmap':
+
+        # Add IntendedFor field if requested through protocol translator
+        if not 'UNASSIGNED' in bids_intendedfor:
+            info['IntendedFor'] = bids_intendedfor
+
+        # Check for MEGE vs SE-EPI fieldmap images
+        # MEGE will have a 'GR' sequence, SE-EPI will have 'EP'
+
+        logger.debug('    Identifying fieldmap image type')
+        if seq_name == 'GR':
+
+            logger.debug('    GRE detected')
+            logger.debug('    Identifying magnitude and phase images')
+
+            # 2017-06-26 JMT Adapt to changes in dcm2niix JSON sidecar
+            # For Siemens dual gradient echo fieldmaps, three Nifti/JSON pairs are generated from two series
+            # *--GR--<serno>.<ext> : magnitude image from echo 1 (EchoNumber unset, ImageType[2] = "M")
+            # *--GR--<serno>a.<ext> : magnitude image from echo 2 (EchoNumber = 2, ImageType[2] = "M")
+            # *--GR--<serno+1>.<ext> : inter-echo phase difference (EchoNumber = 2, ImageType[2] = "P")
+            # Newer dcm2niix versions use _e2 and _ph suffixes instead - bids_group_series handles both
+
+            if image.image_type == 'P':
+
+                # Read phase meta data
+                bids_nii_fname = bids_stem + '_phasediff.nii.gz'
+                bids_json_fname = bids_stem + '_phasediff.json'
+
+                # Extract TE1 and TE2 from paired mag and phase JSON sidecars
+                TE1, TE2 = bids_fmap_echotimes(image.work_json, image.mag1_json)
+                info['EchoTime1'] = TE1
+                info['EchoTime2'] = TE2
+
+            elif image.first_echo:
+
+                logger.debug('    Echo 1 magnitude')
+                bids_nii_fname = bids_stem + '_magnitude.nii.gz'
+                bids_json_fname = ''  # Discard sidecar only
+
+            else:
+
+                # Echo 2 magnitude - discard
+                logger.debug('    Echo 2 magnitude - discarding')
+                bids_nii_fname = ''  # Discard image
+                bids_json_fname = ''  # Discard sidecar
+
+        elif seq_name == 'EP':
+
+            logger.debug('    EPI detected')
+
+        else:
+
+            logger.debug('    Unrecognized fieldmap detected')
+            logger.debug('    Simply copying image and sidecar to fmap directory')
+
+    elif bids_purpose == 'anat':
+
+        if seq_name == 'GR_IR':
+
+            logger.debug('    IR-prepared GRE detected - likely T1w MP-RAGE or equivalent')
+
+        elif seq_name == 'SE':
+
+            logger.debug('    Spin echo detected - likely T1w or T2w anatomic image')
+
+        elif seq_name == 'GR':
+
+            logger.debug('    Gradient echo detected')
+
+    elif bids_purpose == 'dwi':
+
+        # Fill DWI bval and bvec source filenames
+        # Non-empty filenames trigger the copy during placement
+        image.bids_bval = bids_stem + '.bval'
+        image.bids_bvec = bids_stem + '.bvec'
+
+    image.bids_nii = bids_nii_fname
+    image.bids_json = bids_json_fname
+
+
+def bids_write_plan(plan_fname, plan):
+    """
+    Write a conversion plan as JSON or, for a .tsv filename, as a tab-separated table
+
+    :param plan_fname: string
+        Output filename
+    :param plan: list
+        BidsImage records from bids_plan_session
+    :return:
+    """
+
+    columns = ['subject', 'session', 'status', 'ser_desc', 'ser_no', 'work_nii',
+               'bids_nii', 'bids_json', 'bids_events', 'bids_bval', 'bids_bvec', 'IntendedFor']
+
+    # Flatten records - the ser_no column is the dcm2niix series field including any echo suffix
+    rows = []
+    for image in plan:
+        row = dict((col, getattr(image, col)) for col in columns[:-1])
+        row['ser_no'] = image.ser_str
+        row['IntendedFor'] = image.info.get('IntendedFor', '')
+        rows.append(row)
+
+    with open(plan_fname, 'w') as fd:
+
+        if plan_fname.endswith('.tsv'):
+
+            fd.write('\t'.join(columns) + '\n')
+            for row in rows:
+                intendedfor = row['IntendedFor']
+                if not isinstance(intendedfor, str):
+                    row['IntendedFor'] = ','.join(intendedfor)
+                fd.write('\t'.join(str(row[col]) for col in columns) + '\n')
+
+        else:
+
+            json.dump(rows, fd, indent=4, separators=(',', ':'))
+
+
+def bids_place_image(image, overwrite=False, direct=False, manifest=None):
+    """
+    Populate BIDS source directory with a planned Nifti image, JSON and DWI sidecars
+    - The BIDS purpose directory must already exist
+    - Safe to run concurrently for different images
+
+    :param image: BidsImage
+        Planned image record from bids_plan_session
+    :param overwrite: bool
+    :param direct: bool
+        Move the image and DWI sidecars from the working directory instead of copying them.
+        The working JSON sidecar is kept for planning
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest, updated with the digests of copied and written files
+    :return n_bytes: int
+        Number of bytes copied into the BIDS source directory
+    """
+
+    logger.debug('  Populating BIDS source directory')
+
+    # Image data is renamed rather than copied in direct mode
+    transfer = safe_move if direct else safe_copy
+
+    # Image data already moved or reclaimed by a previous run - only sidecars are rewritten
+    in_work = os.path.isfile(image.work_nii)
+
+    # Nothing left to check if the image was moved by an interrupted previous run
+    if not in_work:
+
+        # Sidecar without an image that was never placed (eg a failed dcm2niix conversion)
+        if image.bids_nii and not os.path.isfile(image.bids_nii):
+            logger.warning('* %s : no converted image - skipping' % os.path.basename(image.work_json))
+            return 0
+
+        problems = []
+
+    # Cheap header-only consistency checks for DWI and BOLD series
+    elif image.bids_bval:
+        problems = bids_validate_dwi(image.work_nii, image.work_bval, image.work_bvec)
+    elif image.bids_nii and image.bids_nii.endswith('_bold.nii.gz'):
+        problems = bids_validate_bold(image.work_nii)
+    else:
+        problems = []
+
+    for problem in problems:
+        logger.warning('* %s : %s' % (os.path.basename(image.work_nii), problem))
+
+    n_bytes = 0
+
+    if image.bids_events:
+        bids_events_template(image.bids_events, overwrite, manifest)
+
+    if image.bids_nii and in_work:
+        n_bytes += transfer(image.work_nii, image.bids_nii, overwrite, manifest)
+
+    if image.bids_json:
+        bids_write_json(image.bids_json, image.info, overwrite, manifest)
+
+    if image.bids_bval and in_work:
+        n_bytes += transfer(image.work_bval, image.bids_bval, overwrite, manifest)
+
+    if image.bids_bvec and in_work:
+        n_bytes += transfer(image.work_bvec, image.bids_bvec, overwrite, manifest)
+
+    return n_bytes
+
+
+def bids_nifti_dims(nii_fname):
+    """
+    Read the dim field from a Nifti-1 or Nifti-2 header without loading voxel data
+    - Only the header is read (decompressed on the fly for .nii.gz)
+    - Nifti-1 : 348 byte header, int16 dim at offset 40
+    - Nifti-2 : 540 byte header, int64 dim at offset 16 (written by dcm2niix for very large series)
+
+    :param nii_fname: str
+        Nifti-1 or Nifti-2 image filename (.nii or .nii.gz)
+    :return dim: list
+        Nifti dim array [ndim, nx, ny, nz, nt, ...] or empty list if unreadable
+    """
+
+    opener = gzip.open if nii_fname.endswith('.gz') else open
+
+    try:
+        with opener(nii_fname, 'rb') as fd:
+            hdr = fd.read(540)
+    except (OSError, EOFError):
+        return []
+
+    if len(hdr) < 348:
+        return []
+
+    # sizeof_hdr is 348 (Nifti-1) or 540 (Nifti-2) - use it to determine version and byte order
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', hdr[0:4])[0]
+        if sizeof_hdr == 348:
+            return list(struct.unpack(endian + '8h', hdr[40:56]))
+        if sizeof_hdr == 540 and len(hdr) == 540:
+            return list(struct.unpack(endian + '8q', hdr[16:80]))
+
+    return []
+
+
+def bids_read_gradients(bval_fname, bvec_fname):
+    """
+    Parse FSL-style bval and bvec gradient tables
+
+    :param bval_fname: str
+    :param bvec_fname: str
+    :return bvals, bvecs: list, list
+        b-values and bvec rows (x, y and z component lists)
+    """
+
+    with open(bval_fname, 'r') as fd:
+        bvals = [float(v) for v in fd.read().split()]
+
+    with open(bvec_fname, 'r') as fd:
+        bvecs = [[float(v) for v in line.split()] for line in fd if line.strip()]
+
+    return bvals, bvecs
+
+
+def bids_validate_dwi(nii_fname, bval_fname, bvec_fname, tol=0.01):
+    """
+    Check DWI gradient tables against the image volume count
+    - bval and bvec lengths must match the 4th image dimension
+    - bvecs must have three rows and unit length for non-zero b-values
+
+    :param nii_fname: str
+    :param bval_fname: str
+    :param bvec_fname: str
+    :param tol: float
+        Allowed deviation of gradient direction length from 1
+    :return problems: list
+        Description of each problem found (empty if consistent)
+    """
+
+    dim = bids_nifti_dims(nii_fname)
+    if not dim:
+        return ['could not read Nifti-1 or Nifti-2 header - consistency checks skipped']
+
+    n_vols = dim[4] if dim[0] >= 4 else 1
+
+    try:
+        bvals, bvecs = bids_read_gradients(bval_fname, bvec_fname)
+    except (OSError, ValueError) as err:
+        return ['could not read gradient tables (%s)' % err]
+
+    problems = []
+
+    if len(bvals) != n_vols:
+        problems.append('%d b-values for %d volumes' % (len(bvals), n_vols))
+
+    if len(bvecs) != 3:
+        problems.append('bvec has %d rows (expected 3)' % len(bvecs))
+    elif any(len(row) != n_vols for row in bvecs):
+        problems.append('bvec lengths %s for %d volumes' % ([len(row) for row in bvecs], n_vols))
+    else:
+        n_bad = 0
+        for bval, x, y, z in zip(bvals, *bvecs):
+            if bval > 0 and abs((x * x + y * y + z * z) ** 0.5 - 1.0) > tol:
+                n_bad += 1
+        if n_bad:
+            problems.append('%d diffusion-weighted directions are not unit vectors' % n_bad)
+
+    return problems
+
+
+def bids_validate_bold(nii_fname):
+    """
+    Check that a BOLD image is a 4D timeseries
+
+    :param nii_fname: str
+    :return problems: list
+        Description of each problem found (empty if consistent)
+    """
+
+    dim = bids_nifti_dims(nii_fname)
+    if not dim:
+        return ['could not read Nifti-1 or Nifti-2 header - consistency checks skipped']
+
+    if dim[0] < 4 or dim[4] < 2:
+        return ['BOLD image has a single volume (dim %s)' % dim[:5]]
+
+    return []
+
+
+def bids_init(bids_src_dir, overwrite=False):
+    """
+    Initialize BIDS source directory
+
+    :param bids_src_dir: string
+        BIDS source directory
+    :param overwrite: string
+        Overwrite flag
+    :return participants: dictionary
+        Participants table from bids_open_participants
+    """
+
+    # Participants TSV file in BIDS root directory, keeping rows from previous runs
+    participants = bids_open_participants(os.path.join(bids_src_dir, 'participants.tsv'), overwrite)
+
+    # Create template JSON dataset description
+    datadesc_json = os.path.join(bids_src_dir, 'dataset_description.json')
+    meta_dict = dict({'BIDSVersion': "1.0.0",
+               'License': "This data is made available under the Creative Commons BY-SA 4.0 International License.",
+               'Name': "The dataset name goes here",
+               'ReferencesAndLinks': "References and links for this dataset go here"})
+
+    # Write JSON file
+    bids_write_json(datadesc_json, meta_dict, overwrite)
+
+    return participants
+
+
+def bids_open_participants(parts_tsv, overwrite=False):
+    """
+    Load the participants table, one row per subject
+    - Rows from previous runs are kept, so restarting (eg in watch mode) never loses subjects
+    - Columns added by hand after participant_id, sex and age are preserved
+    - The table is written immediately so that it exists before any session is processed
+
+    :param parts_tsv: string
+        participants.tsv filename
+    :param overwrite: bool
+        Start a new table instead of loading the existing one
+    :return participants: dictionary
+        'fname' : participants.tsv filename
+        'header' : list of column names
+        'rows' : dictionary of column value lists keyed by participant_id, in file order
+    """
+
+    header = ['participant_id', 'sex', 'age']
+    rows = OrderedDict()
+
+    if os.path.isfile(parts_tsv) and not overwrite:
+        with open(parts_tsv, 'r') as fd:
+            lines = [line.rstrip('\n').split('\t') for line in fd if line.strip()]
+        if lines and lines[0][0] == 'participant_id':
+            header = lines.pop(0)
+        for fields in lines:
+            rows[fields[0]] = fields[1:]
+
+    participants = {'fname': parts_tsv, 'header': header, 'rows': rows}
+    bids_write_participants(participants)
+
+    return participants
+
+
+def bids_participants_record(participants, SID, sex, age, manifest=None):
+    """
+    Add or update a subject's row in the participants table and rewrite participants.tsv
+    - Sessions of the same subject and reconverted sessions update the existing row
+
+    :param participants: dictionary
+        Participants table from bids_open_participants
+    :param SID: string
+        Subject ID
+    :param sex: string
+    :param age: string
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :return:
+    """
+
+    row = participants['rows'].setdefault('sub-' + SID, [])
+    row[0:2] = [str(sex), str(age)]
+
+    bids_write_participants(participants, manifest)
+
+
+def bids_write_participants(participants, manifest=None):
+    """
+    Write participants.tsv from the participants table
+    - Written under a temporary name and renamed into place, and only if the contents changed
+
+    :param participants: dictionary
+        Participants table from bids_open_participants
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :return:
+    """
+
+    n_cols = len(participants['header'])
+
+    lines = ['\t'.join(participants['header'])]
+    for participant_id, fields in participants['rows'].items():
+        fields = (fields + [''] * n_cols)[:n_cols - 1]
+        lines.append('\t'.join([participant_id] + fields))
+
+    safe_write_text(participants['fname'], '\n'.join(lines) + '\n', overwrite=True, manifest=manifest)
+
+
+def bids_open_journal(journal_fname, overwrite=False):
+    """
+    Open the Pass 2 progress journal, loading steps completed by previous runs
+    - One JSON object per line : {"session": <work subdir>, "step": <completed step>}
+    - Steps are the working Nifti basename for each placed image, 'complete' once a whole
+      session has been placed and 'reset' when a session's working conversion is discarded
+    - 'complete' steps also record the session's protocols and a hash of their translator entries
+      (see bids_check_journal_translator)
+    - The journal is restarted when overwriting so every output is regenerated
+
+    :param journal_fname: string
+        Journal filename (JSON lines)
+    :param overwrite: bool
+        Overwrite flag
+    :return journal: dictionary
+        'fd' : open journal file descriptor
+        'done' : dictionary of completed step sets keyed by session
+        'translator' : translator records of completed sessions keyed by session
+    """
+
+    done = dict()
+    translator = dict()
+
+    if os.path.isfile(journal_fname) and not overwrite:
+
+        logger.info('  Resuming from progress journal %s' % journal_fname)
+
+        with open(journal_fname, 'r') as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Ignore a final line truncated by an interruption
+                    continue
+                if entry['step'] == 'reset':
+                    done.pop(entry['session'], None)
+                    translator.pop(entry['session'], None)
+                else:
+                    done.setdefault(entry['session'], set()).add(entry['step'])
+                if 'translator' in entry:
+                    translator[entry['session']] = entry['translator']
+
+        fd = open(journal_fname, 'a')
+
+    else:
+
+        fd = open(journal_fname, 'w')
+
+    return {'fd': fd, 'done': done, 'translator': translator}
+
+
+def bids_journal_record(journal, session_key, step, translator=None):
+    """
+    Append a completed step to the Pass 2 progress journal
+    - Flushed to disk immediately so that the record survives node preemption
+
+    :param journal: dictionary
+        Progress journal from bids_open_journal
+    :param session_key: string
+        Session key (working directory relative to the work root)
+    :param step: string
+        Completed step
+    :param translator: dictionary
+        Translator record from bids_translator_record, stored with the step
+    :return:
+    """
+
+    entry = {'session': session_key, 'step': step}
+
+    if step == 'reset':
+        journal['done'].pop(session_key, None)
+        journal['translator'].pop(session_key, None)
+    else:
+        journal['done'].setdefault(session_key, set()).add(step)
+
+    if translator:
+        journal['translator'][session_key] = translator
+        entry['translator'] = translator
+
+    journal['fd'].write(json.dumps(entry) + '\n')
+    journal['fd'].flush()
+    os.fsync(journal['fd'].fileno())
+
+
+def bids_translator_record(prot_dict, protocols):
+    """
+    Protocols placed for a session and a hash of their protocol translator entries
+
+    :param prot_dict: dictionary
+        Protocol translation dictionary
+    :param protocols: iterable
+        Series descriptions (ser_desc) of every image in the session, including excluded ones
+    :return translator: dictionary
+        'protocols' : sorted list of series descriptions
+        'hash' : SHA-1 of the translator entries for those protocols (None for missing entries)
+    """
+
+    protocols = sorted(set(protocols))
+    entries = json.dumps([[ser_desc, prot_dict.get(ser_desc)] for ser_desc in protocols])
+
+    return {'protocols': protocols, 'hash': hashlib.sha1(entries.encode()).hexdigest()}
+
+
+def bids_check_journal_translator(journal, prot_dict):
+    """
+    Reopen completed sessions whose protocol translator entries have changed since placement
+    - Without this, a translator edit (eg including a previously excluded series) would be ignored
+      for every session the journal already records as complete
+    - Changed sessions are reset in the journal and placed again. Existing BIDS files are kept
+      unless --overwrite is used, so a renamed series leaves its old file behind
+
+    :param journal: dictionary
+        Progress journal from bids_open_journal
+    :param prot_dict: dictionary
+        Protocol translation dictionary
+    :return:
+    """
+
+    for session_key, translator in sorted(journal['translator'].items()):
+
+        if 'complete' not in journal['done'].get(session_key, set()):
+            continue
+
+        if bids_translator_record(prot_dict, translator['protocols'])['hash'] != translator['hash']:
+            logger.warning('* Protocol translator entries for %s changed since placement - placing again' %
+                           session_key)
+            bids_journal_record(journal, session_key, 'reset')
+
+
+def bids_init_reclaim(policy, work_dir, work_cap=None):
+    """
+    Initialize working directory reclamation
+    - 'verified' : delete all of a session's working files once every placed file has been verified
+    - 'sidecars' : delete verified image data (Nifti, bval, bvec) but keep JSON sidecars and excluded images
+    - 'lru' : keep working files until the working tree exceeds the cap, then delete placed image data
+      from the least recently completed sessions
+    - Reclaimed working directories keep a marker file so they are reconverted only if needed
+
+    :param policy: string
+        'none', 'verified', 'sidecars' or 'lru'
+    :param work_dir: string
+        Working conversion root directory
+    :param work_cap: float
+        Working directory size cap in GB (lru only)
+    :return reclaim: dictionary
+        None if nothing is reclaimed, otherwise
+        'policy' : reclamation policy
+        'cap' : working directory size cap in bytes
+        'work_dir' : working conversion root directory
+        'sizes' : bytes of working files by session key (lru only, filled on first use)
+        'lru' : completed, unreclaimed session keys, least recently completed first (lru only)
+    """
+
+    if policy == 'none':
+        return None
+
+    return {'policy': policy,
+            'cap': work_cap * 1e9 if work_cap else None,
+            'work_dir': work_dir,
+            'sizes': None,
+            'lru': OrderedDict()}
+
+
+def bids_reclaim_session(reclaim, journal, session_key, conv_dir, plan, completed_now=True):
+    """
+    Reclaim working directory space after a session has been completely placed
+    - Also applied to sessions completed by a previous run, so rerunning with --reclaim frees them
+
+    :param reclaim: dictionary
+        Working directory reclamation state from bids_init_reclaim
+    :param journal: dictionary
+        Pass 2 progress journal from bids_open_journal
+    :param session_key: string
+        Session key (working directory relative to the work root)
+    :param conv_dir: string
+        Working conversion directory
+    :param plan: list
+        BidsImage records from bids_plan_session (not used by the lru policy)
+    :param completed_now: bool
+        The session was placed by this run rather than a previous one
+    :return n_bytes: int
+        Bytes deleted from the working tree
+    """
+
+    if reclaim['policy'] == 'lru':
+        return bids_reclaim_lru(reclaim, journal, session_key, conv_dir, completed_now)
+
+    # Only reclaim once every placed file is present in the BIDS source directory
+    placed = [image for image in plan if image.status == 'include']
+    unverified = [image for image in placed if not bids_verify_placement(image)]
+
+    for image in unverified:
+        logger.warning('* %s : placement not verified - preserving conversion directory' %
+                       os.path.basename(image.work_nii))
+
+    if unverified:
+        return 0
+
+    if reclaim['policy'] == 'verified':
+        n_bytes = bids_reclaim_dir(conv_dir)
+    else:
+        n_bytes = bids_reclaim_dir(conv_dir, set(os.path.basename(image.work_nii) for image in placed))
+
+    logger.info('  Reclaimed %0.1f MB from conversion directory' % (n_bytes / 1e6))
+
+    return n_bytes
+
+
+def bids_reclaim_lru(reclaim, journal, session_key, conv_dir, completed_now=True):
+    """
+    Enforce the working directory size cap by deleting placed image data from the
+    least recently completed sessions
+    - Placed images are taken from the journal, so sessions completed by previous runs are included
+    - The working tree is walked once on first use, then only completed sessions are re-measured
+
+    :param reclaim: dictionary
+        Working directory reclamation state from bids_init_reclaim
+    :param journal: dictionary
+        Pass 2 progress journal from bids_open_journal
+    :param session_key: string
+        Session key of the session just completed
+    :param conv_dir: string
+        Working conversion directory of the session just completed
+    :param completed_now: bool
+        The session was placed by this run. Sessions completed by previous runs keep their journal order
+    :return n_bytes: int
+        Bytes deleted from the working tree
+    """
+
+    work_dir = reclaim['work_dir']
 
-    if os.path.isdir(conv_dir):
+    if reclaim['sizes'] is None:
 
-        # glob returns the full relative path from the tmp dir
-        filelist = glob(os.path.join(conv_dir, '*.nii*'))
-        
-        # Determine where we have runs with the same description (name)
-        # TODO: Might be able to use sets instead of lists for uniqueness check
-        run_suffix = [0] * len(filelist)
-        for file_index in range(len(filelist)-1):
-            src_nii_fname = filelist[file_index]
-            subj_name, ser_desc, seq_name, ser_no = parse_dcm2niix_fname(src_nii_fname)
-            matches = [i for i in range(len(filelist)) if ser_desc in filelist[i]]
-            if len(matches) > 1:
-            for i in range(len(matches)):
-                    run_suffix[matches[i]] = i + 1  # Yes, this will re-create this little list several times and no, that's not ideal                for i in matches:
+        # Bytes of working files by session key from a single walk of the working tree
+        reclaim['sizes'] = dict()
+        for subdir, dirs, files in os.walk(work_dir):
+            key = os.path.relpath(subdir, work_dir)
+            reclaim['sizes'][key] = sum(os.path.getsize(os.path.join(subdir, f)) for f in files)
 
-        # Loop over all Nifti files (*.nii, *.nii.gz) for this subject
-        file_index = 0
-        for src_nii_fname in filelist:
+        # Sessions completed by previous runs and not yet reclaimed, in journal order
+        for key, steps in journal['done'].items():
+            if 'complete' in steps and not os.path.isfile(os.path.join(work_dir, key, BIDS_RECLAIM_MARKER)):
+                reclaim['lru'][key] = True
 
-            # Parse image filename into fields
-            subj_name, ser_desc, seq_name, ser_no = parse_dcm2niix_fname(src_nii_fname)
+    reclaim['sizes'][session_key] = bids_tree_size(conv_dir)
+    if completed_now:
+        reclaim['lru'][session_key] = True
+        reclaim['lru'].move_to_end(session_key)
 
-            # Check if we're creating new protocol dictionary
-            if first_pass:
+    n_bytes = 0
 
-                print('  Adding protocol %s to dictionary template' % ser_desc)
+    while reclaim['lru'] and sum(reclaim['sizes'].values()) > reclaim['cap']:
 
-                # Add current protocol to protocol dictionary
-                # Use default EXCLUDE_* values which can be changed (or not) by the user
-                prot_dict[ser_desc] = ["EXCLUDE_BIDS_Directory", "EXCLUDE_BIDS_Name", "UNASSIGNED"]
+        key, _ = reclaim['lru'].popitem(last=False)
+        key_dir = os.path.join(work_dir, key)
 
-            else:
+        if not os.path.isdir(key_dir):
+            continue
 
-                # Replace Nifti extension ('.nii.gz' or '.nii') with '.json'
-                if '.nii.gz' in src_nii_fname:
-                    src_json_fname = src_nii_fname.replace('.nii.gz', '.json')
-                elif 'nii' in src_nii_fname:
-                    src_json_fname = src_nii_fname.replace('.nii', '.json')
+        placed = set(step for step in journal['done'].get(key, set()) if '.nii' in step)
+        freed = bids_reclaim_dir(key_dir, placed)
 
-                # JSON sidecar for this image
-                if not os.path.isfile(src_json_fname):
-                    print('* JSON sidecar not found : %s' % src_json_fname)
-                    break
+        logger.info('  Reclaimed %0.1f MB from %s' % (freed / 1e6, key))
 
-                if prot_dict[ser_desc][0].startswith('EXCLUDE'):
+        reclaim['sizes'][key] = bids_tree_size(key_dir)
+        n_bytes += freed
 
-                    # Skip excluded protocols
-                    print('* Excluding protocol ' + str(ser_desc))
+    if sum(reclaim['sizes'].values()) > reclaim['cap']:
+        logger.warning('* Working directory exceeds %0.1f GB with nothing left to reclaim' % (reclaim['cap'] / 1e9))
 
-                else:
+    return n_bytes
 
-                    print('  Organizing ' + str(ser_desc))
-
-                    # Use protocol dictionary to determine purpose folder, BIDS filename suffix and fmap linking
-                    bids_purpose, bids_suffix, bids_intendedfor = prot_dict[ser_desc]
-
-                    # Add run suffix for duplicate series descriptions
-                    if run_suffix[file_index]:
-                        bids_suffix = bids_add_run_number(bids_suffix, str(run_suffix[file_index]))
-
-                    # Create BIDS purpose directory
-                    bids_purpose_dir = os.path.join(src_dir, bids_purpose)
-                    safe_mkdir(bids_purpose_dir)
-
-                    # Complete BIDS filenames for image and sidecar
-                    if SES:
-                        bids_prefix = 'sub-' + SID + '_ses-' + SES + '_'
-                    else:
-                        bids_prefix = 'sub-' + SID + '_'
-
-                    # Construct BIDS source Nifti and JSON filenames
-                    bids_nii_fname = os.path.join(bids_purpose_dir, bids_prefix + bids_suffix + '.nii.gz')
-                    bids_json_fname = bids_nii_fname.replace('.nii.gz','.json')
-
-                    # Add prefix and suffix to IntendedFor values
-                    if not 'UNASSIGNED' in bids_intendedfor:
-                        if isinstance(bids_intendedfor, str):
-                            # Single linked image
-                            bids_intendedfor = bids_prefix + bids_intendedfor + '.nii.gz'
-                        else:
-                            # Loop over all linked images
-                            for ifc, ifstr in enumerate(bids_intendedfor):
-                                # Avoid multiple substitutions
-                                if not '.nii.gz' in ifstr:
-                                    bids_intendedfor[ifc] = bids_prefix + ifstr + '.nii.gz'
-
-                    # Special handling for specific purposes (anat, func, fmap, etc)
-                    # This function populates BIDS structure with the image and adjusted sidecar
-                    bids_purpose_handling(bids_purpose, bids_intendedfor, seq_name,
-                                          src_nii_fname, src_json_fname,
-                                          bids_nii_fname, bids_json_fname,
-                                          overwrite)
-            file_index += 1
 
-        if not first_pass:
+def bids_verify_placement(image):
+    """
+    Check that a planned image and its DWI sidecars are present in the BIDS source directory
+    - Sizes are compared with any working copies that remain (moved files are only checked for presence)
 
-            # Optional working directory cleanup after Pass 2
-            if do_cleanup:
-                print('  Cleaning up temporary files')
-                shutil.rmtree(conv_dir)
-            else:
-                print('  Preserving conversion directory')
+    :param image: BidsImage
+        Planned image record from bids_plan_session
+    :return: bool
+    """
+
+    for work_fname, bids_fname in ((image.work_nii, image.bids_nii),
+                                   (image.work_bval, image.bids_bval),
+                                   (image.work_bvec, image.bids_bvec)):
+
+        if not bids_fname:
+            continue
+
+        if not os.path.isfile(bids_fname):
+            return False
 
+        if os.path.isfile(work_fname) and os.path.getsize(work_fname) != os.path.getsize(bids_fname):
+            return False
 
-def bids_purpose_handling(bids_purpose, bids_intendedfor, seq_name,
-                          work_nii_fname, work_json_fname, bids_nii_fname, bids_json_fname,
-                          overwrite=False):
+    return True
+
+
+def bids_reclaim_dir(conv_dir, placed=None):
     """
-    Special handling for each image purpose (func, anat, fmap, dwi, etc)
+    Delete intermediate files from a working conversion directory and leave a reclamation marker
 
-    :param bids_purpose: str
-    :param bids_intendedfor: str
-    :param seq_name: str
-    :param work_nii_fname: str
-    :param work_json_fname: str
-    :param bids_nii_fname: str
-    :param bids_json_fname: str
-    :param overwrite: bool
-    :return:
+    :param conv_dir: string
+        Working conversion directory
+    :param placed: set
+        Working Nifti basenames whose image data (Nifti, bval, bvec) should be deleted.
+        JSON sidecars are kept. None deletes every file
+    :return n_bytes: int
+        Bytes deleted
     """
 
-    # Init DWI sidecars
-    work_bval_fname = []
-    work_bvec_fname = []
-    bids_bval_fname = []
-    bids_bvec_fname = []
+    placed_stems = None if placed is None else set(strip_extensions(fname) for fname in placed)
 
-    # Load the JSON sidecar
-    info = bids_read_json(work_json_fname)
+    n_bytes = 0
 
-    if bids_purpose == 'func':
+    with os.scandir(conv_dir) as it:
 
-        if seq_name == 'EP':
+        for entry in it:
 
-            print('    EPI detected')
-            bids_events_template(bids_nii_fname, overwrite)
+            if not entry.is_file() or entry.name == BIDS_RECLAIM_MARKER:
+                continue
 
-            # Add taskname to BIDS JSON sidecar
-            bids_keys = parse_bids_fname(bids_nii_fname)
-            if 'task' in bids_keys:
-                info['TaskName'] = bids_keys['task']
-            else:
-                info['TaskName'] = 'unknown'
+            if placed_stems is not None and (entry.name.endswith('.json') or
+                                             strip_extensions(entry.name) not in placed_stems):
+                continue
 
-    elif bids_purpose == 'fmap':
+            n_bytes += entry.stat().st_size
+            os.remove(entry.path)
 
-        # Add IntendedFor field if requested through protocol translator
-        if not 'UNASSIGNED' in bids_intendedfor:
-            info['IntendedFor'] = bids_intendedfor
+    with open(os.path.join(conv_dir, BIDS_RECLAIM_MARKER), 'w') as fd:
+        fd.write(json.dumps({'reclaimed': datetime.now().isoformat(),
+                             'sidecars': placed is not None}) + '\n')
 
-        # Check for MEGE vs SE-EPI fieldmap images
-        # MEGE will have a 'GR' sequence, SE-EPI will have 'EP'
+    return n_bytes
 
-        print('    Identifying fieldmap image type')
-        if seq_name == 'GR':
 
-            print('    GRE detected')
-            print('    Identifying magnitude and phase images')
+def bids_open_manifest(manifest_fname, bids_src_dir):
+    """
+    Open the checksum manifest of the BIDS source directory
+    - TSV with one row per file : path (relative to the BIDS source directory), size, md5, sha256,
+      mtime_ns and inode. The last two identify unchanged files so they are not re-read
+    - Rows from a previous run are loaded as a digest cache keyed on (size, mtime_ns, inode)
+    - Digests of copied and written files are added during placement from the same read pass
+
+    :param manifest_fname: string
+        Manifest filename (TSV)
+    :param bids_src_dir: string
+        BIDS source directory
+    :return manifest: dictionary
+        'fname' : manifest filename
+        'root' : BIDS source directory
+        'entries' : (size, mtime_ns, inode, md5, sha256) tuples keyed by relative path
+        'cache' : (md5, sha256) tuples keyed by (size, mtime_ns, inode) from the previous manifest
+        'lock' : lock for updates from placement threads
+    """
 
-            # 2017-06-26 JMT Adapt to changes in dcm2niix JSON sidecar
-            # For Siemens dual gradient echo fieldmaps, three Nifti/JSON pairs are generated from two series
-            # *--GR--<serno>.<ext> : magnitude image from echo 1 (EchoNumber unset, ImageType[2] = "M")
-            # *--GR--<serno>a.<ext> : magnitude image from echo 2 (EchoNumber = 2, ImageType[2] = "M")
-            # *--GR--<serno+1>.<ext> : inter-echo phase difference (EchoNumber = 2, ImageType[2] = "P")
+    cache = dict()
 
-            if 'EchoNumber' in info:
+    if os.path.isfile(manifest_fname):
+        with open(manifest_fname, 'r') as fd:
+            next(fd, None)
+            for line in fd:
+                try:
+                    path, size, md5, sha256, mtime_ns, inode = line.rstrip('\n').split('\t')
+                    cache[(int(size), int(mtime_ns), int(inode))] = (md5, sha256)
+                except ValueError:
+                    continue
 
-                if info['EchoNumber'] == 2:
+    return {'fname': manifest_fname,
+            'root': bids_src_dir,
+            'entries': dict(),
+            'cache': cache,
+            'lock': threading.Lock()}
 
-                    if 'P' in info['ImageType'][2]:
 
-                        # Read phase meta data
-                        bids_nii_fname = bids_nii_fname.replace('.nii.gz', '_phasediff.nii.gz')
-                        bids_json_fname = bids_json_fname.replace('.json', '_phasediff.json')
+def bids_manifest_record(manifest, fname, md5, sha256):
+    """
+    Record the digests of a file just placed in the BIDS source directory
 
-                        # Extract TE1 and TE2 from mag and phase JSON sidecars
-                        TE1, TE2 = bids_fmap_echotimes(work_json_fname)
-                        info['EchoTime1'] = TE1
-                        info['EchoTime2'] = TE2
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :param fname: string
+        Placed filename
+    :param md5: string
+    :param sha256: string
+    :return:
+    """
 
-                    else:
+    st = os.stat(fname)
+    path = os.path.relpath(fname, manifest['root'])
 
-                        # Echo 2 magnitude - discard
-                        print('    Echo 2 magnitude - discarding')
-                        bids_nii_fname = []  # Discard image
-                        bids_json_fname = []  # Discard sidecar
+    with manifest['lock']:
+        manifest['entries'][path] = (st.st_size, st.st_mtime_ns, st.st_ino, md5, sha256)
 
-            else:
 
-                print('    Echo 1 magnitude')
-                bids_nii_fname = bids_nii_fname.replace('.nii.gz', '_magnitude.nii.gz')
-                bids_json_fname = []  # Discard sidecar only
+def bids_close_manifest(manifest, max_workers=None):
+    """
+    Complete and write the checksum manifest
+    - Every file in the BIDS source directory is listed (hidden files excluded)
+    - Digests come from placement or the previous manifest when size, mtime and inode are unchanged.
+      Only the remaining files (eg moved images, participants.tsv or files edited by hand) are read
+
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :param max_workers: int
+        Maximum number of hashing threads
+    :return:
+    """
 
-        elif seq_name == 'EP':
+    root = manifest['root']
 
-            print('    EPI detected')
+    # Digest cache from placement and the previous manifest
+    known = dict(manifest['cache'])
+    for size, mtime_ns, inode, md5, sha256 in manifest['entries'].values():
+        known[(size, mtime_ns, inode)] = (md5, sha256)
 
-        else:
+    rows = dict()
+    to_hash = []
 
-            print('    Unrecognized fieldmap detected')
-            print('    Simply copying image and sidecar to fmap directory')
+    for subdir, dirs, files in os.walk(root):
 
-    elif bids_purpose == 'anat':
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
 
-        if seq_name == 'GR_IR':
+        for fname in files:
 
-            print('    IR-prepared GRE detected - likely T1w MP-RAGE or equivalent')
+            if fname.startswith('.'):
+                continue
 
-        elif seq_name == 'SE':
+            full_fname = os.path.join(subdir, fname)
+            st = os.stat(full_fname)
+            key = (st.st_size, st.st_mtime_ns, st.st_ino)
+            path = os.path.relpath(full_fname, root)
 
-            print('    Spin echo detected - likely T1w or T2w anatomic image')
+            if key in known:
+                rows[path] = key + known[key]
+            else:
+                to_hash.append((path, full_fname, key))
 
-        elif seq_name == 'GR':
+    with ThreadPoolExecutor(max_workers=max(1, max_workers or 1)) as pool:
+        for (path, full_fname, key), digests in zip(to_hash, pool.map(file_digest, [f for _, f, _ in to_hash])):
+            rows[path] = key + digests
 
-            print('    Gradient echo detected')
+    lines = ['path\tsize\tmd5\tsha256\tmtime_ns\tinode']
+    for path in sorted(rows):
+        size, mtime_ns, inode, md5, sha256 = rows[path]
+        lines.append('%s\t%d\t%s\t%s\t%d\t%d' % (path, size, md5, sha256, mtime_ns, inode))
 
-    elif bids_purpose == 'dwi':
+    safe_write_text(manifest['fname'], '\n'.join(lines) + '\n', overwrite=True)
 
-        # Fill DWI bval and bvec working and source filenames
-        # Non-empty filenames trigger the copy below
-        work_bval_fname = str(work_json_fname.replace('.json', '.bval'))
-        bids_bval_fname = str(bids_json_fname.replace('.json', '.bval'))
-        work_bvec_fname = str(work_json_fname.replace('.json', '.bvec'))
-        bids_bvec_fname = str(bids_json_fname.replace('.json', '.bvec'))
+    logger.info('Checksum manifest : %d files, %d hashed after placement - see %s' %
+                (len(rows), len(to_hash), manifest['fname']))
 
-    # Populate BIDS source directory with Nifti images, JSON and DWI sidecars
-    print('  Populating BIDS source directory')
 
-    if bids_nii_fname:
-        safe_copy(work_nii_fname, str(bids_nii_fname), overwrite)
+def bids_init_metrics(SID, SES, first_pass):
+    """
+    Initialize timing and throughput metrics for one session
 
-    if bids_json_fname:
-        bids_write_json(bids_json_fname, info)
+    :param SID: string
+        subject ID
+    :param SES: string
+        session name or empty string
+    :param first_pass: boolean
+        Flag for first pass conversion
+    :return metrics: dictionary
+    """
 
-    if bids_bval_fname:
-        safe_copy(work_bval_fname, bids_bval_fname, overwrite)
+    return {'version': __version__,
+            'subject': SID,
+            'session': SES,
+            'pass': 1 if first_pass else 2,
+            'start': datetime.now().isoformat(),
+            'durations': dict(),
+            'bytes_copied': 0,
+            'bytes_reclaimed': 0,
+            'files_processed': 0,
+            '_t0': time.perf_counter()}
 
-    if bids_bvec_fname:
-        safe_copy(work_bvec_fname, bids_bvec_fname, overwrite)
 
+@contextmanager
+def bids_timer(metrics, phase):
+    """
+    Accumulate wall time spent in a processing phase into session metrics
 
-def bids_init(bids_src_dir, overwrite=False):
+    :param metrics: dictionary
+        Session metrics from bids_init_metrics (timing is skipped if None)
+    :param phase: string
+        Phase name (eg 'dcm2niix', 'bids_run_conversion')
+    :return:
     """
-    Initialize BIDS source directory
 
-    :param bids_src_dir: string
-        BIDS source directory
-    :param overwrite: string
-        Overwrite flag
-    :return participants_fd: object
-        participant TSV file descriptor
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            durations = metrics['durations']
+            durations[phase] = durations.get(phase, 0.0) + time.perf_counter() - t0
+
+
+def bids_write_metrics(metrics_fd, metrics):
     """
+    Append session metrics as a single JSON line
 
-    # Create template participant TSV file in BIDS root directory
-    parts_tsv = os.path.join(bids_src_dir, 'participants.tsv')
-    participants_fd = open(parts_tsv, 'w')
-    participants_fd.write('participant_id\tsex\tage\n')
+    :param metrics_fd: object
+        JSON lines file descriptor
+    :param metrics: dictionary
+        Session metrics from bids_init_metrics
+    :return:
+    """
 
-    # Create template JSON dataset description
-    datadesc_json = os.path.join(bids_src_dir, 'dataset_description.json')
-    meta_dict = dict({'BIDSVersion': "1.0.0",
-               'License': "This data is made available under the Creative Commons BY-SA 4.0 International License.",
-               'Name': "The dataset name goes here",
-               'ReferencesAndLinks': "References and links for this dataset go here"})
+    record = dict((k, v) for k, v in metrics.items() if not k.startswith('_'))
+    record['durations']['total'] = time.perf_counter() - metrics['_t0']
 
-    # Write JSON file
-    bids_write_json(datadesc_json, meta_dict, overwrite)
+    metrics_fd.write(json.dumps(record) + '\n')
 
-    return participants_fd
+    logger.info('  Session completed in %0.1f s (%d files, %0.1f MB copied)' %
+                (record['durations']['total'], record['files_processed'], record['bytes_copied'] / 1e6))
 
 
-def bids_dcm_info(dcm_dir):
+def bids_demographics(subject_dirs, max_workers=None):
     """
-    Extract relevant subject information from DICOM header
-    - Assumes only one subject present within dcm_dir
-    
-    :param dcm_dir: directory containing all DICOM files or DICOM subfolders
-    :return dcm_info: DICOM header information dictionary
+    Probe participant demographics for many subjects in parallel
+    - One representative DICOM header is read per subject
+    - Header reads are I/O bound, so a thread pool overlaps the file system latency
+
+    :param subject_dirs: list
+        (SID, subject DICOM directory) tuples from bids_subject_dirs
+    :param max_workers: int
+        Maximum number of probe threads (None uses the ThreadPoolExecutor default)
+    :return demographics: dictionary
+        DICOM header information from bids_dcm_info keyed by normalized subject DICOM directory
     """
 
-    # Init the DICOM structure
-    ds = []
+    dcm_sub_dirs = [os.path.normpath(dcm_sub_dir) for _, dcm_sub_dir in subject_dirs]
 
-    # Init the subject info dictionary
-    dcm_info = dict()
+    t0 = time.perf_counter()
 
-    # Walk through dcm_dir looking for valid DICOM files
-    for subdir, dirs, files in os.walk(dcm_dir):
-        for file in files:
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        demographics = dict(zip(dcm_sub_dirs, pool.map(bids_dcm_info, dcm_sub_dirs)))
 
-            try:
-                ds = dicom.read_file(os.path.join(subdir, file))
-            except:
-                pass
+    logger.debug('Demographics for %d subjects probed in %0.1f s' % (len(dcm_sub_dirs), time.perf_counter() - t0))
 
-            # Break out if valid DICOM read
-            if ds:
-                break
+    return demographics
 
-    if ds:
 
-        # Fill dictionary
-        # Note that DICOM anonymization tools sometimes clear these fields
-        if hasattr(ds, 'PatientSex'):
-            dcm_info['Sex'] = ds.PatientSex
-        else:
-            dcm_info['Sex'] = 'Unknown'
+def bids_dcm_info(dcm_dir):
+    """
+    Extract relevant subject information from DICOM header
+    - Assumes only one subject present within dcm_dir
+    - Only files with a DICOM preamble are parsed and pixel data is never read
 
-        if hasattr(ds, 'PatientAge'):
-            dcm_info['Age'] = ds.PatientAge
-        else:
-            dcm_info['Age'] = 0
+    :param dcm_dir: directory containing all DICOM files or DICOM subfolders
+    :return dcm_info: DICOM header information dictionary or None if no DICOM file was found
+    """
 
-    else:
+    # Representative header from the first valid DICOM file
+    hdr = dcmio.first_header(dcm_dir, tags=['PatientSex', 'PatientAge'])
 
-        print('* No DICOM header information found in %s' % dcm_dir)
-        print('* Confirm that DICOM images in this folder are uncompressed')
-        print('* Exiting')
-        sys.exit(1)
+    if hdr is None:
+        return None
 
-    return dcm_info
+    # Fill dictionary
+    # Note that DICOM anonymization tools sometimes clear these fields
+    return {'Sex': hdr.get('PatientSex', 'Unknown'),
+            'Age': hdr.get('PatientAge', 0)}
 
 
 def parse_dcm2niix_fname(fname):
@@ -612,6 +2635,42 @@ def parse_dcm2niix_fname(fname):
     return subj_name, ser_desc, seq_name, ser_no
 
 
+def parse_dcm2niix_series(ser_str):
+    """
+    Parse the dcm2niix series field into series number, echo and image type
+    - '8' : series 8
+    - '8a' : series 8, additional echo (older dcm2niix)
+    - '5_e2' : series 5, echo 2
+    - '9_ph', '9_e2_ph' : series 9, phase image
+    :param ser_str: str
+        Series field from parse_dcm2niix_fname
+    :return ser_no: int
+            echo: int
+                Echo number (1 unless given by the suffix)
+            is_phase: bool
+                True for a _ph suffix, None if the suffix doesn't say
+    """
+
+    m = re.match(r'([0-9]+)([a-z]?)((?:_[a-zA-Z]+[0-9]*)*)$', ser_str)
+
+    if not m:
+        return 0, 1, None
+
+    ser_no = int(m.group(1))
+
+    # Older dcm2niix versions append a letter for each additional echo
+    echo = ord(m.group(2)) - ord('a') + 2 if m.group(2) else 1
+    is_phase = None
+
+    for tag in m.group(3).split('_')[1:]:
+        if tag.startswith('e') and tag[1:].isdigit():
+            echo = int(tag[1:])
+        elif tag == 'ph':
+            is_phase = True
+
+    return ser_no, echo, is_phase
+
+
 def parse_bids_fname(fname):
     """
     Parse BIDS filename into key-value pairs
@@ -664,6 +2723,47 @@ def bids_add_run_number(bids_stub, ser_no):
     return new_bids_stub
 
 
+def bids_add_echo_number(bids_stub, echo):
+    """
+    Add echo number to BIDS filename
+
+    :param bids_stub:
+    :param echo: int
+    :return:
+    """
+
+    if '_' in bids_stub:
+        # Add '_echo-x' before final suffix
+        bmain, bseq = bids_stub.rsplit('_',1)
+        new_bids_stub = '%s_echo-%d_%s' % (bmain, echo, bseq)
+    else:
+        # Isolated final suffix - just add 'echo-x_' as a prefix
+        new_bids_stub = 'echo-%d_%s' % (echo, bids_stub)
+
+    return new_bids_stub
+
+
+def bids_add_part(bids_stub, part):
+    """
+    Add magnitude or phase part entity to BIDS filename
+
+    :param bids_stub:
+    :param part: str
+        'mag' or 'phase'
+    :return:
+    """
+
+    if '_' in bids_stub:
+        # Add '_part-x' before final suffix
+        bmain, bseq = bids_stub.rsplit('_',1)
+        new_bids_stub = '%s_part-%s_%s' % (bmain, part, bseq)
+    else:
+        # Isolated final suffix - just add 'part-x_' as a prefix
+        new_bids_stub = 'part-%s_%s' % (part, bids_stub)
+
+    return new_bids_stub
+
+
 def bids_catch_duplicate(fname):
     """
     Add numeric suffix if filename already exists
@@ -687,35 +2787,23 @@ def bids_catch_duplicate(fname):
     return new_fname
 
 
-def bids_events_template(bold_fname, overwrite=False):
+def bids_events_template(events_fname, overwrite=False, manifest=None):
     """
     Create a template events file for a corresponding BOLD imaging file
-    :param bold_fname: str
-        BOLD imaging filename (.nii.gz)
+    :param events_fname: str
+        Events filename (.tsv) from bids_purpose_handling
     :param overwrite: bool
         Overwrite flag
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
     :return: Nothing
     """
 
-    events_fname = bold_fname.replace('_bold.nii.gz', '_events.tsv')
-
-    if os.path.isfile(events_fname):
-        if overwrite:
-            print('  Overwriting previous %s' % events_fname)
-            create_file = True
-        else:
-            print('  Preserving previous %s' % events_fname)
-            create_file = False
-    else:
-        print('  Creating %s' % events_fname)
-        create_file = True
+    events_text = ('onset\tduration\ttrial_type\tresponse_time\n'
+                   '1.0\t0.5\tgo\t0.555\n'
+                   '2.5\t0.4\tstop\t0.666\n')
 
-    if create_file:
-        fd = open(events_fname, 'w')
-        fd.write('onset\tduration\ttrial_type\tresponse_time\n')
-        fd.write('1.0\t0.5\tgo\t0.555\n')
-        fd.write('2.5\t0.4\tstop\t0.666\n')
-        fd.close()
+    safe_write_text(events_fname, events_text, overwrite, manifest)
 
 
 def strip_extensions(fname):
@@ -754,11 +2842,13 @@ def bids_load_prot_dict(prot_dict_json):
     return prot_dict
 
 
-def bids_fmap_echotimes(src_phase_json_fname):
+def bids_fmap_echotimes(src_phase_json_fname, src_mag1_json_fname):
     """
     Extract TE1 and TE2 from mag and phase MEGE fieldmap pairs
 
     :param src_phase_json_fname: str
+    :param src_mag1_json_fname: str
+        Echo 1 magnitude sidecar paired with the phase image by bids_group_series
     :return:
     """
 
@@ -770,33 +2860,122 @@ def bids_fmap_echotimes(src_phase_json_fname):
         # Read phase image metadata
         phase_dict = bids_read_json(src_phase_json_fname)
 
-        # Parse dcm2niix filename into fields
-        subj_name, prot_name, seq_name, ser_no = parse_dcm2niix_fname(src_phase_json_fname)
-
-        # Magnitude 1 series number is one less than phasediff series number
-        mag1_ser_no = str(int(ser_no) - 1)
-
-        # Construct dcm2niix mag1 JSON filename
-        src_mag1_json_fname = subj_name + '--' + prot_name + '--' + seq_name + '--' + mag1_ser_no + '.json'
-        src_mag1_json_path = os.path.join(os.path.dirname(src_phase_json_fname), src_mag1_json_fname)
-
         # Read mag1 metadata
-        mag1_dict = bids_read_json(src_mag1_json_path)
+        if src_mag1_json_fname and os.path.isfile(src_mag1_json_fname):
+            mag1_dict = bids_read_json(src_mag1_json_fname)
+        else:
+            mag1_dict = dict()
 
         # Add TE1 key and rename TE2 key
         if mag1_dict:
             TE1 = mag1_dict['EchoTime']
             TE2 = phase_dict['EchoTime']
         else:
-            print('*** Could not determine echo times multiecho fieldmap - using 0.0 ')
+            logger.warning('*** Could not determine echo times multiecho fieldmap - using 0.0 ')
 
     else:
 
-        print('* Fieldmap phase difference sidecar not found : ' + src_phase_json_fname)
+        logger.warning('* Fieldmap phase difference sidecar not found : ' + src_phase_json_fname)
 
     return TE1, TE2
 
 
+def bids_discover_protocols(sessions):
+    """
+    Find all protocols in a set of sessions from DICOM headers alone
+    - Every DICOM file header is read (without pixel data) and grouped by SeriesInstanceUID
+    - Series descriptions are sanitized as dcm2niix does for its output filenames, so the keys match
+      the ser_desc values parsed from the Pass 2 conversions
+
+    :param sessions: list
+        (SID, SES, session DICOM directory) tuples
+    :return protocols: dictionary
+        Protocol information keyed by ser_desc, in order of discovery, with keys 'sequence', 'image_type',
+        'dimensions', 'n_series' and 'subjects' (list of subject IDs)
+    """
+
+    protocols = dict()
+
+    for SID, SES, dcm_dir in sessions:
+
+        logger.info('  Scanning DICOM headers in %s' % dcm_dir)
+
+        fnames = list(dcmio.dicom_files(dcm_dir))
+        hdrs = dcmio.read_headers(fnames, BIDS_DISCOVERY_TAGS)
+
+        # One representative header per series
+        series = dict()
+        for hdr in hdrs:
+            if hdr is not None:
+                series.setdefault(hdr.get('SeriesInstanceUID', ''), hdr)
+
+        for hdr in sorted(series.values(), key=lambda h: h.get('SeriesNumber', 0)):
+
+            ser_desc = bids_sanitize_desc(hdr.get('SeriesDescription') or hdr.get('ProtocolName', ''))
+
+            if ser_desc not in protocols:
+                protocols[ser_desc] = {'sequence': '_'.join(bids_listify(hdr.get('ScanningSequence', ''))),
+                                       'image_type': '\\'.join(bids_listify(hdr.get('ImageType', ''))),
+                                       'dimensions': '%sx%s' % (hdr.get('Columns', 0), hdr.get('Rows', 0)),
+                                       'n_series': 0, 'subjects': []}
+
+            protocols[ser_desc]['n_series'] += 1
+            if SID not in protocols[ser_desc]['subjects']:
+                protocols[ser_desc]['subjects'].append(SID)
+
+    return protocols
+
+
+def bids_write_discovery(discovery_fname, protocols, n_examples=3):
+    """
+    Write discovered protocols with counts and example subjects to a TSV file
+
+    :param discovery_fname: string
+        Output TSV filename
+    :param protocols: dictionary
+        Protocol information from bids_discover_protocols
+    :param n_examples: int
+        Number of example subject IDs listed per protocol
+    :return:
+    """
+
+    columns = ['ser_desc', 'sequence', 'image_type', 'dimensions', 'n_series', 'n_subjects', 'example_subjects']
+
+    with open(discovery_fname, 'w') as fd:
+
+        fd.write('\t'.join(columns) + '\n')
+
+        for ser_desc, p in protocols.items():
+            fd.write('\t'.join([ser_desc, p['sequence'], p['image_type'], p['dimensions'],
+                                str(p['n_series']), str(len(p['subjects'])),
+                                ','.join(p['subjects'][:n_examples])]) + '\n')
+
+
+def bids_sanitize_desc(desc):
+    """
+    Series description as it appears in dcm2niix output filenames (%d)
+    - Characters that are unsafe in filenames and whitespace are replaced with underscores
+
+    :param desc: str
+    :return: str
+    """
+
+    return re.sub(r'[<>:"/\\|?*^\s]', '_', desc.strip())
+
+
+def bids_listify(value):
+    """
+    Wrap single DICOM values in a list so single and multi-valued elements can be handled alike
+    :param value:
+    :return: list of str
+    """
+
+    if isinstance(value, list):
+        return [str(v) for v in value]
+
+    return [str(value)] if value != '' else []
+
+
 def bids_create_prot_dict(prot_dict_json, prot_dict):
     """
     Write protocol translation dictionary template to JSON file
@@ -809,8 +2988,8 @@ def bids_create_prot_dict(prot_dict_json, prot_dict):
 
     if os.path.isfile(prot_dict_json):
 
-        print('* Protocol dictionary already exists : ' + prot_dict_json)
-        print('* Skipping creation of new dictionary')
+        logger.warning('* Protocol dictionary already exists : ' + prot_dict_json)
+        logger.warning('* Skipping creation of new dictionary')
 
     else:
 
@@ -818,13 +2997,13 @@ def bids_create_prot_dict(prot_dict_json, prot_dict):
         json.dump(prot_dict, json_fd, indent=4, separators=(',', ':'))
         json_fd.close()
 
-        print('')
-        print('---')
-        print('New protocol dictionary created : %s' % prot_dict_json)
-        print('Remember to replace "EXCLUDE" values in dictionary with an appropriate image description')
-        print('For example "MP-RAGE T1w 3D structural" or "MB-EPI BOLD resting-state')
-        print('---')
-        print('')
+        logger.info('')
+        logger.info('---')
+        logger.info('New protocol dictionary created : %s' % prot_dict_json)
+        logger.info('Remember to replace "EXCLUDE" values in dictionary with an appropriate image description')
+        logger.info('For example "MP-RAGE T1w 3D structural" or "MB-EPI BOLD resting-state')
+        logger.info('---')
+        logger.info('')
 
     return
 
@@ -842,13 +3021,13 @@ def bids_read_json(fname):
         json_dict = json.load(fd)
         fd.close()
     except:
-        print('*** JSON sidecar not found - returning empty dictionary')
+        logger.warning('*** JSON sidecar not found - returning empty dictionary')
         json_dict = dict()
 
     return json_dict
 
 
-def bids_write_json(fname, meta_dict, overwrite=False):
+def bids_write_json(fname, meta_dict, overwrite=False, manifest=None):
     """
     Write a dictionary to a JSON file. Account for overwrite flag
     :param fname: string
@@ -857,23 +3036,59 @@ def bids_write_json(fname, meta_dict, overwrite=False):
         Dictionary
     :param overwrite: bool
         Overwrite flag
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
     :return:
     """
 
+    safe_write_text(fname, json.dumps(meta_dict, indent=4, separators=(',', ':')), overwrite, manifest)
+
+
+def safe_write_text(fname, text, overwrite=False, manifest=None):
+    """
+    Write text to a file accounting for overwrite flag
+    - The new contents are compared with any existing file (size first, then bytes) and the
+      file is only replaced if they differ, so unchanged files keep their modification time
+    - Writes to a temporary name and renames into place
+    - Digests of written files are recorded in the checksum manifest, if any
+    :param fname: string
+    :param text: string
+    :param overwrite: bool
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :return: bool
+        True if the file was written
+    """
+
+    data = text.encode('utf-8')
+
     if os.path.isfile(fname):
-        if overwrite:
-            print('    Overwriting previous %s' % os.path.basename(fname))
-            create_file = True
-        else:
-            print('    Preserving previous %s' % fname)
-            create_file = False
+
+        if not overwrite:
+            logger.debug('    Preserving previous %s' % os.path.basename(fname))
+            return False
+
+        if os.path.getsize(fname) == len(data):
+            with open(fname, 'rb') as fd:
+                if fd.read() == data:
+                    logger.debug('    Unchanged %s' % os.path.basename(fname))
+                    return False
+
+        logger.debug('    Overwriting previous %s' % os.path.basename(fname))
+
     else:
-        print('    Creating new %s' % os.path.basename(fname))
-        create_file = True
 
-    if create_file:
-        with open(fname, 'w') as fd:
-            json.dump(meta_dict, fd, indent=4, separators=(',', ':'))
+        logger.debug('    Creating new %s' % os.path.basename(fname))
+
+    tmp_fname = safe_tmp_fname(fname)
+    with open(tmp_fname, 'wb') as fd:
+        fd.write(data)
+    os.replace(tmp_fname, fname)
+
+    if manifest:
+        bids_manifest_record(manifest, fname, hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest())
+
+    return True
 
 
 def safe_mkdir(dname):
@@ -887,28 +3102,139 @@ def safe_mkdir(dname):
         os.makedirs(dname, exist_ok=True)
 
 
-def safe_copy(file1, file2, overwrite=False):
+def safe_tmp_fname(fname):
+    """
+    Hidden temporary filename alongside fname
+    - Outputs are written to this name then renamed into place, so an interrupted
+      write never leaves a truncated file under the final name
+    :param fname: string
+    :return: string
+    """
+
+    fpath, fbase = os.path.split(fname)
+    return os.path.join(fpath, '.' + fbase + '.tmp')
+
+
+def safe_copy(file1, file2, overwrite=False, manifest=None):
     """
     Copy file accounting for overwrite flag
+    - Copies to a temporary name and renames into place
+    - With a checksum manifest, digests are computed from the same read pass as the copy
     :param file1: str
     :param file2: str
     :param overwrite: bool
-    :return:
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest
+    :return n_bytes: int
+        Number of bytes copied (0 if an existing file was preserved)
     """
 
     if os.path.isfile(file2):
         if overwrite:
-            print('    Overwriting previous %s' % os.path.basename(file2))
+            logger.debug('    Overwriting previous %s' % os.path.basename(file2))
             create_file = True
         else:
-            print('    Preserving previous %s' % os.path.basename(file2))
+            logger.debug('    Preserving previous %s' % os.path.basename(file2))
             create_file = False
     else:
-        print('    Copying %s to %s' % (os.path.basename(file1), os.path.basename(file2)))
+        logger.debug('    Copying %s to %s' % (os.path.basename(file1), os.path.basename(file2)))
         create_file = True
 
     if create_file:
-        shutil.copy(file1, file2)
+        tmp_fname = safe_tmp_fname(file2)
+        if manifest:
+            md5, sha256 = copy_digest(file1, tmp_fname)
+            shutil.copymode(file1, tmp_fname)
+            os.replace(tmp_fname, file2)
+            bids_manifest_record(manifest, file2, md5, sha256)
+        else:
+            shutil.copy(file1, tmp_fname)
+            os.replace(tmp_fname, file2)
+        return os.path.getsize(file2)
+
+    return 0
+
+
+def safe_move(file1, file2, overwrite=False, manifest=None):
+    """
+    Move file accounting for overwrite flag
+    - A rename within the same filesystem, so no data is rewritten
+    - Falls back to copying to a temporary name when the destination is on another filesystem
+    - A missing file1 with an existing file2 is treated as already moved
+    - Renamed files are hashed when the checksum manifest is closed
+    :param file1: str
+    :param file2: str
+    :param overwrite: bool
+    :param manifest: dictionary
+        Checksum manifest from bids_open_manifest (only used by the cross-filesystem copy)
+    :return n_bytes: int
+        Number of bytes copied (0 for a rename or if an existing file was preserved)
+    """
+
+    if not os.path.isfile(file1) and os.path.isfile(file2):
+        logger.debug('    %s already moved' % os.path.basename(file2))
+        return 0
+
+    if os.path.isfile(file2) and not overwrite:
+        logger.debug('    Preserving previous %s' % os.path.basename(file2))
+        return 0
+
+    logger.debug('    Moving %s to %s' % (os.path.basename(file1), os.path.basename(file2)))
+
+    try:
+        os.replace(file1, file2)
+        return 0
+    except OSError:
+        # Cross-device - copy then remove
+        n_bytes = safe_copy(file1, file2, overwrite=True, manifest=manifest)
+        os.remove(file1)
+        return n_bytes
+
+
+def copy_digest(file1, file2, chunk_size=1 << 20):
+    """
+    Copy a file while computing its MD5 and SHA-256 digests in the same pass
+
+    :param file1: str
+        Source filename
+    :param file2: str
+        Destination filename
+    :param chunk_size: int
+        Read size in bytes
+    :return md5, sha256: str, str
+        Hex digests
+    """
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+
+    with open(file1, 'rb') as fd1, open(file2, 'wb') as fd2:
+        for chunk in iter(lambda: fd1.read(chunk_size), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+            fd2.write(chunk)
+
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def file_digest(fname, chunk_size=1 << 20):
+    """
+    MD5 and SHA-256 digests of a file from a single read pass
+
+    :param fname: str
+    :param chunk_size: int
+        Read size in bytes
+    :return md5, sha256: str, str
+        Hex digests
+    """
+
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+
+    with open(fname, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(chunk_size), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+
+    return md5.hexdigest(), sha256.hexdigest()
 
 
 # This is the standard boilerplate that calls the main() function.
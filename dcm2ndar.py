@@ -47,13 +47,19 @@ import os
 import sys
 import argparse
 import subprocess
-import pydicom
 import json
 import glob
 import shutil
-import nibabel as nib
+import hashlib
+import zipfile
+import dcmconv
+import dcmio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from dateutil import relativedelta
+
+# DICOM header elements used by ndar_dcm_info
+NDAR_DCM_TAGS = ['PatientBirthDate', 'AcquisitionDate', 'StudyDate', 'PatientSex', 'PatientPosition',
+                 'TransmitCoilName', 'SoftwareVersions', 'PhotometricInterpretation']
 
 
 def main():
@@ -62,6 +68,19 @@ def main():
     parser = argparse.ArgumentParser(description='Convert DICOM files to NDAR-compliant fileset')
     parser.add_argument('-i', '--indir', required=True, help='Source directory containing subject DICOM directories')
     parser.add_argument('-o', '--outdir', required=False, help='Output directory for subject NDAR directories')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of concurrent dcm2niix conversions [1]')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Seconds before a dcm2niix conversion is killed [no limit]')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Retries for a failed or timed out dcm2niix conversion [0]')
+    parser.add_argument('--batch', action='store_true', default=False,
+                        help='Convert subjects through dcm2niibatch, one process per concurrent job')
+    parser.add_argument('--package', action='store_true', default=False,
+                        help='Write a zip archive per subject and a checksum manifest for NDAR upload')
+    parser.add_argument('--include', action='append', default=None,
+                        help='Only convert subject directories matching this pattern (repeatable)')
+    parser.add_argument('--exclude', action='append', default=None,
+                        help='Skip subject directories matching this pattern (repeatable)')
 
     # Parse command line arguments
     args = parser.parse_args()
@@ -90,115 +109,272 @@ def main():
         shutil.rmtree(ndar_root_dir)
     os.makedirs(ndar_root_dir)
 
-    # Loop over each subject's DICOM directory within the root source directory
-    for SID in os.listdir(dcm_root_dir):
-
-        dcm_sub_dir = os.path.join(dcm_root_dir, SID)
+    # Subject DICOM directories within the root source directory
+    # Hidden directories (eg the dcmpacs.py staging directory) are skipped
+    SIDs = [SID for SID, _ in dcmio.scan_dirs(dcm_root_dir, args.include, args.exclude)]
+
+    # Run dcm2niix conversion from DICOM to Nifti with BIDS sidecars for metadata
+    # This relies on the current CBIC branch of dcm2niix which extracts additional DICOM fields
+    # required by NDAR
+    # All subjects are converted concurrently before the NDAR summaries are generated
+    jobs = []
+    items = []
+    for SID in SIDs:
+
+        # Create subject directory
+        print('Creating NDAR subject directory for ' + SID)
+        ndar_sub_dir = os.path.join(ndar_root_dir, SID)
+        subprocess.call(['mkdir', '-p', ndar_sub_dir])
+
+        if args.batch:
+            items.append(dcmconv.dcm2niibatch_item(SID, os.path.join(dcm_root_dir, SID), ndar_sub_dir, 'sub-%n_%p'))
+        else:
+            jobs.append(dcmconv.dcm2niix_job(SID,
+                                             ['dcm2niix', '-b', 'y', '-f', 'sub-%n_%p', '-o', ndar_sub_dir,
+                                              os.path.join(dcm_root_dir, SID)],
+                                             os.path.join(ndar_root_dir, 'logs', SID + '_dcm2niix.log'),
+                                             ndar_sub_dir))
+
+    print('Converting %d subjects' % len(SIDs))
+    if args.batch:
+        # Equivalent of dcm2niix -b y (uncompressed Nifti)
+        conv_results = dcmconv.run_dcm2niibatch(items, {'isGz': False, 'isCreateBIDS': True},
+                                                os.path.join(ndar_root_dir, 'logs'),
+                                                args.jobs, args.timeout, args.retries)
+    else:
+        conv_results = dcmconv.run_dcm2niix_jobs(jobs, args.jobs, args.timeout, args.retries)
 
-        # Only process subdirectories
-        if os.path.isdir(dcm_sub_dir):
+    # Cohort demographics for all converted subjects, cached in the DICOM root directory
+    demographics = ndar_demographics(dcm_root_dir,
+                                     [SID for SID, r in zip(SIDs, conv_results) if r['status'] == 'ok'])
 
-            print('Processing subject ' + SID)
+    # Loop over each subject's DICOM directory within the root source directory
+    for SID, conv_result in zip(SIDs, conv_results):
 
-            # Create subject directory
-            print('  Creating NDAR subject directory')
-            ndar_sub_dir = os.path.join(ndar_root_dir, SID)
-            subprocess.call(['mkdir', '-p', ndar_sub_dir])
+        ndar_sub_dir = os.path.join(ndar_root_dir, SID)
 
-            # Create NDAR summary CSV for this subject
-            ndar_csv_fname = os.path.join(ndar_sub_dir, SID + '_NDAR.csv')
-            ndar_csv_fd = ndar_init_summary(ndar_csv_fname)
+        if conv_result['status'] != 'ok':
+            print('* dcm2niix %s for subject %s - skipping' % (conv_result['status'], SID))
+            continue
 
-            # Read additional subject-level DICOM header fields from first DICOM image
-            dcm_info = ndar_dcm_info(dcm_sub_dir)
+        print('Processing subject ' + SID)
 
-            # Run dcm2niix conversion from DICOM to Nifti with BIDS sidecars for metadata
-            # This relies on the current CBIC branch of dcm2niix which extracts additional DICOM fields
-            # required by NDAR
-            subprocess.call(['dcm2niix', '-b', 'y', '-f', 'sub-%n_%p', '-o', ndar_sub_dir, dcm_sub_dir])
+        # Create NDAR summary CSV for this subject
+        ndar_csv_fname = os.path.join(ndar_sub_dir, SID + '_NDAR.csv')
+        ndar_csv_fd = ndar_init_summary(ndar_csv_fname)
 
-            # Loop over all Nifti files (*.nii, *.nii.gz) for this SID
-            # glob returns the full relative path from the NDAR root dir
-            for nii_fname_full in glob.glob(os.path.join(ndar_sub_dir, '*.nii*')):
+        # Additional subject-level DICOM header fields and age at scan
+        dcm_info = demographics[SID]
 
-                # Read Nifti header for image FOV, extent (ie matrix) and voxel dimensions
-                print('  Reading Nifti header')
-                nii_info = ndar_nifti_info(nii_fname_full)
+        # Loop over all Nifti files (*.nii, *.nii.gz) for this SID
+        # glob returns the full relative path from the NDAR root dir
+        for nii_fname_full in glob.glob(os.path.join(ndar_sub_dir, '*.nii*')):
 
-                # Isolate base filename
-                nii_fname = os.path.basename(nii_fname_full)
+            # Isolate base filename
+            nii_fname = os.path.basename(nii_fname_full)
 
-                # Parse file basename
-                SID, prot, fstub = ndar_parse_filename(nii_fname)
+            # Parse file basename
+            SID, prot, fstub = ndar_parse_filename(nii_fname)
 
-                # Full path for file stub
-                fstub_full = os.path.join(ndar_sub_dir, fstub)
+            # Full path for file stub
+            fstub_full = os.path.join(ndar_sub_dir, fstub)
 
-                # Check if we're creating new protocol dictionary
-                if create_prot_dict:
+            # Check if we're creating new protocol dictionary
+            if create_prot_dict:
 
-                    print('  Adding protocol %s to dictionary' % prot)
+                print('  Adding protocol %s to dictionary' % prot)
 
-                    # Add current protocol to protocol dictionary
-                    # The value defaults to "EXCLUDE" which should be replaced with the correct NDAR
-                    # ImageDescription for this protocol (eg "T1w Structural", "BOLD MB EPI Resting State")
-                    prot_dict[prot] = "EXCLUDE"
+                # Add current protocol to protocol dictionary
+                # The value defaults to "EXCLUDE" which should be replaced with the correct NDAR
+                # ImageDescription for this protocol (eg "T1w Structural", "BOLD MB EPI Resting State")
+                prot_dict[prot] = "EXCLUDE"
 
-                else:
+            else:
 
-                    # JSON sidecar for this image
-                    json_fname = fstub_full + '.json'
-                    if not os.path.isfile(json_fname):
-                        print('* JSON sidecar not found')
-                        break
+                # JSON sidecar for this image
+                json_fname = fstub_full + '.json'
+                if not os.path.isfile(json_fname):
+                    print('* JSON sidecar not found')
+                    break
 
-                    # Skip excluded protocols
-                    if prot_dict[prot] == 'EXCLUDE':
+                # Skip excluded protocols
+                if prot_dict[prot] == 'EXCLUDE':
 
-                        print('* Excluding protocol ' + prot)
+                    print('* Excluding protocol ' + prot)
 
-                        # Remove all files related to this protocol
-                        for f in glob.glob(fstub_full + '.*'):
-                            os.remove(f)
+                    # Remove all files related to this protocol
+                    for f in glob.glob(fstub_full + '.*'):
+                        os.remove(f)
 
-                    else:
+                else:
 
-                        print('  Converting protocol ' + prot)
+                    print('  Converting protocol ' + prot)
 
-                        # Read JSON sidecar contents
-                        json_fd = open(json_fname, 'r')
-                        info = json.load(json_fd)
-                        json_fd.close()
+                    # Read JSON sidecar contents
+                    json_fd = open(json_fname, 'r')
+                    sidecar = json.load(json_fd)
+                    json_fd.close()
 
-                        # Combine JSON, Nifti and DICOM info dictionaries
-                        info.update(nii_info)
-                        info.update(dcm_info)
+                    # Read Nifti header for image FOV, extent (ie matrix) and voxel dimensions
+                    print('  Reading Nifti header')
+                    nii_info = ndar_nifti_info(nii_fname_full)
 
-                        # Add remaining fields not in JSON or DICOM metadata
-                        info['SID'] = SID
-                        info['ImageFile'] = os.path.basename(nii_fname)
-                        info['ImageDescription'] = prot_dict[prot]
-                        info['ScanType'] = ndar_scantype(prot_dict[prot])
-                        info['Orientation'] = ndar_orientation(info)
+                    # Image record over the JSON, Nifti and shared subject DICOM info dictionaries
+                    # with the remaining fields not in JSON or DICOM metadata
+                    image = NdarImage(SID, nii_fname, prot_dict[prot], sidecar, nii_info, dcm_info)
 
-                        # Add row to NDAR summary CSV file
-                        ndar_add_row(ndar_csv_fd, info)
+                    # Add row to NDAR summary CSV file
+                    ndar_add_row(ndar_csv_fd, image)
 
-                        # Delete JSON file
-                        os.remove(json_fname)
+                    # Delete JSON file
+                    os.remove(json_fname)
 
 
-            # Close NDAR summary file for this subject
-            ndar_close_summary(ndar_csv_fd)
+        # Close NDAR summary file for this subject
+        ndar_close_summary(ndar_csv_fd)
 
     # Create combined protocol translator in DICOM root directory if necessary
     if create_prot_dict:
         ndar_create_prot_dict(prot_dict_json, prot_dict)
 
+    # Upload archives for all converted subjects
+    elif args.package:
+        ndar_package(ndar_root_dir, [SID for SID, r in zip(SIDs, conv_results) if r['status'] == 'ok'], args.jobs)
+
+    # Final dcm2niix summary, including any failed or empty conversions
+    print('')
+    for line in dcmconv.dcm2niix_summary(conv_results):
+        print(line)
+
     # Clean exit
     sys.exit(0)
 
 
+def ndar_package(ndar_root_dir, SIDs, max_workers=1):
+    """
+    Package each subject's NDAR directory into an upload archive
+    - Archives are written to <NDAR root>/upload/<SID>.zip with the subject files at the archive root,
+      matching the image_file entries in the summary CSV
+    - Subjects are packaged concurrently (zlib compression and file I/O release the GIL)
+    - Sizes, MD5 and SHA-256 digests of every member and archive are computed while the archives are written
+      and listed in <NDAR root>/upload/Upload_Manifest.tsv
+
+    :param ndar_root_dir: str
+        NDAR root directory containing the subject directories
+    :param SIDs: list
+        Subject IDs to package
+    :param max_workers: int
+        Maximum number of archives written concurrently
+    :return manifest_fname: str
+    """
+
+    upload_dir = os.path.join(ndar_root_dir, 'upload')
+    os.makedirs(upload_dir, exist_ok=True)
+
+    print('')
+    print('Packaging %d subjects for upload' % len(SIDs))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        subject_rows = list(pool.map(lambda SID: ndar_package_subject(os.path.join(ndar_root_dir, SID),
+                                                                      os.path.join(upload_dir, SID + '.zip')),
+                                     SIDs))
+
+    manifest_fname = os.path.join(upload_dir, 'Upload_Manifest.tsv')
+
+    with open(manifest_fname, 'w') as fd:
+        fd.write('archive\tmember\tsize\tmd5\tsha256\n')
+        for rows in subject_rows:
+            for row in rows:
+                fd.write('%s\t%s\t%d\t%s\t%s\n' % row)
+
+    for SID, rows in zip(SIDs, subject_rows):
+        print('  %s.zip : %d files, %0.1f MB' % (SID, len(rows) - 1, rows[-1][2] / 1e6))
+
+    print('Upload manifest written to %s' % manifest_fname)
+
+    return manifest_fname
+
+
+def ndar_package_subject(ndar_sub_dir, zip_fname, chunk_size=1 << 20):
+    """
+    Stream a subject's NDAR files into a zip archive
+    - Files are read once in fixed-size chunks, so memory use is bounded whatever the image size
+    - Already compressed files (.gz) are stored, everything else is deflated
+    - The archive is written under a temporary name and renamed into place
+
+    :param ndar_sub_dir: str
+        Subject NDAR directory
+    :param zip_fname: str
+        Output archive filename
+    :param chunk_size: int
+        Read size in bytes
+    :return rows: list
+        (archive, member, size, md5, sha256) for each member, followed by the archive itself with an empty member
+    """
+
+    archive = os.path.basename(zip_fname)
+    tmp_fname = zip_fname + '.part'
+
+    rows = []
+
+    with open(tmp_fname, 'wb') as raw_fd:
+
+        # Digests of the archive bytes as they are written
+        out_fd = NdarDigestWriter(raw_fd)
+
+        with zipfile.ZipFile(out_fd, 'w', allowZip64=True) as zf:
+
+            for fname in sorted(os.listdir(ndar_sub_dir)):
+
+                full_fname = os.path.join(ndar_sub_dir, fname)
+                if not os.path.isfile(full_fname):
+                    continue
+
+                zinfo = zipfile.ZipInfo.from_file(full_fname, fname)
+                zinfo.compress_type = zipfile.ZIP_STORED if fname.endswith('.gz') else zipfile.ZIP_DEFLATED
+
+                md5, sha256 = hashlib.md5(), hashlib.sha256()
+
+                with open(full_fname, 'rb') as src_fd, \
+                        zf.open(zinfo, 'w', force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as dst_fd:
+                    for chunk in iter(lambda: src_fd.read(chunk_size), b''):
+                        md5.update(chunk)
+                        sha256.update(chunk)
+                        dst_fd.write(chunk)
+
+                rows.append((archive, fname, zinfo.file_size, md5.hexdigest(), sha256.hexdigest()))
+
+    os.replace(tmp_fname, zip_fname)
+
+    rows.append((archive, '', out_fd.n_bytes, out_fd.md5.hexdigest(), out_fd.sha256.hexdigest()))
+
+    return rows
+
+
+class NdarDigestWriter:
+    """
+    Write-only file wrapper computing the size, MD5 and SHA-256 of everything written
+    - No tell or seek, so zipfile streams members with data descriptors instead of rewriting headers
+    """
+
+    __slots__ = ('fd', 'n_bytes', 'md5', 'sha256')
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.n_bytes = 0
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.n_bytes += len(data)
+        return self.fd.write(data)
+
+    def flush(self):
+        self.fd.flush()
+
+
 def ndar_load_prot_dict(prot_dict_json):
     '''
     Read protocol translations from JSON file
@@ -334,6 +510,9 @@ def ndar_nifti_info(nii_fname):
     :return: nii_info: Nifti information dictionary
     '''
 
+    # Deferred import - nibabel is slow to load and only needed once images exist
+    import nibabel as nib
+
     # Init a new dictionary
     nii_info = dict()
 
@@ -369,6 +548,71 @@ def ndar_nifti_info(nii_fname):
     return nii_info
 
 
+def ndar_demographics(dcm_root_dir, SIDs):
+    """
+    Collect subject-level DICOM information and age at scan for a whole cohort
+    - DICOM headers are only read for subjects missing from the demographics cache
+    - Ages are calculated for all subjects together from the birth and scan dates
+
+    The cache is a JSON file in the DICOM root directory alongside the protocol translator.
+    An entry is reused while the DICOM file it was read from is unchanged.
+
+    :param dcm_root_dir: str
+        DICOM root directory containing subject directories
+    :param SIDs: list
+        Subject IDs (subject DICOM directory names)
+    :return: demographics: dictionary
+        DICOM information dictionary keyed by SID, including AgeMonths and ScanDate
+    """
+
+    cache_fname = os.path.join(dcm_root_dir, 'NDAR_Demographics.json')
+
+    if os.path.isfile(cache_fname):
+        with open(cache_fname, 'r') as fd:
+            cache = json.load(fd)
+    else:
+        cache = dict()
+
+    n_read = 0
+
+    for SID in SIDs:
+
+        entry = cache.get(SID)
+
+        # Reuse cached header information if the source DICOM file hasn't changed
+        if entry and ndar_file_mtime(entry['DicomFile']) == entry['DicomMtime']:
+            continue
+
+        print('  Reading DICOM header for subject ' + SID)
+        cache[SID] = ndar_dcm_info(os.path.join(dcm_root_dir, SID))
+        n_read += 1
+
+    # Age in months at scan for the whole cohort in one pass
+    ages = ndar_age_months([cache[SID]['BirthDate'] for SID in SIDs],
+                           [cache[SID]['AcquisitionDate'] for SID in SIDs])
+
+    demographics = dict()
+
+    for SID, age_months in zip(SIDs, ages):
+
+        dcm_info = dict(cache[SID])
+
+        if age_months < 0:
+            print('* Birth or scan date missing for subject %s - setting interview age to 0' % SID)
+            age_months = 0
+
+        dcm_info['AgeMonths'] = int(age_months)
+        dcm_info['ScanDate'] = ndar_date(dcm_info['AcquisitionDate'])
+
+        demographics[SID] = dcm_info
+
+    if n_read > 0:
+        with open(cache_fname, 'w') as fd:
+            json.dump(cache, fd, indent=4, separators=(',', ':'))
+
+    return demographics
+
+
 def ndar_dcm_info(dcm_dir):
     """
     Extract additional subject-level DICOM header fields not handled by dcm2niix
@@ -378,45 +622,128 @@ def ndar_dcm_info(dcm_dir):
     :return: dcm_info: extra information dictionary
     """
 
-    # Loop over files until first valid DICOM is found
-    ds = []
-    for dcm in os.listdir(dcm_dir):
-        try:
-            ds = pydicom.read_file(os.path.join(dcm_dir, dcm))
-        except:
-            pass
+    # Representative header from the first valid DICOM file
+    hdr = dcmio.first_header(dcm_dir, tags=NDAR_DCM_TAGS)
 
-        # Break out if valid DICOM read
-        if ds:
-            break
+    if hdr is None:
+        print('* No DICOM files found in %s' % dcm_dir)
+        print('* Exiting')
+        sys.exit(1)
 
     # Init a new dictionary
     dcm_info = dict()
 
-    # Read DoB and scan date
-    dob = ds.PatientBirthDate
-    scan_date = ds.AcquisitionDate
+    # Source file, used to validate the demographics cache
+    dcm_info['DicomFile'] = hdr.fname
+    dcm_info['DicomMtime'] = ndar_file_mtime(hdr.fname)
 
-    # Calculate age in months at time of scan using datetime functions
-    d1 = datetime.strptime(dob, '%Y%M%d')
-    d2 = datetime.strptime(scan_date, '%Y%M%d')
-    rd = relativedelta.relativedelta(d2, d1)
-
-    # Approximation since residual day to month conversion assumes 1 month = 30 days
-    age_months = rd.years * 12 + rd.months + round(rd.days / 30.0)
+    # DoB and scan date as DICOM DA strings (YYYYMMDD)
+    # Fall back to the study date if the acquisition date has been removed
+    dcm_info['BirthDate'] = hdr.get('PatientBirthDate', '')
+    dcm_info['AcquisitionDate'] = hdr.get('AcquisitionDate') or hdr.get('StudyDate', '')
 
     # Fill dictionary
-    dcm_info['Sex'] = ds.PatientSex
-    dcm_info['PatientPosition'] = ds.PatientPosition
-    dcm_info['TransmitCoil'] = ds.TransmitCoilName
-    dcm_info['SoftwareVersions'] = ds.SoftwareVersions
-    dcm_info['PhotometricInterpretation'] = ds.PhotometricInterpretation
-    dcm_info['AgeMonths'] = age_months
-    dcm_info['ScanDate'] = datetime.strftime(d2, '%M/%d/%Y') # NDAR scan date format MM/DD/YYYY
+    # Values are stored as strings so the dictionary can be cached as JSON
+    dcm_info['Sex'] = str(hdr['PatientSex'])
+    dcm_info['PatientPosition'] = str(hdr['PatientPosition'])
+    dcm_info['TransmitCoil'] = str(hdr['TransmitCoilName'])
+    dcm_info['SoftwareVersions'] = str(hdr['SoftwareVersions'])
+    dcm_info['PhotometricInterpretation'] = str(hdr['PhotometricInterpretation'])
 
     return dcm_info
 
 
+def ndar_age_months(dobs, scan_dates):
+    """
+    Age in months at time of scan following the NDAR interview_age rounding rule
+    - Age is rounded to chronological month
+    - A residual of up to 15 days rounds down, 16 days or more rounds up
+
+    :param dobs: list
+        Birth dates as DICOM DA strings (YYYYMMDD)
+    :param scan_dates: list
+        Scan dates as DICOM DA strings (YYYYMMDD)
+    :return: age_months: numpy int array
+        Age in months for each subject, -1 where either date is missing or invalid
+    """
+
+    # Deferred import - numpy is already required by nibabel
+    import numpy as np
+
+    d1 = ndar_datetime64(dobs)
+    d2 = ndar_datetime64(scan_dates)
+
+    # Whole calendar months between the birth and scan months
+    m1 = d1.astype('datetime64[M]')
+    months = (d2.astype('datetime64[M]') - m1).astype(int)
+
+    # One fewer whole month if the scan day of month is before the birth day of month
+    day1 = (d1 - m1.astype('datetime64[D]')).astype(int)
+    day2 = (d2 - d2.astype('datetime64[M]').astype('datetime64[D]')).astype(int)
+    months -= day2 < day1
+
+    # Most recent monthly anniversary of birth, clipped to the end of short months
+    month_start = (m1 + months).astype('datetime64[D]')
+    month_end = (m1 + months + 1).astype('datetime64[D]') - 1
+    anniversary = np.minimum(month_start + day1, month_end)
+
+    # Round up on a residual of more than 15 days
+    residual_days = (d2 - anniversary).astype(int)
+    age_months = months + (residual_days > 15)
+
+    # Flag missing dates
+    age_months[np.isnat(d1) | np.isnat(d2)] = -1
+
+    return age_months
+
+
+def ndar_datetime64(dates):
+    """
+    Convert DICOM DA strings (YYYYMMDD) to a numpy datetime64[D] array
+    - Missing or malformed dates become NaT
+
+    :param dates: list
+    :return: numpy datetime64[D] array
+    """
+
+    import numpy as np
+
+    d64 = np.full(len(dates), np.datetime64('NaT'), dtype='datetime64[D]')
+
+    for i, d in enumerate(dates):
+        d = str(d).strip()
+        if len(d) == 8 and d.isdigit():
+            try:
+                d64[i] = np.datetime64('%s-%s-%s' % (d[0:4], d[4:6], d[6:8]), 'D')
+            except ValueError:
+                # Digits but not a real date (eg 20170231)
+                pass
+
+    return d64
+
+
+def ndar_date(da):
+    """
+    Convert a DICOM DA string (YYYYMMDD) to the NDAR date format (MM/DD/YYYY)
+
+    :param da: str
+    :return: str
+    """
+
+    try:
+        return datetime.strptime(da, '%Y%m%d').strftime('%m/%d/%Y')
+    except ValueError:
+        return 'Unknown'
+
+
+def ndar_file_mtime(fname):
+
+    try:
+        return os.path.getmtime(fname)
+    except OSError:
+        return None
+
+
 def ndar_init_summary(fname):
     '''
     Open a summary CSV file and initialize with NDAR Image03 preamble
@@ -456,11 +783,60 @@ def ndar_close_summary(fd):
     return
 
 
+class NdarImage:
+    """
+    Converted image record for the NDAR summary
+    - Holds the per-image fields and references to the sidecar, Nifti and subject DICOM dictionaries
+      rather than merging them into a new dictionary for every image
+    - Lookups search the image fields, then DICOM, Nifti and sidecar information in that order
+    """
+
+    __slots__ = ('SID', 'ImageFile', 'ImageDescription', 'ScanType', 'Orientation',
+                 'sidecar', 'nii_info', 'dcm_info')
+
+    # Per-image fields searched before the information dictionaries
+    FIELDS = ('SID', 'ImageFile', 'ImageDescription', 'ScanType', 'Orientation')
+
+    def __init__(self, SID, image_file, description, sidecar, nii_info, dcm_info):
+
+        self.SID = SID
+        self.ImageFile = image_file
+        self.ImageDescription = description
+        self.ScanType = ndar_scantype(description)
+        self.sidecar = sidecar
+        self.nii_info = nii_info
+        self.dcm_info = dcm_info
+        self.Orientation = None
+        self.Orientation = ndar_orientation(self)
+
+    def get(self, key, default=None):
+
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+
+        for d in (self.dcm_info, self.nii_info, self.sidecar):
+            if key in d:
+                return d[key]
+
+        return default
+
+    def __getitem__(self, key):
+
+        value = self.get(key, KeyError)
+
+        if value is KeyError:
+            raise KeyError(key)
+
+        return value
+
+
 def ndar_add_row(fd, info):
     """
     Write a single experiment row to the NDAR summary CSV file
     :param fd:
-    :param info:
+    :param info: NdarImage
     :return:
     """
 
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Shared dcm2niix job orchestration for dcm2bids.py and dcm2ndar.py
+
+Runs dcm2niix conversions as asyncio subprocesses with a concurrency limit,
+a per-job timeout and retries. The output of each job is captured to its own
+log file and every failure (non-zero exit, timeout or no images written) is
+returned for a final summary rather than silently leaving an empty directory.
+
+Alternatively, conversions can be driven through dcm2niibatch (dcm2niix built
+with -DBATCH_VERSION), which converts every folder listed in a YAML spec from
+a single process. Items are split into one spec per concurrent job so that
+process startup happens once per shard rather than once per folder.
+
+Usage
+----
+jobs = [dcm2niix_job('sub-01_ses-1', ['dcm2niix', ...], 'sub-01_ses-1.log', out_dir)]
+results = run_dcm2niix_jobs(jobs, max_jobs=4, timeout=3600, retries=1)
+for line in dcm2niix_summary(results):
+    print(line)
+
+items = [dcm2niibatch_item('sub-01_ses-1', dcm_dir, out_dir, '%n--%d--%q--%s')]
+results = run_dcm2niibatch(items, {'isGz': True, 'isCreateBIDS': True}, 'logs', max_jobs=4)
+
+MIT License
+
+Copyright (c) 2017 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import time
+import shutil
+from datetime import datetime
+
+
+def dcm2niix_job(name, cmd, log_fname, out_dir):
+    """
+    Describe a single dcm2niix conversion job
+    - The output directory is emptied before each retry, so a retry never finds the partial
+      output of a failed attempt (dcm2niix would otherwise write suffixed copies next to it)
+
+    :param name: str
+        Job name used in logs and the summary (eg 'sub-01/ses-1')
+    :param cmd: list
+        dcm2niix command and arguments
+    :param log_fname: str
+        File receiving stdout and stderr from every attempt
+    :param out_dir: str or list
+        dcm2niix output directory (or every output directory of a dcm2niibatch shard), checked for
+        images after a successful exit and emptied before each retry (None skips both)
+    :return job: dictionary
+    """
+
+    return {'name': name, 'cmd': cmd, 'log': log_fname, 'out_dir': out_dir}
+
+
+def run_dcm2niix_jobs(jobs, max_jobs=1, timeout=None, retries=0):
+    """
+    Run dcm2niix jobs concurrently
+
+    :param jobs: list
+        Jobs from dcm2niix_job
+    :param max_jobs: int
+        Maximum number of concurrent dcm2niix processes
+    :param timeout: float
+        Seconds before an attempt is killed (None waits indefinitely)
+    :param retries: int
+        Additional attempts after a failed, timed out or empty attempt
+    :return results: list
+        One result dictionary per job, in job order. Adds the keys
+        'status' ('ok', 'failed', 'timeout' or 'empty'), 'returncode', 'attempts' and 'elapsed'
+    """
+
+    if not jobs:
+        return []
+
+    # Deferred import - asyncio is slow to load and only needed once conversions start
+    import asyncio
+
+    return asyncio.run(_run_all(jobs, max(1, max_jobs), timeout, retries))
+
+
+def dcm2niibatch_item(name, in_dir, out_dir, filename):
+    """
+    Describe a single folder conversion within a dcm2niibatch spec
+
+    :param name: str
+        Item name used in logs and the summary (eg 'sub-01/ses-1')
+    :param in_dir: str
+        DICOM input directory
+    :param out_dir: str
+        Output directory, checked for images after the batch process exits
+    :param filename: str
+        dcm2niix output filename format (eg '%n--%d--%q--%s')
+    :return item: dictionary
+    """
+
+    return {'name': name, 'in_dir': in_dir, 'out_dir': out_dir, 'filename': filename}
+
+
+def run_dcm2niibatch(items, options, spec_dir, max_jobs=1, timeout=None, retries=0):
+    """
+    Run folder conversions through dcm2niibatch, one process per shard of items
+    - Items are split into at most max_jobs contiguous shards, keeping a subject's sessions together
+    - A batch spec and log are written for each shard in spec_dir
+    - The timeout applies to a whole shard. A failed shard, or one that leaves any item without images,
+      is retried as a whole after emptying the output directories of all its items
+
+    :param items: list
+        Items from dcm2niibatch_item
+    :param options: dictionary
+        dcm2niibatch Options (eg {'isGz': True, 'isCreateBIDS': True})
+    :param spec_dir: str
+        Directory for the batch specs and shard logs
+    :param max_jobs: int
+        Maximum number of concurrent dcm2niibatch processes
+    :param timeout: float
+        Seconds before a shard attempt is killed (None waits indefinitely)
+    :param retries: int
+        Additional attempts after a failed or timed out shard
+    :return results: list
+        One result dictionary per item, in item order, with the same keys as run_dcm2niix_jobs.
+        'log', 'attempts' and 'elapsed' refer to the item's shard
+    """
+
+    if not items:
+        return []
+
+    os.makedirs(spec_dir, exist_ok=True)
+
+    n_shards = min(max(1, max_jobs), len(items))
+    shard_size = -(-len(items) // n_shards)
+    shards = [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+
+    jobs = []
+
+    for sc, shard in enumerate(shards):
+
+        spec_fname = os.path.join(spec_dir, 'dcm2niibatch_%03d.yaml' % sc)
+        write_dcm2niibatch_spec(spec_fname, shard, options)
+
+        # Output directories of every item in the shard - items are also checked individually below
+        jobs.append(dcm2niix_job('batch %03d' % sc, ['dcm2niibatch', spec_fname],
+                                 os.path.join(spec_dir, 'dcm2niibatch_%03d.log' % sc),
+                                 [item['out_dir'] for item in shard]))
+
+    shard_results = run_dcm2niix_jobs(jobs, max_jobs, timeout, retries)
+
+    results = []
+
+    for shard, shard_result in zip(shards, shard_results):
+
+        for item in shard:
+
+            result = dict(item, cmd=shard_result['cmd'], log=shard_result['log'],
+                          status=shard_result['status'], returncode=shard_result['returncode'],
+                          attempts=shard_result['attempts'], elapsed=shard_result['elapsed'])
+
+            if result['status'] == 'ok' and not _has_images(item['out_dir']):
+                result['status'] = 'empty'
+
+            results.append(result)
+
+    return results
+
+
+def write_dcm2niibatch_spec(spec_fname, items, options):
+    """
+    Write a dcm2niibatch YAML spec
+    - Written directly rather than through a YAML library, since the format is fixed and flat
+
+    :param spec_fname: str
+        Spec filename
+    :param items: list
+        Items from dcm2niibatch_item
+    :param options: dictionary
+        dcm2niibatch Options with bool values
+    :return:
+    """
+
+    lines = ['Options:']
+    lines += ['  %s: %s' % (key, 'true' if value else 'false') for key, value in options.items()]
+    lines.append('Files:')
+
+    for item in items:
+        lines += ['  -',
+                  '    in_dir: %s' % _yaml_str(item['in_dir']),
+                  '    out_dir: %s' % _yaml_str(item['out_dir']),
+                  '    filename: %s' % _yaml_str(item['filename'])]
+
+    with open(spec_fname, 'w') as fd:
+        fd.write('\n'.join(lines) + '\n')
+
+
+def dcm2niix_summary(results):
+    """
+    Summarize dcm2niix job results
+
+    :param results: list
+        Results from run_dcm2niix_jobs
+    :return lines: list
+        Summary lines, including one line per failed job
+    """
+
+    failed = [r for r in results if r['status'] != 'ok']
+
+    lines = ['dcm2niix : %d conversions, %d failed' % (len(results), len(failed))]
+
+    for r in failed:
+        lines.append('* %s : %s (exit code %s, %d attempts) - see %s' %
+                     (r['name'], r['status'], r['returncode'], r['attempts'], r['log']))
+
+    return lines
+
+
+async def _run_all(jobs, max_jobs, timeout, retries):
+
+    import asyncio
+
+    # The semaphore bounds the number of running dcm2niix processes
+    sem = asyncio.Semaphore(max_jobs)
+
+    return await asyncio.gather(*[_run_job(sem, job, timeout, retries) for job in jobs])
+
+
+async def _run_job(sem, job, timeout, retries):
+
+    import asyncio
+
+    result = dict(job, status='failed', returncode=None, attempts=0, elapsed=0.0)
+
+    # A dcm2niibatch shard has one output directory per item
+    out_dirs = job['out_dir'] if isinstance(job['out_dir'], list) else [job['out_dir']] if job['out_dir'] else []
+
+    log_dir = os.path.dirname(job['log'])
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    async with sem:
+
+        t0 = time.perf_counter()
+
+        with open(job['log'], 'ab') as log_fd:
+
+            for attempt in range(retries + 1):
+
+                result['attempts'] = attempt + 1
+
+                # Discard the partial output of the previous attempt
+                if attempt > 0:
+                    for out_dir in out_dirs:
+                        _empty_dir(out_dir)
+
+                log_fd.write(('--- %s attempt %d : %s\n' %
+                              (datetime.now().isoformat(), attempt + 1, ' '.join(job['cmd']))).encode())
+                log_fd.flush()
+
+                try:
+                    proc = await asyncio.create_subprocess_exec(*job['cmd'],
+                                                                stdout=log_fd, stderr=asyncio.subprocess.STDOUT)
+                except OSError as err:
+                    # dcm2niix missing or not executable - retrying won't help
+                    log_fd.write(('*** %s\n' % err).encode())
+                    break
+
+                try:
+                    result['returncode'] = await asyncio.wait_for(proc.wait(), timeout)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+                    result['returncode'] = proc.returncode
+                    result['status'] = 'timeout'
+                    log_fd.write(('*** Killed after %0.0f s\n' % timeout).encode())
+                    continue
+
+                if result['returncode'] != 0:
+                    result['status'] = 'failed'
+                elif not all(_has_images(out_dir) for out_dir in out_dirs):
+                    result['status'] = 'empty'
+                else:
+                    result['status'] = 'ok'
+                    break
+
+        result['elapsed'] = time.perf_counter() - t0
+
+    return result
+
+
+def _yaml_str(value):
+
+    # Single-quoted YAML scalar - only the quote itself needs escaping
+    return "'%s'" % value.replace("'", "''")
+
+
+def _empty_dir(out_dir):
+
+    # Remove the contents but keep the directory itself
+    try:
+        it = os.scandir(out_dir)
+    except OSError:
+        return
+
+    with it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+
+
+def _has_images(out_dir):
+
+    try:
+        with os.scandir(out_dir) as it:
+            return any('.nii' in entry.name for entry in it)
+    except OSError:
+        return False
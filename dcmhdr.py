@@ -45,14 +45,24 @@ SOFTWARE.
 __version__ = '0.9.1'
 
 import os
+import re
 import sys
 import argparse
 import subprocess
 import shutil
 import json
-import dicom
 import glob
+import dcmio
 from datetime import datetime as dt
+from functools import partial
+from multiprocessing import Pool
+
+# DICOM header elements used by dcm_hdr
+DCM_HDR_TAGS = ['PatientName', 'SeriesNumber', 'SeriesDescription', 'AcquisitionDate', 'AcquisitionTime',
+                'PatientSex', 'PatientAge']
+
+# Predicate operators, longest first so that '<=' is not parsed as '<'
+DCM_WHERE_OPS = ['<=', '>=', '!=', '=', '<', '>', '~']
 
 
 def main():
@@ -61,10 +71,22 @@ def main():
     parser = argparse.ArgumentParser(description='Extract useful fields from DICOM headers')
     parser.add_argument('-i','--input', required=True, nargs='+', help='List of DICOM filenames')
     parser.add_argument('-o','--output', help='Output CSV file name')
+    parser.add_argument('-w','--where', action='append', default=[],
+                        help='Only list files matching a predicate on a DICOM keyword, eg SeriesDescription~BOLD, '
+                             'AcquisitionDate>=20170101 or PatientName=SMITH^JOHN. Operators: = != ~ < <= > >=. '
+                             'Repeat for several predicates, which must all match')
+    parser.add_argument('-j','--jobs', type=int, default=1, help='Number of header reader processes [1]')
 
     # Parse command line arguments
     args = parser.parse_args()
 
+    # Parse file selection predicates before opening any files
+    try:
+        predicates = [dcm_parse_where(where) for where in args.where]
+    except ValueError as err:
+        print('* %s' % err)
+        sys.exit(1)
+
     # List of one or more DICOM files
     dcm_fnames = args.input
 
@@ -87,13 +109,20 @@ def main():
     sys.stdout.flush()
     csv_fd.write(hdr_str)
 
-    # Loop over each subject's DICOM directory within the root source directory
-    for dcm_fname in dcm_fnames:
+    # Filter and read headers in worker processes, keeping the input order
+    select = partial(dcm_select_hdr, predicates=predicates)
 
-        if os.path.isfile(dcm_fname):
+    if args.jobs > 1:
+        pool = Pool(args.jobs)
+        results = pool.imap(select, dcm_fnames, chunksize=64)
+    else:
+        pool = None
+        results = map(select, dcm_fnames)
 
-            # Get subject age and sex from representative DICOM header
-            hdr = dcm_hdr(dcm_fname)
+    # Loop over each subject's DICOM directory within the root source directory
+    for dcm_fname, status, hdr in results:
+
+        if status == 'ok':
 
             # Add line to CSV output file
             line_str = '%s, %s, %s, %s, %s, %s, %s\n' % (
@@ -109,10 +138,18 @@ def main():
             sys.stdout.flush()
             csv_fd.write(line_str)
 
-        else:
+        elif status == 'missing':
 
             print('* Could not find DICOM file %s - skipping' % dcm_fname)
 
+        elif status == 'unreadable':
+
+            print('* Could not read DICOM header from %s - skipping' % dcm_fname)
+
+    if pool:
+        pool.close()
+        pool.join()
+
     # Close participants TSV file
     csv_fd.close()
 
@@ -120,18 +157,133 @@ def main():
     sys.exit(0)
 
 
-def dcm_hdr(dcm_fname):
+def dcm_select_hdr(dcm_fname, predicates=None):
+    """
+    Extract header information from a DICOM file if it satisfies every predicate
+    - The predicate and output elements are read together in one partial header read that stops
+      after the highest numbered element needed, so each file is opened and parsed once
+    - Runs in the worker processes
+
+    :param dcm_fname: DICOM filename
+    :param predicates: list of (keyword, operator, value) tuples from dcm_parse_where
+    :return: (dcm_fname, status, hdr) tuple
+        status is 'ok', 'missing', 'unreadable' or 'filtered'. hdr is None unless status is 'ok'
+    """
+
+    if not os.path.isfile(dcm_fname):
+        return dcm_fname, 'missing', None
+
+    predicates = predicates or []
+
+    tags = sorted(set(keyword for keyword, _, _ in predicates) | set(DCM_HDR_TAGS))
+
+    try:
+        ds = dcmio.read_header(dcm_fname, tags=tags, force=True, partial=True)
+    except Exception:
+        return dcm_fname, 'unreadable', None
+
+    for keyword, op, value in predicates:
+        if not dcm_match(ds.get(keyword), op, value):
+            return dcm_fname, 'filtered', None
+
+    return dcm_fname, 'ok', dcm_hdr(dcm_fname, ds)
+
+
+def dcm_parse_where(where):
+    """
+    Parse a file selection predicate
+
+    :param where: predicate string, eg 'SeriesDescription~BOLD'
+    :return: (keyword, operator, value) tuple
+        Raises ValueError for a malformed predicate or unknown DICOM keyword
+    """
+
+    for op in DCM_WHERE_OPS:
+
+        keyword, found, value = where.partition(op)
+
+        # First operator present wins, so check that no earlier character starts another operator
+        if found and not any(c in '<>!=~' for c in keyword):
+
+            keyword = keyword.strip()
+
+            if not re.match(r'^[A-Za-z][A-Za-z0-9]*$', keyword):
+                raise ValueError('Malformed predicate %s' % where)
+
+            if not dcmio.is_keyword(keyword):
+                raise ValueError('Unknown DICOM keyword %s in predicate %s' % (keyword, where))
+
+            if op == '~':
+                try:
+                    re.compile(value)
+                except re.error as err:
+                    raise ValueError('Bad regular expression in predicate %s : %s' % (where, err))
+
+            return keyword, op, value.strip()
+
+    raise ValueError('No operator found in predicate %s' % where)
+
+
+def dcm_match(hdr_value, op, value):
+    """
+    Evaluate a single predicate against a header value
+    - Missing elements only match '!='
+    - Numeric header values (IS, DS, US ...) are compared numerically, everything else as strings.
+      DICOM dates (YYYYMMDD) and times (HHMMSS) therefore order correctly as strings
+    - '~' is a regular expression search
+    - Multi-valued elements are compared as their backslash-separated DICOM string
+
+    :param hdr_value: plain header value from DicomHeader.get
+    :param op: operator
+    :param value: predicate value string
+    :return: bool
+    """
+
+    if hdr_value is None:
+        return op == '!='
+
+    if isinstance(hdr_value, list):
+        hdr_value = '\\'.join(str(v) for v in hdr_value)
+
+    if op == '~':
+        return re.search(value, str(hdr_value)) is not None
+
+    if isinstance(hdr_value, (int, float)):
+        try:
+            a, b = hdr_value, float(value)
+        except ValueError:
+            a, b = str(hdr_value), value
+    else:
+        a, b = str(hdr_value).strip(), value
+
+    if op == '=':
+        return a == b
+    elif op == '!=':
+        return a != b
+    elif op == '<':
+        return a < b
+    elif op == '<=':
+        return a <= b
+    elif op == '>':
+        return a > b
+    else:
+        return a >= b
+
+
+def dcm_hdr(dcm_fname, ds=None):
     """
     Extract relevant subject information from DICOM header
     :param dcm_fname: DICOM filename
+    :param ds: DicomHeader already read with at least DCM_HDR_TAGS (read from dcm_fname if None)
     :return dcm_info: DICOM header information dictionary
     """
 
-    try:
-        ds = dicom.read_file(dcm_fname, force=True)
-    except:
-        print("Unexpected error:", sys.exc_info()[0])
-        raise
+    if ds is None:
+        try:
+            ds = dcmio.read_header(dcm_fname, tags=DCM_HDR_TAGS, force=True)
+        except:
+            print("Unexpected error:", sys.exc_info()[0])
+            raise
 
     # Init a new dictionary
     hdr = dict()
@@ -139,12 +291,12 @@ def dcm_hdr(dcm_fname):
     if ds:
 
         # Fill dictionary
-        hdr['PatName'] = ds.PatientName
-        hdr['SerNo'] = ds.SeriesNumber
-        hdr['SerDesc'] = ds.SeriesDescription
-        hdr['AcqDateTime'] = dcm_date_time(ds.AcquisitionDate, ds.AcquisitionTime)
-        hdr['Sex'] = ds.PatientSex
-        hdr['Age'] = ds.PatientAge
+        hdr['PatName'] = ds['PatientName']
+        hdr['SerNo'] = ds['SeriesNumber']
+        hdr['SerDesc'] = ds['SeriesDescription']
+        hdr['AcqDateTime'] = dcm_date_time(ds['AcquisitionDate'], ds['AcquisitionTime'])
+        hdr['Sex'] = ds['PatientSex']
+        hdr['Age'] = ds['PatientAge']
 
     else:
 
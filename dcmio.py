@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Shared DICOM header access and discovery for dcm2bids.py, dcm2ndar.py and dcmhdr.py
+
+All header reads go through this module so the three tools share one DICOM
+library and one set of reader options. Pixel data is never read, and the
+reader can be limited to the handful of elements a tool actually needs.
+
+Subject, session and DICOM file discovery is also shared. Directories are read
+with os.scandir and entries are yielded as they are listed, so discovery over
+large roots on network storage starts producing work immediately and costs no
+extra stat per entry.
+
+pydicom 1.0 or later (import pydicom) is used when available, falling back
+to the older pydicom 0.9.x API (import dicom).
+
+Usage
+----
+hdr = read_header('IM0001.dcm', tags=['PatientSex', 'PatientAge'])
+sex = hdr.get('PatientSex', 'Unknown')
+
+hdr = first_header('mydicom/sub01', tags=['PatientSex'])
+
+hdr = read_header('IM0001.dcm', tags=['SeriesDescription'], partial=True)
+
+for SID, dcm_sub_dir in scan_dirs('mydicom', exclude=['pilot*']):
+    fnames = list(dicom_files(dcm_sub_dir))
+
+MIT License
+
+Copyright (c) 2017 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+from fnmatch import fnmatch
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Distinguishes a missing element from one present with an empty value
+_MISSING = object()
+
+
+class DicomHeader:
+    """
+    DICOM header record with plain Python values
+    - Strings, person names and dates are returned as str
+    - DS and IS values are returned as float and int
+    - Multi-valued elements are returned as lists
+    """
+
+    __slots__ = ('fname', '_ds')
+
+    def __init__(self, fname, ds):
+        self.fname = fname
+        self._ds = ds
+
+    def get(self, keyword, default=None):
+        """
+        Value of a DICOM element
+
+        :param keyword: str
+            DICOM keyword (eg 'PatientSex')
+        :param default:
+            Returned if the element is missing or empty
+        :return: element value
+        """
+
+        value = getattr(self._ds, keyword, None)
+
+        if value is None or value == '':
+            return default
+
+        return _plain(value)
+
+    def __contains__(self, keyword):
+        return self.get(keyword) is not None
+
+    def __getitem__(self, keyword):
+        """
+        Value of a DICOM element that must be present
+        - Raises KeyError only if the element is missing from the header
+        - Present but empty elements (eg an anonymized PatientName) return ''
+        """
+
+        value = getattr(self._ds, keyword, _MISSING)
+
+        if value is _MISSING:
+            raise KeyError(keyword)
+
+        if value is None or value == '':
+            return ''
+
+        return _plain(value)
+
+
+def is_dicom(fname):
+    """
+    Cheap DICOM file check using the Part 10 preamble
+    - Files start with a 128 byte preamble followed by the 'DICM' magic
+
+    :param fname: str
+        Candidate file path
+    :return: bool
+    """
+
+    try:
+        with open(fname, 'rb') as fd:
+            return fd.read(132)[128:] == b'DICM'
+    except OSError:
+        return False
+
+
+def read_header(fname, tags=None, force=False, partial=False):
+    """
+    Read a DICOM header without pixel data
+
+    :param fname: str
+        DICOM filename
+    :param tags: list
+        DICOM keywords to read (None reads every element before the pixel data)
+    :param force: bool
+        Read files without a DICOM preamble
+    :param partial: bool
+        Stop parsing after the highest numbered element in tags. Data elements are stored
+        in ascending tag order, so elements after the last one needed are never read
+    :return hdr: DicomHeader
+        Raises the reader's exception if the file can't be parsed
+    """
+
+    try:
+        import pydicom
+    except ImportError:
+        pydicom = None
+
+    if pydicom is not None and partial and tags:
+
+        from pydicom.filereader import read_partial
+        from pydicom.tag import Tag
+
+        tag_list = [Tag(keyword) for keyword in tags]
+        last_tag = max(tag_list)
+
+        # Stop at the first element after the last tag needed (always before pixel data)
+        def _stop_when(tag, vr, length):
+            return tag > last_tag or tag == 0x7FE00010
+
+        with open(fname, 'rb') as fd:
+            ds = read_partial(fd, stop_when=_stop_when, force=force, specific_tags=tag_list)
+
+    elif pydicom is not None:
+        ds = pydicom.dcmread(fname, stop_before_pixels=True, specific_tags=tags, force=force)
+    else:
+        # pydicom 0.9.x has no element selection
+        import dicom
+        ds = dicom.read_file(fname, stop_before_pixels=True, force=force)
+
+    return DicomHeader(fname, ds)
+
+
+def is_keyword(keyword):
+    """
+    Check a DICOM keyword against the data dictionary
+
+    :param keyword: str
+        DICOM keyword (eg 'SeriesDescription')
+    :return: bool
+        Always True with pydicom 0.9.x, which has no keyword lookup
+    """
+
+    try:
+        from pydicom.datadict import tag_for_keyword
+    except ImportError:
+        return True
+
+    return tag_for_keyword(keyword) is not None
+
+
+def first_header(dcm_dir, tags=None):
+    """
+    Header of the first readable DICOM file within a directory tree
+    - Directories and files are searched in sorted order
+    - Files without a DICOM preamble are skipped without parsing
+
+    :param dcm_dir: str
+        Directory containing DICOM files or DICOM subdirectories
+    :param tags: list
+        DICOM keywords to read (None reads every element before the pixel data)
+    :return hdr: DicomHeader
+        None if no DICOM file was found
+    """
+
+    for dcm_fname in dicom_files(dcm_dir):
+
+        try:
+            return read_header(dcm_fname, tags)
+        except Exception:
+            continue
+
+    return None
+
+
+def dicom_files(dcm_dir, sort=True):
+    """
+    DICOM files within a directory tree
+    - Hidden files and directories are skipped
+    - Files without a DICOM preamble are skipped without parsing
+
+    :param dcm_dir: str
+        Directory containing DICOM files or DICOM subdirectories
+    :param sort: bool
+        Yield files and directories in sorted order rather than directory order
+    :return: generator of DICOM file paths
+    """
+
+    for entry in scan_files(dcm_dir, sort):
+        if is_dicom(entry.path):
+            yield entry.path
+
+
+def scan_dirs(root_dir, include=None, exclude=None):
+    """
+    Subdirectories of a directory, yielded as the directory is read
+    - os.scandir entries carry the file type from the directory listing (d_type), so
+      no per-entry stat is needed except for symlinks and file systems without d_type
+    - Hidden directories are skipped (eg dcmpacs.py's .incoming staging directory)
+
+    :param root_dir: str
+        Directory to list (eg the DICOM root or a subject DICOM directory)
+    :param include: list
+        fnmatch patterns - only directory names matching at least one are yielded (None yields all)
+    :param exclude: list
+        fnmatch patterns - directory names matching any of these are skipped
+    :return: generator of (name, path) tuples in directory order
+    """
+
+    try:
+        it = os.scandir(root_dir)
+    except OSError:
+        return
+
+    with it:
+
+        for entry in it:
+
+            if entry.name.startswith('.') or not _selected(entry.name, include, exclude):
+                continue
+
+            try:
+                if entry.is_dir():
+                    yield entry.name, entry.path
+            except OSError:
+                # Entry removed since the listing
+                continue
+
+
+def scan_files(root_dir, sort=False):
+    """
+    Regular files within a directory tree, yielded as each directory is read
+    - Files in a directory are yielded before its subdirectories are descended, as with os.walk
+    - Hidden files and directories are skipped and symlinked directories are not followed
+    - The os.DirEntry is returned so that callers needing sizes or times can use entry.stat(),
+      which is cached on the entry (and free on Windows)
+
+    :param root_dir: str
+        Top of the directory tree
+    :param sort: bool
+        Yield entries in sorted name order rather than directory order
+    :return: generator of os.DirEntry
+    """
+
+    try:
+        it = os.scandir(root_dir)
+    except OSError:
+        return
+
+    subdirs = []
+
+    with it:
+
+        for entry in (sorted(it, key=lambda e: e.name) if sort else it):
+
+            if entry.name.startswith('.'):
+                continue
+
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+            except OSError:
+                continue
+
+    for subdir in subdirs:
+        yield from scan_files(subdir, sort)
+
+
+def read_headers(fnames, tags=None, max_workers=None):
+    """
+    Read many DICOM headers concurrently
+    - Header reads are I/O bound, so a thread pool overlaps the file system latency
+
+    :param fnames: list
+        DICOM filenames
+    :param tags: list
+        DICOM keywords to read (None reads every element before the pixel data)
+    :param max_workers: int
+        Maximum number of reader threads (None uses the ThreadPoolExecutor default)
+    :return hdrs: list
+        DicomHeader for each filename, in order, or None where the file couldn't be parsed
+    """
+
+    def _read(fname):
+        try:
+            return read_header(fname, tags)
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(_read, fnames))
+
+
+def _selected(name, include, exclude):
+
+    if include and not any(fnmatch(name, pattern) for pattern in include):
+        return False
+
+    return not (exclude and any(fnmatch(name, pattern) for pattern in exclude))
+
+
+def _plain(value):
+
+    # Multi-valued elements (MultiValue) but not strings
+    if isinstance(value, Sequence) and not isinstance(value, (str, bytes)):
+        return [_plain(v) for v in value]
+
+    # DS and IS are float and int subclasses
+    if isinstance(value, float):
+        return float(value)
+
+    if isinstance(value, int):
+        return int(value)
+
+    if isinstance(value, bytes):
+        return value
+
+    # Person names, dates and other strings
+    return str(value)
@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+"""
+Retrieve subject DICOM series from a PACS or other DICOM node into the dcm2bids input layout
+
+Studies are found with C-FIND for each subject's PatientID and every series is pulled
+with C-GET (or C-MOVE to this script's own storage SCP) over several concurrent
+associations. Series are written to:
+
+<DICOM Directory>/
+    <SID>/
+        <Session>/
+            <SeriesNumber>_<SeriesDescription>/
+                <SOPInstanceUID>.dcm
+
+where the session name is the study date (YYYYMMDD, with a _2, _3 ... suffix for
+further studies on the same day). Series sharing a number and description within a
+study get a short SeriesInstanceUID hash suffix (eg 5_rsBOLD_3f2a9c1e). Each series is received into a hidden staging
+directory and renamed into place once complete, so a concurrent
+dcm2bids.py --watch only ever sees whole series. Completed series are recorded in
+a retrieval log and skipped on later runs.
+
+Requires pynetdicom, which is only imported when the script runs.
+
+Usage
+----
+dcmpacs.py --host <PACS host> --port <port> --aec <PACS AE title> -s <subjects file> -o <DICOM Directory>
+
+The subjects file lists one PatientID per line, optionally followed by the subject ID
+to use for the directory name (default PatientID).
+
+Examples
+----
+% dcmpacs.py --host pacs.example.edu --port 104 --aec PACS -s subjects.txt -o mydicom -j 4
+% dcmpacs.py --host localhost --port 4242 --aec ORTHANC --patient CBIC0001 -o mydicom
+% dcmpacs.py --host pacs --port 104 --aec PACS --method move --store-port 11112 -s subjects.txt
+
+Overlap retrieval and conversion by running dcm2bids.py --watch on the same DICOM directory.
+
+MIT License
+
+Copyright (c) 2017 Mike Tyszka
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+__version__ = '1.0.0'
+
+import os
+import re
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import dcmio
+
+logger = logging.getLogger('dcmpacs')
+
+# Storage SOP classes accepted from the node (MR, CT, PET, secondary capture and raw data)
+# C-GET needs one presentation context per class, and an association is limited to 128
+PACS_STORAGE_CLASSES = ['1.2.840.10008.5.1.4.1.1.4',      # MR Image Storage
+                        '1.2.840.10008.5.1.4.1.1.4.1',    # Enhanced MR Image Storage
+                        '1.2.840.10008.5.1.4.1.1.4.2',    # MR Spectroscopy Storage
+                        '1.2.840.10008.5.1.4.1.1.4.3',    # Enhanced MR Color Image Storage
+                        '1.2.840.10008.5.1.4.1.1.2',      # CT Image Storage
+                        '1.2.840.10008.5.1.4.1.1.128',    # PET Image Storage
+                        '1.2.840.10008.5.1.4.1.1.7',      # Secondary Capture Image Storage
+                        '1.2.840.10008.5.1.4.1.1.66']     # Raw Data Storage
+
+# C-FIND pending statuses
+PACS_PENDING = (0xFF00, 0xFF01)
+
+# C-GET and C-MOVE final statuses for a complete (0x0000) or partially complete (0xB000) retrieval
+PACS_COMPLETE = (0x0000, 0xB000)
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Retrieve subject DICOM series from a DICOM node')
+    parser.add_argument('--host', required=True, help='DICOM node hostname or IP address')
+    parser.add_argument('--port', type=int, required=True, help='DICOM node port')
+    parser.add_argument('--aec', required=True, help='DICOM node AE title')
+    parser.add_argument('--aet', default='DCMPACS', help='AE title of this script [DCMPACS]')
+    parser.add_argument('-s', '--subjects', help='File listing PatientID [SID] on each line')
+    parser.add_argument('--patient', action='append', default=[], help='PatientID to retrieve (repeatable)')
+    parser.add_argument('-o', '--outdir', default='dicom', help='DICOM root directory for dcm2bids [dicom]')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of concurrent associations [4]')
+    parser.add_argument('--method', default='get', choices=['get', 'move'],
+                        help='Retrieve with C-GET or with C-MOVE to a local storage SCP [get]')
+    parser.add_argument('--store-port', type=int, default=11112,
+                        help='Local storage SCP port for C-MOVE [11112]')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='List the series that would be retrieved without retrieving them')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='Verbose output')
+
+    # Parse command line arguments
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(message)s', stream=sys.stdout)
+
+    # pynetdicom logs every request and response at INFO
+    logging.getLogger('pynetdicom').setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    # Fail early if pynetdicom is missing
+    pacs_import()
+
+    # PatientID and SID pairs
+    subjects = [(pid, pid) for pid in args.patient]
+    if args.subjects:
+        subjects += pacs_load_subjects(args.subjects)
+
+    if not subjects:
+        logger.error('* No subjects given - use --subjects or --patient')
+        sys.exit(1)
+
+    node = {'host': args.host, 'port': args.port, 'aec': args.aec, 'aet': args.aet}
+
+    dcm_root_dir = os.path.realpath(args.outdir)
+    incoming_dir = os.path.join(dcm_root_dir, '.incoming')
+    os.makedirs(incoming_dir, exist_ok=True)
+
+    # Series completed by previous runs
+    log = pacs_open_log(os.path.join(dcm_root_dir, 'Retrieval_Log.jsonl'))
+
+    logger.info('Querying %s@%s:%d for %d subjects' % (args.aec, args.host, args.port, len(subjects)))
+
+    # Find every series for every subject, one association per subject
+    series = []
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {pool.submit(pacs_find_series, node, pid): (pid, SID) for pid, SID in subjects}
+        for future in as_completed(futures):
+            pid, SID = futures[future]
+            try:
+                found = future.result()
+            except Exception as err:
+                logger.warning('* C-FIND failed for %s : %s' % (pid, err))
+                continue
+            for s in found:
+                s['SID'] = SID
+            series.extend(found)
+            logger.info('  %s : %d series' % (pid, len(found)))
+
+    # Skip series in the retrieval log or already present in the DICOM directory
+    todo = []
+    series.sort(key=lambda s: (s['SID'], s['Session'], s['SeriesNumber']))
+    for s in pacs_series_dirs(series, dcm_root_dir):
+        if s['SeriesInstanceUID'] in log['done'] or pacs_dir_series_uid(s['Dir']) == s['SeriesInstanceUID']:
+            logger.debug('  Skipping %s - already retrieved' % os.path.relpath(s['Dir'], dcm_root_dir))
+        else:
+            todo.append(s)
+
+    logger.info('%d series found, %d to retrieve' % (len(series), len(todo)))
+
+    if args.dry_run:
+        for s in todo:
+            logger.info('  %s' % os.path.relpath(s['Dir'], dcm_root_dir))
+        sys.exit(0)
+
+    # Local storage SCP receiving C-MOVE sub-operations
+    scp = pacs_start_store_scp(node, args.store_port, incoming_dir) if args.method == 'move' else None
+
+    n_failed = 0
+
+    try:
+
+        # Retrieve series concurrently, each on its own association
+        with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+
+            futures = {pool.submit(pacs_retrieve_series, node, s, incoming_dir, args.method): s for s in todo}
+
+            for future in as_completed(futures):
+
+                s = futures[future]
+                rel_dir = os.path.relpath(s['Dir'], dcm_root_dir)
+
+                try:
+                    n_files = future.result()
+                except Exception as err:
+                    logger.warning('* %s : retrieval failed - %s' % (rel_dir, err))
+                    n_failed += 1
+                    continue
+
+                logger.info('  %s : %d files' % (rel_dir, n_files))
+                pacs_log_record(log, s, n_files)
+
+    finally:
+        if scp:
+            scp.shutdown()
+        log['fd'].close()
+
+    logger.info('')
+    logger.info('Retrieved %d series, %d failed' % (len(todo) - n_failed, n_failed))
+
+    # Clean exit
+    sys.exit(1 if n_failed else 0)
+
+
+def pacs_import():
+    """
+    Import pynetdicom on first use
+    - pynetdicom is only needed by this script, so it is not a dependency of the converters
+
+    :return pynetdicom: module
+    """
+
+    try:
+        import pynetdicom
+    except ImportError:
+        logger.error('* dcmpacs.py requires pynetdicom (pip install pynetdicom)')
+        sys.exit(1)
+
+    return pynetdicom
+
+
+def pacs_load_subjects(subjects_fname):
+    """
+    Read PatientID and optional SID pairs from a text file
+    - Blank lines and lines starting with # are ignored
+
+    :param subjects_fname: str
+        Subjects file with PatientID [SID] on each line
+    :return subjects: list
+        (PatientID, SID) tuples
+    """
+
+    subjects = []
+
+    with open(subjects_fname, 'r') as fd:
+        for line in fd:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            subjects.append((fields[0], fields[1] if len(fields) > 1 else fields[0]))
+
+    return subjects
+
+
+def pacs_open_log(log_fname):
+    """
+    Open the retrieval log, loading series completed by previous runs
+    - One JSON object per line for each completed series
+
+    :param log_fname: str
+        Retrieval log filename (JSON lines)
+    :return log: dictionary
+        'fd' : open log file descriptor
+        'done' : set of completed SeriesInstanceUIDs
+        'lock' : lock for records from retrieval threads
+    """
+
+    done = set()
+
+    if os.path.isfile(log_fname):
+        with open(log_fname, 'r') as fd:
+            for line in fd:
+                try:
+                    done.add(json.loads(line)['SeriesInstanceUID'])
+                except (ValueError, KeyError):
+                    # Ignore a final line truncated by an interruption
+                    continue
+
+    return {'fd': open(log_fname, 'a'), 'done': done, 'lock': threading.Lock()}
+
+
+def pacs_log_record(log, series, n_files):
+    """
+    Record a completed series in the retrieval log
+
+    :param log: dictionary
+        Retrieval log from pacs_open_log
+    :param series: dictionary
+        Series from pacs_find_series
+    :param n_files: int
+        Number of files received
+    :return:
+    """
+
+    entry = {'SeriesInstanceUID': series['SeriesInstanceUID'],
+             'SID': series['SID'],
+             'Session': series['Session'],
+             'Dir': series['Dir'],
+             'Files': n_files,
+             'Retrieved': datetime.now().isoformat()}
+
+    with log['lock']:
+        log['done'].add(series['SeriesInstanceUID'])
+        log['fd'].write(json.dumps(entry) + '\n')
+        log['fd'].flush()
+        os.fsync(log['fd'].fileno())
+
+
+def pacs_associate(node, contexts, **kwargs):
+    """
+    Open an association with the DICOM node
+
+    :param node: dictionary
+        'host', 'port', 'aec' and 'aet'
+    :param contexts: list
+        Abstract syntax UIDs to request
+    :param kwargs:
+        Passed to AE.associate (eg ext_neg, evt_handlers)
+    :return assoc: pynetdicom Association
+        Raises RuntimeError if the association is rejected or aborted
+    """
+
+    pynetdicom = pacs_import()
+
+    ae = pynetdicom.AE(ae_title=node['aet'])
+    for context in contexts:
+        ae.add_requested_context(context)
+
+    assoc = ae.associate(node['host'], node['port'], ae_title=node['aec'], **kwargs)
+
+    if not assoc.is_established:
+        raise RuntimeError('association with %s@%s:%d rejected or aborted' %
+                           (node['aec'], node['host'], node['port']))
+
+    return assoc
+
+
+def pacs_find_series(node, patient_id):
+    """
+    Find all studies and series for a patient with Study Root C-FIND queries
+
+    :param node: dictionary
+        'host', 'port', 'aec' and 'aet'
+    :param patient_id: str
+        PatientID
+    :return series: list
+        One dictionary per series with the keys PatientID, StudyInstanceUID, Session,
+        SeriesInstanceUID, SeriesNumber and SeriesDescription
+    """
+
+    from pydicom.dataset import Dataset
+    from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind as FindModel
+
+    assoc = pacs_associate(node, [FindModel])
+
+    try:
+
+        query = Dataset()
+        query.QueryRetrieveLevel = 'STUDY'
+        query.PatientID = patient_id
+        query.StudyInstanceUID = ''
+        query.StudyDate = ''
+        query.StudyTime = ''
+
+        studies = [(str(ds.StudyInstanceUID), str(ds.get('StudyDate', '')), str(ds.get('StudyTime', '')))
+                   for ds in pacs_c_find(assoc, query, FindModel)]
+
+        series = []
+
+        for study_uid, session in pacs_session_names(studies):
+
+            query = Dataset()
+            query.QueryRetrieveLevel = 'SERIES'
+            query.PatientID = patient_id
+            query.StudyInstanceUID = study_uid
+            query.SeriesInstanceUID = ''
+            query.SeriesNumber = ''
+            query.SeriesDescription = ''
+
+            for ds in pacs_c_find(assoc, query, FindModel):
+                series.append({'PatientID': patient_id,
+                               'StudyInstanceUID': study_uid,
+                               'Session': session,
+                               'SeriesInstanceUID': str(ds.SeriesInstanceUID),
+                               'SeriesNumber': int(ds.get('SeriesNumber', 0) or 0),
+                               'SeriesDescription': str(ds.get('SeriesDescription', ''))})
+
+    finally:
+        assoc.release()
+
+    return series
+
+
+def pacs_c_find(assoc, query, model):
+    """
+    Matching identifiers from a C-FIND request
+
+    :param assoc: pynetdicom Association
+    :param query: pydicom Dataset
+    :param model: Query/Retrieve information model UID
+    :return: generator of pydicom Datasets
+    """
+
+    for status, identifier in assoc.send_c_find(query, model):
+
+        if not status:
+            raise RuntimeError('C-FIND timed out or was aborted')
+
+        if status.Status in PACS_PENDING:
+            if identifier is not None:
+                yield identifier
+        elif status.Status != 0x0000:
+            raise RuntimeError('C-FIND failed with status 0x%04X' % status.Status)
+
+
+def pacs_session_names(studies):
+    """
+    Session directory names for a patient's studies
+    - The study date (YYYYMMDD), with _2, _3 ... added for later studies on the same date
+
+    :param studies: list
+        (StudyInstanceUID, StudyDate, StudyTime) tuples
+    :return: list of (StudyInstanceUID, session name) tuples in study date and time order
+    """
+
+    names = []
+    n_per_date = dict()
+
+    for study_uid, study_date, study_time in sorted(studies, key=lambda s: (s[1], s[2])):
+
+        date = study_date or 'unknown'
+        n_per_date[date] = n_per_date.get(date, 0) + 1
+
+        names.append((study_uid, date if n_per_date[date] == 1 else '%s_%d' % (date, n_per_date[date])))
+
+    return names
+
+
+def pacs_series_dir_name(series):
+    """
+    Series directory name within a session (eg 5_rsBOLD_MB8)
+
+    :param series: dictionary
+        Series from pacs_find_series
+    :return: str
+    """
+
+    desc = re.sub(r'[^A-Za-z0-9_.+-]', '_', series['SeriesDescription'].strip()) or 'unnamed'
+
+    return '%d_%s' % (series['SeriesNumber'], desc)
+
+
+def pacs_series_dirs(series, dcm_root_dir):
+    """
+    Set the destination directory of each series in 'Dir'
+    - <SID>/<Session>/<SerNo>_<Desc> where that name is unique within the session
+    - A short SeriesInstanceUID hash is appended to the name (eg 5_rsBOLD_3f2a9c1e) when several series
+      in a session share a number and description, or when the plain name already holds another series
+
+    :param series: list
+        Series from pacs_find_series with 'SID' added
+    :param dcm_root_dir: str
+        DICOM root directory
+    :return series: list
+        Same list, with 'Dir' set for every series
+    """
+
+    shared = dict()
+    for s in series:
+        shared.setdefault((s['SID'], s['Session'], pacs_series_dir_name(s)), []).append(s)
+
+    for (SID, session, dir_name), named in shared.items():
+
+        for s in named:
+
+            s['Dir'] = os.path.join(dcm_root_dir, SID, session, dir_name)
+
+            dir_uid = pacs_dir_series_uid(s['Dir'])
+
+            if len(named) > 1 or dir_uid not in (None, s['SeriesInstanceUID']):
+                uid_hash = hashlib.sha1(s['SeriesInstanceUID'].encode()).hexdigest()[:8]
+                s['Dir'] = '%s_%s' % (s['Dir'], uid_hash)
+
+    return series
+
+
+def pacs_dir_series_uid(ser_dir):
+    """
+    SeriesInstanceUID of the DICOM files in a series directory
+
+    :param ser_dir: str
+        Series directory
+    :return: str
+        None if the directory doesn't exist or contains no readable DICOM file
+    """
+
+    if not os.path.isdir(ser_dir):
+        return None
+
+    hdr = dcmio.first_header(ser_dir, tags=['SeriesInstanceUID'])
+
+    return str(hdr['SeriesInstanceUID']) if hdr is not None and 'SeriesInstanceUID' in hdr else None
+
+
+def pacs_retrieve_series(node, series, incoming_dir, method='get'):
+    """
+    Retrieve one series and move it into the DICOM directory once complete
+    - Files are received into <incoming>/<SeriesInstanceUID>/ then the directory is renamed into place
+
+    :param node: dictionary
+        'host', 'port', 'aec' and 'aet'
+    :param series: dictionary
+        Series from pacs_find_series with the destination directory in 'Dir'
+    :param incoming_dir: str
+        Staging directory on the same filesystem as the DICOM directory
+    :param method: str
+        'get' for C-GET on this association, 'move' for C-MOVE to the local storage SCP
+    :return n_files: int
+        Number of files received
+    """
+
+    pynetdicom = pacs_import()
+    from pydicom.dataset import Dataset
+    from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelGet as GetModel
+    from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelMove as MoveModel
+
+    stage_dir = os.path.join(incoming_dir, series['SeriesInstanceUID'])
+
+    # Discard anything left by an interrupted attempt
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    os.makedirs(stage_dir)
+
+    query = Dataset()
+    query.QueryRetrieveLevel = 'SERIES'
+    query.PatientID = series['PatientID']
+    query.StudyInstanceUID = series['StudyInstanceUID']
+    query.SeriesInstanceUID = series['SeriesInstanceUID']
+
+    if method == 'get':
+
+        # C-GET returns the images on the same association, with this script as the storage SCP
+        roles = [pynetdicom.build_role(uid, scp_role=True) for uid in PACS_STORAGE_CLASSES]
+        handlers = [(pynetdicom.evt.EVT_C_STORE, pacs_handle_store, [incoming_dir])]
+        assoc = pacs_associate(node, [GetModel] + PACS_STORAGE_CLASSES, ext_neg=roles, evt_handlers=handlers)
+        responses = assoc.send_c_get(query, GetModel)
+
+    else:
+
+        # C-MOVE sends the images to the local storage SCP over separate associations
+        assoc = pacs_associate(node, [MoveModel])
+        responses = assoc.send_c_move(query, node['aet'], MoveModel)
+
+    try:
+        final = None
+        for status, identifier in responses:
+            if not status:
+                raise RuntimeError('retrieval timed out or was aborted')
+            final = status.Status
+    finally:
+        assoc.release()
+
+    if final not in PACS_COMPLETE:
+        raise RuntimeError('final status 0x%04X' % final if final is not None else 'no response')
+
+    n_files = len(os.listdir(stage_dir))
+
+    if n_files == 0:
+        raise RuntimeError('no files received')
+
+    # Publish the complete series in the dcm2bids layout
+    os.makedirs(os.path.dirname(series['Dir']), exist_ok=True)
+
+    try:
+        os.replace(stage_dir, series['Dir'])
+    except OSError as err:
+        # Destination created since the series was queried - don't leave the files in staging
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        raise RuntimeError('could not move series into place - %s' % err)
+
+    return n_files
+
+
+def pacs_handle_store(event, incoming_dir):
+    """
+    C-STORE handler writing each received image to its series staging directory
+    - The encoded dataset is written as received, after a Part 10 preamble and file meta group,
+      so images are never decoded and re-encoded
+
+    :param event: pynetdicom Event
+    :param incoming_dir: str
+        Staging directory containing one subdirectory per SeriesInstanceUID
+    :return status: int
+    """
+
+    from pydicom.filewriter import write_file_meta_info
+
+    stage_dir = os.path.join(incoming_dir, str(event.dataset.SeriesInstanceUID))
+
+    # Unsolicited or late images for a series that isn't being retrieved
+    if not os.path.isdir(stage_dir):
+        return 0xA700
+
+    fname = os.path.join(stage_dir, str(event.request.AffectedSOPInstanceUID) + '.dcm')
+
+    with open(fname, 'wb') as fd:
+        fd.write(b'\x00' * 128 + b'DICM')
+        write_file_meta_info(fd, event.file_meta, enforce_standard=True)
+        fd.write(event.request.DataSet.getvalue())
+
+    return 0x0000
+
+
+def pacs_start_store_scp(node, store_port, incoming_dir):
+    """
+    Start a background storage SCP for C-MOVE retrievals
+    - The DICOM node must know this script's AE title, host and store port as a move destination
+
+    :param node: dictionary
+        'host', 'port', 'aec' and 'aet'
+    :param store_port: int
+        Local port for incoming associations
+    :param incoming_dir: str
+        Staging directory containing one subdirectory per SeriesInstanceUID
+    :return scp: pynetdicom server
+        Stop with scp.shutdown()
+    """
+
+    pynetdicom = pacs_import()
+
+    ae = pynetdicom.AE(ae_title=node['aet'])
+    for uid in PACS_STORAGE_CLASSES:
+        ae.add_supported_context(uid)
+
+    logger.info('Storage SCP %s listening on port %d' % (node['aet'], store_port))
+
+    return ae.start_server(('', store_port), block=False,
+                           evt_handlers=[(pynetdicom.evt.EVT_C_STORE, pacs_handle_store, [incoming_dir])])
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Install the bidskit tools with console entry points
+
+% pip install .
+
+installs dcm2bids, dcm2ndar, dcmhdr, dcmpacs and the bidskit dispatcher (see bidskit/__main__.py).
+dcm2niix must be installed separately.
+"""
+
+from setuptools import setup
+
+setup(
+    name='bidskit',
+    version='1.0.0',
+    description='Convert DICOM data to BIDS and NDAR formats',
+    license='MIT',
+    python_requires='>=3.7',
+    packages=['bidskit'],
+    py_modules=['dcm2bids', 'dcm2ndar', 'dcmhdr', 'dcmpacs', 'dcmconv', 'dcmio'],
+    install_requires=['pydicom'],
+    extras_require={'ndar': ['nibabel', 'python-dateutil'], 'pacs': ['pynetdicom']},
+    entry_points={
+        'console_scripts': [
+            'bidskit = bidskit.__main__:main',
+            'dcm2bids = dcm2bids:main',
+            'dcm2ndar = dcm2ndar:main',
+            'dcmhdr = dcmhdr:main',
+            'dcmpacs = dcmpacs:main',
+        ],
+    },
+)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Duplicate DICOM detection and staging tests for dcm2bids
+
+Writes small synthetic DICOM sessions into a temporary directory and checks which
+files bids_dedup_session stages for dcm2niix.
+
+Skipped if pydicom is not installed.
+
+Usage
+----
+% python -m pytest tests
+% python tests/test_dcm2bids_dedup.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+try:
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+    HAVE_PYDICOM = True
+except ImportError:
+    HAVE_PYDICOM = False
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import dcm2bids
+
+
+def write_image(fname, series_uid, ser_no, inst_no, sop_uid=None, desc='rsBOLD'):
+    """
+    Write a minimal single-frame MR image header
+
+    :return sop_uid: str
+    """
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = sop_uid or generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = ser_no
+    ds.SeriesDescription = desc
+    ds.ScanningSequence = 'EP' if 'BOLD' in desc else 'GR'
+    ds.Rows, ds.Columns = 64, 64
+    ds.InstanceNumber = inst_no
+    ds.AcquisitionDate = '20240131'
+    ds.AcquisitionTime = '1200%02d' % inst_no
+
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+    try:
+        ds.save_as(fname, enforce_file_format=True)
+    except TypeError:
+        # pydicom 2.x
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.save_as(fname, write_like_original=False)
+
+    return ds.SOPInstanceUID
+
+
+@unittest.skipUnless(HAVE_PYDICOM, 'pydicom is required')
+class TestDedupStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='dcm2bids_')
+        self.dcm_dir = os.path.join(self.tmp_dir, 'dicom', 'S01', 'first')
+        self.stage_dir = os.path.join(self.tmp_dir, 'work', 'dedup', 'sub-S01', 'ses-first')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def staged(self):
+        return sorted(os.path.relpath(os.path.join(path, f), self.stage_dir)
+                      for path, _, fnames in os.walk(self.stage_dir) for f in fnames)
+
+    def test_no_duplicates(self):
+
+        uid = generate_uid()
+        for inst_no in (1, 2):
+            write_image(os.path.join(self.dcm_dir, '5', 'IM%04d.dcm' % inst_no), uid, 5, inst_no)
+
+        conv_dir, skipped = dcm2bids.bids_dedup_session(self.dcm_dir, self.stage_dir, 'S01_first')
+
+        self.assertEqual(conv_dir, self.dcm_dir)
+        self.assertEqual(skipped, [])
+        self.assertFalse(os.path.exists(self.stage_dir))
+
+    def test_repush_keeps_files_without_preamble(self):
+
+        uid = generate_uid()
+        sop = write_image(os.path.join(self.dcm_dir, '5', 'IM0001.dcm'), uid, 5, 1)
+        write_image(os.path.join(self.dcm_dir, '5', 'IM0002.dcm'), uid, 5, 2)
+
+        # Same image pushed again
+        write_image(os.path.join(self.dcm_dir, 'repush', 'IM0001.dcm'), uid, 5, 1, sop_uid=sop)
+
+        # Another series exported without the 128 byte preamble and DICM prefix
+        raw_fname = os.path.join(self.dcm_dir, '7', 'IM0001')
+        write_image(raw_fname, generate_uid(), 7, 1)
+        with open(raw_fname, 'rb') as fd:
+            raw = fd.read()[132:]
+        with open(raw_fname, 'wb') as fd:
+            fd.write(raw)
+
+        conv_dir, skipped = dcm2bids.bids_dedup_session(self.dcm_dir, self.stage_dir, 'S01_first')
+
+        self.assertEqual(conv_dir, self.stage_dir)
+        self.assertEqual([row['files_skipped'] for row in skipped], [1])
+        self.assertEqual(self.staged(), ['5/IM0001.dcm', '5/IM0002.dcm', '7/IM0001'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Header-only protocol discovery tests for dcm2bids (--discover)
+
+Writes small synthetic DICOM sessions for two subjects and checks the protocols
+found by bids_discover_protocols and written by dcm2bids.py --discover.
+
+Skipped if pydicom is not installed.
+
+Usage
+----
+% python -m pytest tests
+% python tests/test_dcm2bids_discover.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_dcm2bids_dedup import HAVE_PYDICOM, REPO_DIR, write_image
+
+import dcm2bids
+
+if HAVE_PYDICOM:
+    from pydicom.uid import generate_uid
+
+# (SID, SES, SeriesNumber, SeriesDescription, number of images) for each series
+SERIES = [('S01', 'first', 2, 'T1 MPRAGE', 2),
+          ('S01', 'first', 5, 'rsBOLD', 2),
+          ('S01', 'first', 7, 'rsBOLD', 1),
+          ('S02', 'first', 3, 'rsBOLD', 1),
+          ('S02', 'second', 2, 'T1 MPRAGE', 1)]
+
+
+@unittest.skipUnless(HAVE_PYDICOM, 'pydicom is required')
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='dcm2bids_')
+        self.dcm_root_dir = os.path.join(self.tmp_dir, 'dicom')
+
+        for SID, SES, ser_no, desc, n_images in SERIES:
+            uid = generate_uid()
+            for inst_no in range(1, n_images + 1):
+                fname = os.path.join(self.dcm_root_dir, SID, SES, '%d' % ser_no, 'IM%04d.dcm' % inst_no)
+                write_image(fname, uid, ser_no, inst_no, desc=desc)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_discover_protocols(self):
+
+        sessions = [('S01', 'first', os.path.join(self.dcm_root_dir, 'S01', 'first')),
+                    ('S02', 'first', os.path.join(self.dcm_root_dir, 'S02', 'first')),
+                    ('S02', 'second', os.path.join(self.dcm_root_dir, 'S02', 'second'))]
+
+        protocols = dcm2bids.bids_discover_protocols(sessions)
+
+        # Descriptions are sanitized as in dcm2niix filenames, series are counted once each
+        self.assertEqual(list(protocols), ['T1_MPRAGE', 'rsBOLD'])
+        self.assertEqual((protocols['T1_MPRAGE']['n_series'], protocols['T1_MPRAGE']['subjects']), (2, ['S01', 'S02']))
+        self.assertEqual((protocols['rsBOLD']['n_series'], protocols['rsBOLD']['subjects']), (3, ['S01', 'S02']))
+        self.assertEqual((protocols['rsBOLD']['sequence'], protocols['rsBOLD']['dimensions']), ('EP', '64x64'))
+
+        discovery_tsv = os.path.join(self.tmp_dir, 'Protocol_Discovery.tsv')
+        dcm2bids.bids_write_discovery(discovery_tsv, protocols, n_examples=1)
+
+        with open(discovery_tsv) as fd:
+            lines = [line.rstrip('\n').split('\t') for line in fd]
+
+        self.assertEqual(lines[0][0], 'ser_desc')
+        self.assertEqual(lines[2], ['rsBOLD', 'EP', '', '64x64', '3', '2', 'S01'])
+
+    def test_discover_command(self):
+
+        # First pass without dcm2niix : translator template and discovery table only
+        out_dir = os.path.join(self.tmp_dir, 'source')
+        proc = subprocess.run([sys.executable, os.path.join(REPO_DIR, 'dcm2bids.py'),
+                               '-i', self.dcm_root_dir, '-o', out_dir, '--discover'],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                              timeout=120)
+
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+
+        deriv_dir = os.path.join(self.tmp_dir, 'derivatives', 'conversion')
+        with open(os.path.join(deriv_dir, 'Protocol_Translator.json')) as fd:
+            prot_dict = json.load(fd)
+
+        self.assertEqual(sorted(prot_dict), ['T1_MPRAGE', 'rsBOLD'])
+        self.assertTrue(all(entry[0] == 'EXCLUDE_BIDS_Directory' for entry in prot_dict.values()))
+        self.assertTrue(os.path.isfile(os.path.join(deriv_dir, 'Protocol_Discovery.tsv')))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'work', 'conversion', 'sub-S01')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Pass 2 placement tests for dcm2bids
+
+Places a session of fake dcm2niix outputs (see test_dcm2bids_plan.py) into a
+temporary BIDS source directory with bids_run_conversion.
+
+Usage
+----
+% python -m pytest tests
+% python tests/test_dcm2bids_place.py
+"""
+
+import os
+import sys
+import json
+import hashlib
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_dcm2bids_plan import PlanTestCase, PROT_DICT, SESSION_NII, SID, SES
+
+import dcm2bids
+
+SESSION_KEY = 'sub-S01/ses-first'
+
+
+class PlaceTestCase(PlanTestCase):
+    """
+    Typical session of fake dcm2niix outputs with non-empty image data
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.add_session()
+
+        # Distinct image contents so that copies can be checked
+        for name in SESSION_NII:
+            with open(os.path.join(self.conv_dir, name), 'wb') as fd:
+                fd.write(name.encode())
+
+    def run_conversion(self, prot_dict=PROT_DICT, **kwargs):
+        dcm2bids.bids_run_conversion(self.conv_dir, False, prot_dict, self.src_dir, SID, SES,
+                                     session_key=SESSION_KEY, **kwargs)
+
+    def placed(self):
+        """
+        Files in the BIDS source directory, relative to it
+
+        :return: sorted list
+        """
+
+        return sorted(os.path.relpath(os.path.join(path, f), self.src_dir)
+                      for path, _, fnames in os.walk(self.src_dir) for f in fnames)
+
+
+# Files placed for the typical session
+SESSION_PLACED = sorted([bids_name for bids_name in SESSION_NII.values() if bids_name] +
+                        ['anat/sub-S01_ses-first_T1w.json',
+                         'func/sub-S01_ses-first_task-rest_run-01_bold.json',
+                         'func/sub-S01_ses-first_task-rest_run-01_events.tsv',
+                         'func/sub-S01_ses-first_task-rest_run-02_bold.json',
+                         'func/sub-S01_ses-first_task-rest_run-02_events.tsv',
+                         'fmap/sub-S01_ses-first_acq-rest_phasediff.json',
+                         'dwi/sub-S01_ses-first_dwi.json',
+                         'dwi/sub-S01_ses-first_dwi.bval',
+                         'dwi/sub-S01_ses-first_dwi.bvec'])
+
+
+class TestPlacement(PlaceTestCase):
+
+    def test_concurrent_placement(self):
+
+        self.run_conversion(io_threads=4)
+
+        self.assertEqual(self.placed(), SESSION_PLACED)
+
+        # Images copied unchanged, working files kept
+        for name, bids_name in SESSION_NII.items():
+            if bids_name:
+                with open(os.path.join(self.src_dir, bids_name), 'rb') as fd:
+                    self.assertEqual(fd.read(), name.encode())
+                self.assertTrue(os.path.isfile(os.path.join(self.conv_dir, name)))
+
+        # Adjusted sidecars
+        with open(os.path.join(self.src_dir, 'fmap', 'sub-S01_ses-first_acq-rest_phasediff.json')) as fd:
+            info = json.load(fd)
+        self.assertEqual((info['EchoTime1'], info['EchoTime2']), (0.00492, 0.00738))
+        self.assertEqual(len(info['IntendedFor']), 2)
+
+    def test_direct(self):
+
+        # Image data is moved, sidecars are kept in the working directory for planning
+        self.run_conversion(io_threads=4, direct=True)
+
+        self.assertEqual(self.placed(), SESSION_PLACED)
+        self.assertFalse(os.path.exists(os.path.join(self.conv_dir, 'S01--rsBOLD--EP--5.nii.gz')))
+        self.assertTrue(os.path.isfile(os.path.join(self.conv_dir, 'S01--rsBOLD--EP--5.json')))
+        self.assertFalse(os.path.exists(os.path.join(self.conv_dir, 'S01--DTI--EP--10.bval')))
+
+        # Excluded images are left alone
+        self.assertTrue(os.path.isfile(os.path.join(self.conv_dir, 'S01--Localizer--GR--1.nii.gz')))
+
+        # Rerunning after a move only rewrites sidecars
+        self.run_conversion(io_threads=4, direct=True, overwrite=True)
+        self.assertEqual(self.placed(), SESSION_PLACED)
+
+
+class TestJournal(PlaceTestCase):
+
+    def open_journal(self):
+        journal = dcm2bids.bids_open_journal(os.path.join(self.tmp_dir, 'Conversion_Journal.jsonl'))
+        self.addCleanup(journal['fd'].close)
+        return journal
+
+    def test_resume(self):
+
+        # Interrupted run : one image placed and journalled
+        journal = self.open_journal()
+        dcm2bids.bids_journal_record(journal, SESSION_KEY, 'S01--T1_MPRAGE--GR_IR--2.nii.gz')
+        journal['fd'].close()
+
+        journal = self.open_journal()
+        self.assertEqual(journal['done'], {SESSION_KEY: {'S01--T1_MPRAGE--GR_IR--2.nii.gz'}})
+
+        self.run_conversion(journal=journal)
+
+        # The journalled image and its sidecar are not placed again, everything else is and the session completes
+        self.assertNotIn('anat/sub-S01_ses-first_T1w.nii.gz', self.placed())
+        self.assertEqual(len(self.placed()), len(SESSION_PLACED) - 2)
+        self.assertIn('complete', journal['done'][SESSION_KEY])
+
+        # A later run skips the completed session
+        journal['fd'].close()
+        journal = self.open_journal()
+        with self.assertLogs('dcm2bids', 'INFO') as logs:
+            self.run_conversion(journal=journal)
+        self.assertIn('completed by a previous run', '\n'.join(logs.output))
+
+    def test_truncated_line(self):
+
+        # A final line cut short by an interruption is ignored
+        journal = self.open_journal()
+        dcm2bids.bids_journal_record(journal, SESSION_KEY, 'S01--DTI--EP--10.nii.gz')
+        journal['fd'].write('{"session": "sub-S01/ses-fir')
+        journal['fd'].close()
+
+        self.assertEqual(self.open_journal()['done'], {SESSION_KEY: {'S01--DTI--EP--10.nii.gz'}})
+
+    def test_translator_change(self):
+
+        journal = self.open_journal()
+        self.run_conversion(journal=journal)
+        journal['fd'].close()
+
+        # Unchanged translator : nothing is reset
+        journal = self.open_journal()
+        dcm2bids.bids_check_journal_translator(journal, PROT_DICT)
+        self.assertIn('complete', journal['done'][SESSION_KEY])
+        journal['fd'].close()
+
+        # Translator entries for other protocols don't affect the session
+        journal = self.open_journal()
+        dcm2bids.bids_check_journal_translator(journal, dict(PROT_DICT, Unused=['anat', 'T2w', 'UNASSIGNED']))
+        self.assertIn('complete', journal['done'][SESSION_KEY])
+        journal['fd'].close()
+
+        # Including the localizer resets the session, which is then placed again
+        prot_dict = dict(PROT_DICT, Localizer=['anat', 'acq-loc_T1w', 'UNASSIGNED'])
+
+        journal = self.open_journal()
+        with self.assertLogs('dcm2bids', 'WARNING'):
+            dcm2bids.bids_check_journal_translator(journal, prot_dict)
+        self.assertNotIn(SESSION_KEY, journal['done'])
+
+        self.run_conversion(prot_dict, journal=journal)
+        self.assertIn('anat/sub-S01_ses-first_acq-loc_T1w.nii.gz', self.placed())
+        journal['fd'].close()
+
+        # Reopening replays the reset and the new completion, whose translator record matches
+        journal = self.open_journal()
+        self.assertIn('complete', journal['done'][SESSION_KEY])
+        dcm2bids.bids_check_journal_translator(journal, prot_dict)
+        self.assertIn('complete', journal['done'][SESSION_KEY])
+
+
+class TestReclaim(PlaceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = os.path.dirname(os.path.dirname(self.conv_dir))
+        self.journal = dcm2bids.bids_open_journal(os.path.join(self.work_dir, 'Conversion_Journal.jsonl'))
+        self.addCleanup(self.journal['fd'].close)
+
+    def work_files(self):
+        return sorted(os.listdir(self.conv_dir))
+
+    def test_verified(self):
+
+        reclaim = dcm2bids.bids_init_reclaim('verified', self.work_dir)
+        self.run_conversion(journal=self.journal, reclaim=reclaim)
+
+        self.assertEqual(self.placed(), SESSION_PLACED)
+        self.assertEqual(self.work_files(), [dcm2bids.BIDS_RECLAIM_MARKER])
+
+    def test_sidecars(self):
+
+        reclaim = dcm2bids.bids_init_reclaim('sidecars', self.work_dir)
+        self.run_conversion(journal=self.journal, reclaim=reclaim)
+
+        # Placed image data is deleted. Sidecars and excluded images are kept
+        work_files = self.work_files()
+        self.assertIn(dcm2bids.BIDS_RECLAIM_MARKER, work_files)
+        self.assertIn('S01--Localizer--GR--1.nii.gz', work_files)
+        self.assertIn('S01--rsBOLD--EP--5.json', work_files)
+        self.assertNotIn('S01--rsBOLD--EP--5.nii.gz', work_files)
+        self.assertNotIn('S01--DTI--EP--10.bval', work_files)
+
+        # Sessions are still planned from the remaining sidecars
+        plan = self.plan(PROT_DICT)
+        self.assertEqual({name: self.bids_name(image) for name, image in plan.items()}, SESSION_NII)
+
+    def test_unverified(self):
+
+        # A placed file that has gone missing blocks reclamation
+        self.run_conversion(journal=self.journal)
+        os.remove(os.path.join(self.src_dir, 'anat', 'sub-S01_ses-first_T1w.nii.gz'))
+
+        reclaim = dcm2bids.bids_init_reclaim('verified', self.work_dir)
+        plan = dcm2bids.bids_plan_session(self.conv_dir, PROT_DICT, self.src_dir, SID, SES)
+        with self.assertLogs('dcm2bids', 'WARNING'):
+            n_bytes = dcm2bids.bids_reclaim_session(reclaim, self.journal, SESSION_KEY, self.conv_dir, plan)
+
+        self.assertEqual(n_bytes, 0)
+        self.assertNotIn(dcm2bids.BIDS_RECLAIM_MARKER, self.work_files())
+
+    def test_completed_earlier(self):
+
+        # Placed without --reclaim, then reclaimed by a later run that skips the session
+        self.run_conversion(journal=self.journal)
+        self.assertNotIn(dcm2bids.BIDS_RECLAIM_MARKER, self.work_files())
+
+        reclaim = dcm2bids.bids_init_reclaim('verified', self.work_dir)
+        metrics = dcm2bids.bids_init_metrics(SID, SES, False)
+        self.run_conversion(journal=self.journal, reclaim=reclaim, metrics=metrics)
+
+        self.assertEqual(self.work_files(), [dcm2bids.BIDS_RECLAIM_MARKER])
+        self.assertGreater(metrics['bytes_reclaimed'], 0)
+
+    def test_lru(self):
+
+        # Under the cap nothing is deleted
+        reclaim = dcm2bids.bids_init_reclaim('lru', self.work_dir, work_cap=1.0)
+        self.run_conversion(journal=self.journal, reclaim=reclaim)
+        self.assertNotIn(dcm2bids.BIDS_RECLAIM_MARKER, self.work_files())
+
+        # Over the cap placed image data is deleted from the least recently completed session
+        reclaim = dcm2bids.bids_init_reclaim('lru', self.work_dir, work_cap=1e-9)
+        with self.assertLogs('dcm2bids', 'INFO'):
+            n_bytes = dcm2bids.bids_reclaim_session(reclaim, self.journal, SESSION_KEY, self.conv_dir, None,
+                                                    completed_now=False)
+
+        work_files = self.work_files()
+        self.assertGreater(n_bytes, 0)
+        self.assertIn(dcm2bids.BIDS_RECLAIM_MARKER, work_files)
+        self.assertIn('S01--Localizer--GR--1.nii.gz', work_files)
+        self.assertNotIn('S01--T1_MPRAGE--GR_IR--2.nii.gz', work_files)
+
+
+class TestManifest(PlaceTestCase):
+
+    def manifest_rows(self, manifest_fname):
+        with open(manifest_fname) as fd:
+            lines = [line.rstrip('\n').split('\t') for line in fd]
+        self.assertEqual(lines[0], ['path', 'size', 'md5', 'sha256', 'mtime_ns', 'inode'])
+        return {row[0]: row[1:] for row in lines[1:]}
+
+    def close_manifest(self, manifest):
+        """
+        Write the manifest and return the number of files hashed after placement
+        """
+
+        with self.assertLogs('dcm2bids', 'INFO') as logs:
+            dcm2bids.bids_close_manifest(manifest)
+
+        message = [line for line in logs.output if 'Checksum manifest' in line][0]
+        return int(message.split(', ')[1].split()[0])
+
+    def test_manifest(self):
+
+        manifest_fname = os.path.join(self.tmp_dir, 'MANIFEST.tsv')
+        manifest = dcm2bids.bids_open_manifest(manifest_fname, self.src_dir)
+        self.run_conversion(io_threads=4, manifest=manifest)
+
+        # Every placed file was digested during placement
+        self.assertEqual(self.close_manifest(manifest), 0)
+
+        rows = self.manifest_rows(manifest_fname)
+        self.assertEqual(sorted(rows), SESSION_PLACED)
+
+        for path, (size, md5, sha256, _, _) in rows.items():
+            with open(os.path.join(self.src_dir, path), 'rb') as fd:
+                data = fd.read()
+            self.assertEqual((int(size), md5, sha256),
+                             (len(data), hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest()))
+
+        # A later run reuses digests of unchanged files and only hashes edited or new ones
+        events = os.path.join(self.src_dir, 'func', 'sub-S01_ses-first_task-rest_run-01_events.tsv')
+        with open(events, 'a') as fd:
+            fd.write('0.0\t30.0\trest\n')
+
+        manifest = dcm2bids.bids_open_manifest(manifest_fname, self.src_dir)
+        self.assertEqual(self.close_manifest(manifest), 1)
+
+        with open(events, 'rb') as fd:
+            self.assertEqual(self.manifest_rows(manifest_fname)[os.path.relpath(events, self.src_dir)][1],
+                             hashlib.md5(fd.read()).hexdigest())
+
+    def test_direct(self):
+
+        # Moved images are hashed when the manifest is closed
+        manifest_fname = os.path.join(self.tmp_dir, 'MANIFEST.tsv')
+        manifest = dcm2bids.bids_open_manifest(manifest_fname, self.src_dir)
+        self.run_conversion(manifest=manifest, direct=True)
+
+        n_moved = len([name for name in SESSION_NII.values() if name]) + 2  # Images, bval and bvec
+        self.assertEqual(self.close_manifest(manifest), n_moved)
+        self.assertEqual(sorted(self.manifest_rows(manifest_fname)), SESSION_PLACED)
+
+
+if __name__ == '__main__':
+    unittest.main()
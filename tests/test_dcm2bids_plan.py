@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Conversion plan tests for dcm2bids
+
+Writes fake dcm2niix outputs (JSON sidecar and empty .nii.gz) into a temporary
+working conversion directory and checks the BIDS destinations, run, echo and part
+entities, IntendedFor and collision status resolved by bids_plan_session. No DICOM,
+dcm2niix or NIfTI reader is needed.
+
+Usage
+----
+% python -m pytest tests
+% python tests/test_dcm2bids_plan.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import dcm2bids
+
+SID, SES = 'S01', 'first'
+
+MAG = ['ORIGINAL', 'PRIMARY', 'M', 'ND']
+PHASE = ['ORIGINAL', 'PRIMARY', 'P', 'ND']
+
+# Protocol translator for the typical session written by PlanTestCase.add_session
+PROT_DICT = {'Localizer': ['EXCLUDE_BIDS_Directory', 'EXCLUDE_BIDS_Name', 'UNASSIGNED'],
+             'T1_MPRAGE': ['anat', 'T1w', 'UNASSIGNED'],
+             'rsBOLD': ['func', 'task-rest_bold', 'UNASSIGNED'],
+             'Fieldmap': ['fmap', 'acq-rest', ['task-rest_run-01_bold', 'task-rest_run-02_bold']],
+             'DTI': ['dwi', 'dwi', 'UNASSIGNED']}
+
+# BIDS destinations of the typical session, relative to the subject/session source directory
+SESSION_NII = {'S01--Localizer--GR--1.nii.gz': '',
+               'S01--T1_MPRAGE--GR_IR--2.nii.gz': 'anat/sub-S01_ses-first_T1w.nii.gz',
+               'S01--rsBOLD--EP--5.nii.gz': 'func/sub-S01_ses-first_task-rest_run-01_bold.nii.gz',
+               'S01--rsBOLD--EP--7.nii.gz': 'func/sub-S01_ses-first_task-rest_run-02_bold.nii.gz',
+               'S01--Fieldmap--GR--8.nii.gz': 'fmap/sub-S01_ses-first_acq-rest_magnitude.nii.gz',
+               'S01--Fieldmap--GR--8a.nii.gz': '',
+               'S01--Fieldmap--GR--9.nii.gz': 'fmap/sub-S01_ses-first_acq-rest_phasediff.nii.gz',
+               'S01--DTI--EP--10.nii.gz': 'dwi/sub-S01_ses-first_dwi.nii.gz'}
+
+
+def glob_nii(conv_dir):
+    """
+    Working Nifti filenames in a conversion directory
+
+    :return: list
+    """
+
+    return [os.path.join(conv_dir, f) for f in sorted(os.listdir(conv_dir)) if f.endswith('.nii.gz')]
+
+
+class PlanTestCase(unittest.TestCase):
+    """
+    Temporary working conversion directory and BIDS source directory
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='dcm2bids_')
+        self.conv_dir = os.path.join(self.tmp_dir, 'work', 'conversion', 'sub-' + SID, 'ses-' + SES)
+        self.src_dir = os.path.join(self.tmp_dir, 'source', 'sub-' + SID, 'ses-' + SES)
+        os.makedirs(self.conv_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def add_output(self, stem, **info):
+        """
+        Fake dcm2niix output : sidecar with the given fields and an empty image
+
+        :param stem: str
+            Working filename without extension (eg S01--rsBOLD--EP--5)
+        """
+
+        with open(os.path.join(self.conv_dir, stem + '.json'), 'w') as fd:
+            json.dump(info, fd)
+
+        open(os.path.join(self.conv_dir, stem + '.nii.gz'), 'wb').close()
+
+    def add_session(self):
+        """
+        Typical session : excluded localizer, T1w, two BOLD runs, dual echo GRE fieldmap and DWI
+        """
+
+        self.add_output('S01--Localizer--GR--1', EchoTime=0.004, ImageType=MAG)
+        self.add_output('S01--T1_MPRAGE--GR_IR--2', EchoTime=0.003, ImageType=MAG)
+        self.add_output('S01--rsBOLD--EP--5', EchoTime=0.03, ImageType=MAG)
+        self.add_output('S01--rsBOLD--EP--7', EchoTime=0.03, ImageType=MAG)
+        self.add_output('S01--Fieldmap--GR--8', EchoTime=0.00492, ImageType=MAG)
+        self.add_output('S01--Fieldmap--GR--8a', EchoTime=0.00738, EchoNumber=2, ImageType=MAG)
+        self.add_output('S01--Fieldmap--GR--9', EchoTime=0.00738, EchoNumber=2, ImageType=PHASE)
+        self.add_output('S01--DTI--EP--10', EchoTime=0.08, ImageType=['ORIGINAL', 'PRIMARY', 'DIFFUSION', 'NONE'])
+
+        for ext, text in (('.bval', '0 1000 1000\n'), ('.bvec', '0 1 0\n0 0 1\n0 0 0\n')):
+            with open(os.path.join(self.conv_dir, 'S01--DTI--EP--10' + ext), 'w') as fd:
+                fd.write(text)
+
+    def plan(self, prot_dict):
+        """
+        Plan the session, keyed by working image filename
+
+        :return: dictionary of BidsImage
+        """
+
+        plan = dcm2bids.bids_plan_session(self.conv_dir, prot_dict, self.src_dir, SID, SES)
+
+        return {os.path.basename(image.work_nii): image for image in plan}
+
+    def bids_name(self, image):
+        return os.path.relpath(image.bids_nii, self.src_dir) if image.bids_nii else ''
+
+
+class TestPlan(PlanTestCase):
+
+    def test_session(self):
+
+        self.add_session()
+        plan = self.plan(PROT_DICT)
+
+        self.assertEqual({name: self.bids_name(image) for name, image in plan.items()}, SESSION_NII)
+        self.assertEqual(plan['S01--Localizer--GR--1.nii.gz'].status, 'exclude')
+        self.assertTrue(all(image.status == 'include' for name, image in plan.items() if 'Localizer' not in name))
+
+        # Nothing is written by planning
+        self.assertFalse(os.path.exists(self.src_dir))
+
+        # Sidecars : only the phase difference image keeps one in fmap, with both echo times and IntendedFor
+        phase = plan['S01--Fieldmap--GR--9.nii.gz']
+        self.assertEqual(os.path.relpath(phase.bids_json, self.src_dir),
+                         'fmap/sub-S01_ses-first_acq-rest_phasediff.json')
+        self.assertEqual((phase.info['EchoTime1'], phase.info['EchoTime2']), (0.00492, 0.00738))
+        self.assertEqual(phase.info['IntendedFor'], ['sub-S01_ses-first_task-rest_run-01_bold.nii.gz',
+                                                     'sub-S01_ses-first_task-rest_run-02_bold.nii.gz'])
+        self.assertEqual(plan['S01--Fieldmap--GR--8.nii.gz'].bids_json, '')
+
+        # One events template per BOLD run, with the task name in the sidecar
+        bold = plan['S01--rsBOLD--EP--7.nii.gz']
+        self.assertEqual(os.path.relpath(bold.bids_events, self.src_dir),
+                         'func/sub-S01_ses-first_task-rest_run-02_events.tsv')
+        self.assertEqual(bold.info['TaskName'], 'rest')
+
+        # DWI gradient tables
+        dwi = plan['S01--DTI--EP--10.nii.gz']
+        self.assertEqual(os.path.relpath(dwi.bids_bval, self.src_dir), 'dwi/sub-S01_ses-first_dwi.bval')
+        self.assertEqual(os.path.relpath(dwi.bids_bvec, self.src_dir), 'dwi/sub-S01_ses-first_dwi.bvec')
+
+    def test_single_intendedfor(self):
+
+        self.add_output('S01--SE_EPI--EP--3', EchoTime=0.05, ImageType=MAG)
+
+        plan = self.plan({'SE_EPI': ['fmap', 'dir-AP_epi', 'task-rest_bold']})
+        image = plan['S01--SE_EPI--EP--3.nii.gz']
+
+        self.assertEqual(self.bids_name(image), 'fmap/sub-S01_ses-first_dir-AP_epi.nii.gz')
+        self.assertEqual(image.info['IntendedFor'], 'sub-S01_ses-first_task-rest_bold.nii.gz')
+
+    def test_missing_sidecar(self):
+
+        self.add_output('S01--T1_MPRAGE--GR_IR--2', EchoTime=0.003, ImageType=MAG)
+        os.remove(os.path.join(self.conv_dir, 'S01--T1_MPRAGE--GR_IR--2.json'))
+
+        plan = self.plan(PROT_DICT)
+
+        self.assertEqual(plan['S01--T1_MPRAGE--GR_IR--2.nii.gz'].status, 'missing sidecar')
+
+    def test_moved_image(self):
+
+        # An image moved by --direct before an interruption is still planned from its sidecar
+        self.add_session()
+        os.remove(os.path.join(self.conv_dir, 'S01--rsBOLD--EP--5.nii.gz'))
+
+        plan = self.plan(PROT_DICT)
+
+        self.assertEqual(self.bids_name(plan['S01--rsBOLD--EP--7.nii.gz']),
+                         'func/sub-S01_ses-first_task-rest_run-02_bold.nii.gz')
+
+    def test_write_plan(self):
+
+        self.add_session()
+        plan = dcm2bids.bids_plan_session(self.conv_dir, PROT_DICT, self.src_dir, SID, SES)
+
+        json_fname = os.path.join(self.tmp_dir, 'plan.json')
+        dcm2bids.bids_write_plan(json_fname, plan)
+        with open(json_fname) as fd:
+            rows = json.load(fd)
+
+        self.assertEqual(len(rows), len(SESSION_NII))
+        row = next(row for row in rows if row['work_nii'].endswith('--9.nii.gz'))
+        self.assertEqual((row['subject'], row['session'], row['status'], row['ser_no']), (SID, SES, 'include', '9'))
+        self.assertEqual(len(row['IntendedFor']), 2)
+
+        tsv_fname = os.path.join(self.tmp_dir, 'plan.tsv')
+        dcm2bids.bids_write_plan(tsv_fname, plan)
+        with open(tsv_fname) as fd:
+            lines = [line.rstrip('\n').split('\t') for line in fd]
+
+        self.assertEqual(lines[0][-1], 'IntendedFor')
+        self.assertEqual(len(lines), len(SESSION_NII) + 1)
+        self.assertTrue(all(len(line) == len(lines[0]) for line in lines))
+
+
+class TestMultiEcho(PlanTestCase):
+
+    def test_me_bold_mag_phase(self):
+
+        # Three echo BOLD with magnitude and phase outputs (dcm2niix _e<N> and _e<N>_ph suffixes)
+        for echo, te in enumerate([0.015, 0.035, 0.055], 1):
+            self.add_output('S01--MEBOLD--EP--5_e%d' % echo, EchoNumber=echo, EchoTime=te, ImageType=MAG)
+            self.add_output('S01--MEBOLD--EP--5_e%d_ph' % echo, EchoNumber=echo, EchoTime=te, ImageType=PHASE)
+
+        plan = self.plan({'MEBOLD': ['func', 'task-rest_bold', 'UNASSIGNED']})
+
+        expected = dict()
+        for echo in (1, 2, 3):
+            expected['S01--MEBOLD--EP--5_e%d.nii.gz' % echo] = \
+                'func/sub-S01_ses-first_task-rest_echo-%d_part-mag_bold.nii.gz' % echo
+            expected['S01--MEBOLD--EP--5_e%d_ph.nii.gz' % echo] = \
+                'func/sub-S01_ses-first_task-rest_echo-%d_part-phase_bold.nii.gz' % echo
+
+        self.assertEqual({name: self.bids_name(image) for name, image in plan.items()}, expected)
+        self.assertTrue(all(image.status == 'include' for image in plan.values()))
+
+        # One events template for the run
+        events = [image.bids_events for image in plan.values() if image.bids_events]
+        self.assertEqual([os.path.relpath(f, self.src_dir) for f in events],
+                         ['func/sub-S01_ses-first_task-rest_events.tsv'])
+
+    def test_me_bold_phase_series(self):
+
+        # Magnitude and phase as consecutive series (older Siemens export)
+        for echo, te in enumerate([0.015, 0.035], 1):
+            suffix = '' if echo == 1 else 'a'
+            self.add_output('S01--MEBOLD--EP--5' + suffix, EchoNumber=echo, EchoTime=te, ImageType=MAG)
+            self.add_output('S01--MEBOLD--EP--6' + suffix, EchoNumber=echo, EchoTime=te, ImageType=PHASE)
+
+        plan = self.plan({'MEBOLD': ['func', 'task-rest_bold', 'UNASSIGNED']})
+
+        self.assertEqual(self.bids_name(plan['S01--MEBOLD--EP--6a.nii.gz']),
+                         'func/sub-S01_ses-first_task-rest_echo-2_part-phase_bold.nii.gz')
+        self.assertEqual(self.bids_name(plan['S01--MEBOLD--EP--5.nii.gz']),
+                         'func/sub-S01_ses-first_task-rest_echo-1_part-mag_bold.nii.gz')
+        self.assertTrue(all(image.status == 'include' for image in plan.values()))
+
+    def test_me_bold_runs(self):
+
+        # Two multi-echo BOLD runs, each with its own events template
+        for ser_no in (5, 8):
+            for echo, te in enumerate([0.015, 0.035], 1):
+                self.add_output('S01--MEBOLD--EP--%d_e%d' % (ser_no, echo), EchoNumber=echo, EchoTime=te,
+                                ImageType=MAG)
+
+        plan = self.plan({'MEBOLD': ['func', 'task-rest_bold', 'UNASSIGNED']})
+
+        self.assertEqual(self.bids_name(plan['S01--MEBOLD--EP--8_e2.nii.gz']),
+                         'func/sub-S01_ses-first_task-rest_run-02_echo-2_bold.nii.gz')
+        self.assertEqual(sorted(os.path.basename(image.bids_events) for image in plan.values() if image.bids_events),
+                         ['sub-S01_ses-first_task-rest_run-01_events.tsv',
+                          'sub-S01_ses-first_task-rest_run-02_events.tsv'])
+
+    def test_memprage(self):
+
+        # Multi-echo anatomy gets echo entities too
+        for echo, te in enumerate([0.0016, 0.0035, 0.0054, 0.0073], 1):
+            self.add_output('S01--MEMPRAGE--GR_IR--2' + ('', 'a', 'b', 'c')[echo - 1],
+                            EchoNumber=echo, EchoTime=te, ImageType=MAG)
+
+        plan = self.plan({'MEMPRAGE': ['anat', 'T1w', 'UNASSIGNED']})
+
+        self.assertEqual(sorted(self.bids_name(image) for image in plan.values()),
+                         ['anat/sub-S01_ses-first_echo-%d_T1w.nii.gz' % echo for echo in (1, 2, 3, 4)])
+
+    def test_gre_fieldmap_no_echo(self):
+
+        # Newer dcm2niix suffixes for a dual echo GRE fieldmap - no echo or part entities
+        self.add_output('S01--Fieldmap--GR--8_e1', EchoNumber=1, EchoTime=0.00492, ImageType=MAG)
+        self.add_output('S01--Fieldmap--GR--8_e2', EchoNumber=2, EchoTime=0.00738, ImageType=MAG)
+        self.add_output('S01--Fieldmap--GR--9_e2_ph', EchoNumber=2, EchoTime=0.00738, ImageType=PHASE)
+
+        plan = self.plan(PROT_DICT)
+
+        self.assertEqual({name: self.bids_name(image) for name, image in plan.items()},
+                         {'S01--Fieldmap--GR--8_e1.nii.gz': 'fmap/sub-S01_ses-first_acq-rest_magnitude.nii.gz',
+                          'S01--Fieldmap--GR--8_e2.nii.gz': '',
+                          'S01--Fieldmap--GR--9_e2_ph.nii.gz': 'fmap/sub-S01_ses-first_acq-rest_phasediff.nii.gz'})
+        self.assertEqual(plan['S01--Fieldmap--GR--9_e2_ph.nii.gz'].info['EchoTime1'], 0.00492)
+
+
+class TestGrouping(PlanTestCase):
+
+    def test_repeated_series(self):
+
+        # A series pushed twice gets the dcm2niix 'a' suffix but an identical sidecar - a repeat, not an echo
+        self.add_output('S01--rsBOLD--EP--5', EchoTime=0.03, ImageType=MAG)
+        self.add_output('S01--rsBOLD--EP--5a', EchoTime=0.03, ImageType=MAG)
+
+        plan = self.plan(PROT_DICT)
+
+        self.assertEqual({name: self.bids_name(image) for name, image in plan.items()},
+                         {'S01--rsBOLD--EP--5.nii.gz': 'func/sub-S01_ses-first_task-rest_run-01_bold.nii.gz',
+                          'S01--rsBOLD--EP--5a.nii.gz': 'func/sub-S01_ses-first_task-rest_run-02_bold.nii.gz'})
+
+    def test_runs_in_series_order(self):
+
+        # Runs follow series number, not filename order
+        for ser_no in (12, 3, 7):
+            self.add_output('S01--rsBOLD--EP--%d' % ser_no, EchoTime=0.03, ImageType=MAG)
+
+        images = dcm2bids.bids_group_series(glob_nii(self.conv_dir))
+
+        self.assertEqual([(image.ser_no, image.run) for image in images], [(3, 1), (7, 2), (12, 3)])
+        self.assertTrue(all(image.n_echoes == 1 and image.first_echo for image in images))
+
+    def test_single_series(self):
+
+        self.add_output('S01--T1_MPRAGE--GR_IR--2', EchoTime=0.003, ImageType=MAG)
+
+        images = dcm2bids.bids_group_series(glob_nii(self.conv_dir))
+
+        self.assertEqual((images[0].run, images[0].n_echoes, images[0].has_phase), (0, 1, False))
+
+
+class TestCollision(PlanTestCase):
+
+    def test_shared_destination(self):
+
+        # Two protocols translated to the same BIDS name are neither placed
+        self.add_output('S01--T2w_A--SE--6', EchoTime=0.09, ImageType=MAG)
+        self.add_output('S01--T2w_B--SE--7', EchoTime=0.09, ImageType=MAG)
+        self.add_output('S01--T1_MPRAGE--GR_IR--2', EchoTime=0.003, ImageType=MAG)
+
+        prot_dict = dict(PROT_DICT, T2w_A=['anat', 'T2w', 'UNASSIGNED'], T2w_B=['anat', 'T2w', 'UNASSIGNED'])
+        plan = self.plan(prot_dict)
+
+        self.assertEqual(plan['S01--T2w_A--SE--6.nii.gz'].status, 'collision')
+        self.assertEqual(plan['S01--T2w_B--SE--7.nii.gz'].status, 'collision')
+        self.assertEqual(plan['S01--T1_MPRAGE--GR_IR--2.nii.gz'].status, 'include')
+
+    def test_collision_not_placed(self):
+
+        self.add_output('S01--T2w_A--SE--6', EchoTime=0.09, ImageType=MAG)
+        self.add_output('S01--T2w_B--SE--7', EchoTime=0.09, ImageType=MAG)
+
+        prot_dict = {'T2w_A': ['anat', 'T2w', 'UNASSIGNED'], 'T2w_B': ['anat', 'T2w', 'UNASSIGNED']}
+        journal = dcm2bids.bids_open_journal(os.path.join(self.tmp_dir, 'journal.jsonl'))
+
+        with self.assertLogs('dcm2bids', 'ERROR'):
+            dcm2bids.bids_run_conversion(self.conv_dir, False, prot_dict, self.src_dir, SID, SES,
+                                         journal=journal, session_key='sub-S01/ses-first')
+        journal['fd'].close()
+
+        self.assertFalse(os.path.exists(os.path.join(self.src_dir, 'anat', 'sub-S01_ses-first_T2w.nii.gz')))
+        self.assertNotIn('complete', journal['done'].get('sub-S01/ses-first', set()))
+
+
+if __name__ == '__main__':
+    unittest.main()
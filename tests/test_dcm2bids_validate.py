@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Header-only DWI and BOLD consistency check tests for dcm2bids
+
+Writes bare Nifti-1 and Nifti-2 headers (plain and gzipped, both byte orders)
+and checks bids_nifti_dims, bids_validate_dwi and bids_validate_bold.
+
+Usage
+----
+% python -m pytest tests
+% python tests/test_dcm2bids_validate.py
+"""
+
+import os
+import sys
+import gzip
+import struct
+import shutil
+import tempfile
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import dcm2bids
+
+
+def nifti_header(dim, version=1, endian='<'):
+    """
+    Bare Nifti header with only sizeof_hdr, dim and magic set
+
+    :param dim: list
+        Nifti dim array (8 values)
+    :param version: int
+        1 or 2
+    :param endian: str
+        struct byte order ('<' or '>')
+    :return: bytes
+    """
+
+    if version == 1:
+        hdr = bytearray(348)
+        hdr[0:4] = struct.pack(endian + 'i', 348)
+        hdr[40:56] = struct.pack(endian + '8h', *dim)
+        hdr[344:348] = b'n+1\0'
+    else:
+        hdr = bytearray(540)
+        hdr[0:4] = struct.pack(endian + 'i', 540)
+        hdr[4:12] = b'n+2\0\r\n\032\n'
+        hdr[16:80] = struct.pack(endian + '8q', *dim)
+
+    return bytes(hdr)
+
+
+class TestNiftiDims(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='dcm2bids_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def write_nifti(self, name, hdr):
+        fname = os.path.join(self.tmp_dir, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(fname, 'wb') as fd:
+            fd.write(hdr + bytes(16))
+        return fname
+
+    def test_dims(self):
+
+        dim = [4, 64, 64, 32, 3, 1, 1, 1]
+
+        for version in (1, 2):
+            for endian in '<>':
+                for ext in ('.nii', '.nii.gz'):
+                    with self.subTest(version=version, endian=endian, ext=ext):
+                        fname = self.write_nifti('image' + ext, nifti_header(dim, version, endian))
+                        self.assertEqual(dcm2bids.bids_nifti_dims(fname), dim)
+
+    def test_unreadable(self):
+
+        self.assertEqual(dcm2bids.bids_nifti_dims(self.write_nifti('empty.nii.gz', b'')), [])
+        self.assertEqual(dcm2bids.bids_nifti_dims(self.write_nifti('junk.nii', bytes(600))), [])
+        self.assertEqual(dcm2bids.bids_nifti_dims(os.path.join(self.tmp_dir, 'missing.nii')), [])
+
+    def test_validate_dwi(self):
+
+        bval = os.path.join(self.tmp_dir, 'dwi.bval')
+        bvec = os.path.join(self.tmp_dir, 'dwi.bvec')
+        with open(bval, 'w') as fd:
+            fd.write('0 1000 1000\n')
+        with open(bvec, 'w') as fd:
+            fd.write('0 1 0\n0 0 1\n0 0 0\n')
+
+        # Nifti-2 DWI is checked like Nifti-1
+        for version in (1, 2):
+            with self.subTest(version=version):
+                ok = self.write_nifti('dwi.nii.gz', nifti_header([4, 64, 64, 32, 3, 1, 1, 1], version))
+                self.assertEqual(dcm2bids.bids_validate_dwi(ok, bval, bvec), [])
+                bad = self.write_nifti('dwi.nii.gz', nifti_header([4, 64, 64, 32, 4, 1, 1, 1], version))
+                self.assertEqual(len(dcm2bids.bids_validate_dwi(bad, bval, bvec)), 2)
+
+        # Unreadable headers say that the checks were skipped
+        problems = dcm2bids.bids_validate_dwi(self.write_nifti('junk.nii', bytes(600)), bval, bvec)
+        self.assertIn('skipped', problems[0])
+
+    def test_validate_bold(self):
+
+        for version in (1, 2):
+            with self.subTest(version=version):
+                ok = self.write_nifti('bold.nii', nifti_header([4, 64, 64, 32, 100, 1, 1, 1], version))
+                self.assertEqual(dcm2bids.bids_validate_bold(ok), [])
+                single = self.write_nifti('bold.nii', nifti_header([3, 64, 64, 32, 1, 1, 1, 1], version))
+                self.assertEqual(len(dcm2bids.bids_validate_bold(single)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Retrieval tests for dcmpacs against a local Query/Retrieve SCP stand-in
+
+Starts a pynetdicom Study Root Q/R SCP (C-FIND, C-GET and C-MOVE) over a few
+synthetic MR images, then runs dcmpacs.py in a subprocess with each retrieval
+method. Checks that series land in <SID>/<StudyDate>/<SerNo>_<Desc>/, that series
+sharing a number and description get separate directories, that the .incoming
+staging directory is left empty, and that a rerun skips everything recorded in
+Retrieval_Log.jsonl.
+
+Skipped if pydicom or pynetdicom is not installed.
+
+Usage
+----
+% python -m pytest tests
+% python tests/test_dcmpacs.py
+"""
+
+import os
+import sys
+import json
+import socket
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+try:
+    import pynetdicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ImplicitVRLittleEndian, generate_uid
+    HAVE_PYNETDICOM = True
+except ImportError:
+    HAVE_PYNETDICOM = False
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PATIENT_ID = 'P001'
+STUDY_DATE = '20240131'
+
+# (SeriesNumber, SeriesDescription, number of images)
+SERIES = [(2, 'T1 MPRAGE', 2), (5, 'rsBOLD', 1)]
+
+# Series re-sent to the PACS as a new series with the same number and description
+REPEATED_SERIES = SERIES + [(5, 'rsBOLD', 3)]
+
+SCP_AET = 'TESTQR'
+
+
+def free_port():
+    """
+    Unused local TCP port
+
+    :return: int
+    """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_datasets(series):
+    """
+    Synthetic single-frame MR images for one patient and study
+
+    :param series: list
+        (SeriesNumber, SeriesDescription, number of images) for each series
+    :return: list of pydicom Datasets
+    """
+
+    from pynetdicom.sop_class import MRImageStorage
+
+    study_uid = generate_uid()
+    datasets = []
+
+    for ser_no, ser_desc, n_images in series:
+
+        series_uid = generate_uid()
+
+        for inst_no in range(1, n_images + 1):
+
+            ds = Dataset()
+            ds.file_meta = FileMetaDataset()
+            ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+            ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+            ds.SOPClassUID = MRImageStorage
+            ds.SOPInstanceUID = generate_uid()
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+            ds.PatientID = PATIENT_ID
+            ds.PatientName = 'Test^Subject'
+            ds.StudyInstanceUID = study_uid
+            ds.StudyDate = STUDY_DATE
+            ds.StudyTime = '120000'
+            ds.SeriesInstanceUID = series_uid
+            ds.SeriesNumber = ser_no
+            ds.SeriesDescription = ser_desc
+            ds.InstanceNumber = inst_no
+            ds.Modality = 'MR'
+            ds.Rows = ds.Columns = 2
+            ds.BitsAllocated = ds.BitsStored = 16
+            ds.HighBit = 15
+            ds.PixelRepresentation = 0
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = 'MONOCHROME2'
+            ds.PixelData = bytes(8)
+
+            datasets.append(ds)
+
+    return datasets
+
+
+def start_qr_scp(datasets, port, move_port):
+    """
+    Study Root Q/R SCP stand-in serving a fixed list of datasets
+
+    :param datasets: list of pydicom Datasets
+    :param port: int
+        Listening port
+    :param move_port: int
+        Port of the C-MOVE destination (any move destination AE title maps here)
+    :return: pynetdicom server
+    """
+
+    from pynetdicom import AE, evt, StoragePresentationContexts
+    from pynetdicom.sop_class import (MRImageStorage,
+                                      StudyRootQueryRetrieveInformationModelFind as FindModel,
+                                      StudyRootQueryRetrieveInformationModelGet as GetModel,
+                                      StudyRootQueryRetrieveInformationModelMove as MoveModel)
+
+    def matches(ds, query):
+        for keyword in ('PatientID', 'StudyInstanceUID', 'SeriesInstanceUID'):
+            value = query.get(keyword, '')
+            if value and str(ds.get(keyword, '')) != str(value):
+                return False
+        return True
+
+    def handle_find(event):
+        query = event.identifier
+        level = query.QueryRetrieveLevel
+        seen = set()
+        for ds in datasets:
+            uid = ds.StudyInstanceUID if level == 'STUDY' else ds.SeriesInstanceUID
+            if not matches(ds, query) or uid in seen:
+                continue
+            seen.add(uid)
+            response = Dataset()
+            response.QueryRetrieveLevel = level
+            for elem in query:
+                if elem.keyword != 'QueryRetrieveLevel':
+                    setattr(response, elem.keyword, ds.get(elem.keyword, ''))
+            yield 0xFF00, response
+
+    def handle_get(event):
+        matched = [ds for ds in datasets if matches(ds, event.identifier)]
+        yield len(matched)
+        for ds in matched:
+            yield 0xFF00, ds
+
+    def handle_move(event):
+        matched = [ds for ds in datasets if matches(ds, event.identifier)]
+        yield '127.0.0.1', move_port
+        yield len(matched)
+        for ds in matched:
+            yield 0xFF00, ds
+
+    ae = AE(ae_title=SCP_AET)
+    for model in (FindModel, GetModel, MoveModel):
+        ae.add_supported_context(model)
+    for cx in StoragePresentationContexts:
+        ae.add_supported_context(cx.abstract_syntax, scu_role=True, scp_role=True)
+    ae.add_requested_context(MRImageStorage)
+
+    handlers = [(evt.EVT_C_FIND, handle_find), (evt.EVT_C_GET, handle_get), (evt.EVT_C_MOVE, handle_move)]
+
+    return ae.start_server(('127.0.0.1', port), block=False, evt_handlers=handlers)
+
+
+@unittest.skipUnless(HAVE_PYNETDICOM, 'pydicom and pynetdicom are required')
+class TestRetrieval(unittest.TestCase):
+
+    # Series served by the stand-in SCP
+    series = SERIES
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='dcmpacs_')
+        self.port = free_port()
+        self.store_port = free_port()
+        self.scp = start_qr_scp(make_datasets(self.series), self.port, self.store_port)
+
+    def tearDown(self):
+        self.scp.shutdown()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def run_dcmpacs(self, out_dir, method):
+        """
+        Run dcmpacs.py against the stand-in SCP
+
+        :return: stdout
+        """
+
+        cmd = [sys.executable, os.path.join(REPO_DIR, 'dcmpacs.py'),
+               '--host', '127.0.0.1', '--port', str(self.port), '--aec', SCP_AET,
+               '--patient', PATIENT_ID, '-o', out_dir, '-j', '2',
+               '--method', method, '--store-port', str(self.store_port)]
+
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True, timeout=120)
+
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+
+        return proc.stdout
+
+    def check_retrieval(self, method):
+
+        out_dir = os.path.join(self.tmp_dir, method)
+        n_series = len(self.series)
+
+        stdout = self.run_dcmpacs(out_dir, method)
+        self.assertIn('%d series found, %d to retrieve' % (n_series, n_series), stdout)
+
+        # One directory per series named <SID>/<StudyDate>/<SerNo>_<Desc>[_<UID hash>]
+        session_dir = os.path.join(out_dir, PATIENT_ID, STUDY_DATE)
+        ser_dirs = sorted(os.listdir(session_dir))
+        self.assertEqual(len(ser_dirs), n_series)
+
+        for ser_no, ser_desc, n_images in self.series:
+            name = '%d_%s' % (ser_no, ser_desc.replace(' ', '_'))
+            if [s[:2] for s in self.series].count((ser_no, ser_desc)) == 1:
+                matched = [d for d in ser_dirs if d == name]
+            else:
+                # Repeated series in this fixture differ in their number of images
+                matched = [d for d in ser_dirs if d.startswith(name + '_')
+                           and len(os.listdir(os.path.join(session_dir, d))) == n_images]
+            self.assertEqual(len(matched), 1, ser_dirs)
+
+        # Nothing left in the staging directory
+        self.assertEqual(os.listdir(os.path.join(out_dir, '.incoming')), [])
+
+        # One retrieval log record per series
+        with open(os.path.join(out_dir, 'Retrieval_Log.jsonl')) as fd:
+            records = [json.loads(line) for line in fd if line.strip()]
+        self.assertEqual(len(records), n_series)
+        self.assertEqual(sorted(os.path.basename(r['Dir']) for r in records), ser_dirs)
+
+        # Rerun retrieves nothing, even for a series whose directory has since been moved away
+        shutil.rmtree(os.path.join(session_dir, ser_dirs[-1]))
+        stdout = self.run_dcmpacs(out_dir, method)
+        self.assertIn('%d series found, 0 to retrieve' % n_series, stdout)
+
+    def test_get(self):
+        self.check_retrieval('get')
+
+    def test_move(self):
+        self.check_retrieval('move')
+
+
+class TestRepeatedSeries(TestRetrieval):
+
+    # Two series sharing a number and description must not share a directory
+    series = REPEATED_SERIES
+
+    def test_unlogged_directory(self):
+
+        # A series directory without a log record (eg an earlier manual export) is kept,
+        # and counts as retrieved only if it holds the same series
+        out_dir = os.path.join(self.tmp_dir, 'unlogged')
+        self.run_dcmpacs(out_dir, 'get')
+        os.remove(os.path.join(out_dir, 'Retrieval_Log.jsonl'))
+
+        stdout = self.run_dcmpacs(out_dir, 'get')
+        self.assertIn('%d series found, 0 to retrieve' % len(self.series), stdout)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Startup import checks and benchmark for the bidskit command line tools
+
+Runs each tool with -h in a fresh interpreter and checks that none of the
+slow modules (DICOM and NIfTI libraries, numpy, asyncio, pynetdicom) were
+imported. These are deferred to the functions that need them, so --help,
+argument errors and Pass 1 stay fast.
+
+The import time of each tool module is measured with python -X importtime and
+checked against a budget (IMPORT_BUDGET_MS, or the BIDSKIT_IMPORT_BUDGET_MS
+environment variable on slow machines). The bidskit package entry point is
+checked to run several jobs in one interpreter, importing each tool once.
+
+Usage
+----
+% python -m pytest tests
+% python tests/test_startup.py
+% python tests/test_startup.py --bench
+"""
+
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be loaded just to print help
+DEFERRED_MODULES = ['dicom', 'pydicom', 'nibabel', 'numpy', 'dateutil', 'asyncio', 'pynetdicom']
+
+TOOLS = ['dcm2bids.py', 'dcm2ndar.py', 'dcmhdr.py', 'dcmpacs.py']
+
+# Cumulative import time budget for each tool module. Importing pydicom alone takes several times this
+IMPORT_BUDGET_MS = float(os.environ.get('BIDSKIT_IMPORT_BUDGET_MS', 150))
+
+# Run a tool's main() with -h, then report which deferred modules were imported
+PROBE = '''
+import sys, json, runpy
+sys.argv = [%r, '-h']
+sys.path.insert(0, %r)
+try:
+    runpy.run_path(%r, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps([m for m in %r if m in sys.modules]))
+'''
+
+
+def loaded_modules(tool):
+    """
+    Deferred modules imported by running a tool with -h
+
+    :param tool: str
+        Script filename within the repository
+    :return: list of module names
+    """
+
+    script = os.path.join(REPO_DIR, tool)
+    code = PROBE % (script, REPO_DIR, script, DEFERRED_MODULES)
+
+    proc = subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, timeout=60)
+
+    return json.loads(proc.stderr.strip().splitlines()[-1])
+
+
+def import_time(module):
+    """
+    Cumulative import time of a module in a fresh interpreter from python -X importtime
+
+    :param module: str
+        Module name (eg dcm2bids)
+    :return: float
+        Milliseconds, best of three runs
+    """
+
+    times = []
+
+    for _ in range(3):
+
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                              cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True, timeout=60)
+
+        # Lines are 'import time: <self us> | <cumulative us> | <module>', innermost modules first
+        for line in proc.stderr.splitlines():
+            fields = [f.strip() for f in line.split('|')]
+            if len(fields) == 3 and fields[2] == module:
+                times.append(int(fields[1]) / 1000.0)
+
+    return min(times)
+
+
+def bench():
+    """
+    Print the import time of each tool module and the bidskit package
+    """
+
+    print('%-10s %10s' % ('Module', 'Import ms'))
+    for module in [tool[:-3] for tool in TOOLS] + ['bidskit']:
+        print('%-10s %10.1f' % (module, import_time(module)))
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_help_imports(self):
+        for tool in TOOLS:
+            with self.subTest(tool=tool):
+                self.assertEqual(loaded_modules(tool), [])
+
+    def test_import_time(self):
+        for tool in TOOLS:
+            module = tool[:-3]
+            with self.subTest(module=module):
+                self.assertLess(import_time(module), IMPORT_BUDGET_MS)
+
+    def test_single_entry_point(self):
+
+        # Several jobs in one interpreter through the package entry point, each tool imported once
+        code = ('import sys, bidskit\n'
+                'status = [bidskit.run(tool, ["-h"]) for tool in ("dcmhdr", "dcm2bids", "dcmhdr")]\n'
+                'sys.stderr.write("%s %s" % (status, sys.modules["dcmhdr"] is bidskit.tool_module("dcmhdr")))')
+
+        proc = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE, universal_newlines=True, timeout=60)
+
+        self.assertEqual(proc.stderr.strip().splitlines()[-1], '[0, 0, 0] True')
+
+        # Command line dispatch
+        proc = subprocess.run([sys.executable, '-m', 'bidskit', 'dcmhdr', '-h'], cwd=REPO_DIR,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=60)
+
+        self.assertEqual(proc.returncode, 0, proc.stdout)
+        self.assertIn('usage: dcmhdr.py', proc.stdout)
+
+
+if __name__ == '__main__':
+    if '--bench' in sys.argv:
+        bench()
+    else:
+        unittest.main()